@@ -0,0 +1,70 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTag, MClassifierTitle
+from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds
+from apps.analyzer.models import apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import ClassifierScorer
+from optparse import make_option
+
+WORDS = ("apple google startup funding review launch rumor update security mobile "
+         "privacy design music video science space climate election market game").split()
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-s", "--stories", dest="stories", type="int", default=10000),
+        make_option("-c", "--classifiers", dest="classifiers", type="int", default=200),
+        make_option("-f", "--feeds", dest="feeds", type="int", default=10),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(1)
+        feed_ids = range(1, options['feeds'] + 1)
+        per_type = options['classifiers'] / 4
+
+        def score():
+            return random.choice([-1, 1])
+
+        classifier_feeds = [MClassifierFeed(feed_id=feed_id, score=score()) for feed_id in feed_ids]
+        classifier_authors = [MClassifierAuthor(feed_id=random.choice(feed_ids), score=score(),
+                                                author="Author %s" % i) for i in range(per_type)]
+        classifier_tags = [MClassifierTag(feed_id=random.choice(feed_ids), score=score(),
+                                          tag="%s%s" % (random.choice(WORDS), i)) for i in range(per_type)]
+        classifier_titles = [MClassifierTitle(feed_id=random.choice(feed_ids), score=score(),
+                                              title="%s %s" % (random.choice(WORDS), random.choice(WORDS)))
+                             for i in range(options['classifiers'] - 3 * per_type)]
+
+        stories = []
+        for i in range(options['stories']):
+            stories.append({
+                'story_feed_id': random.choice(feed_ids),
+                'story_title': ' '.join(random.choice(WORDS) for _ in range(8)).title(),
+                'story_authors': "Author %s" % random.randint(0, per_type * 4),
+                'story_tags': ["%s%s" % (random.choice(WORDS), random.randint(0, per_type * 4))
+                               for _ in range(3)],
+            })
+
+        start = time.time()
+        legacy = []
+        for story in stories:
+            legacy.append({
+                'feed': apply_classifier_feeds(classifier_feeds, story['story_feed_id']),
+                'author': apply_classifier_authors(classifier_authors, story),
+                'tags': apply_classifier_tags(classifier_tags, story),
+                'title': apply_classifier_titles(classifier_titles, story),
+            })
+        legacy_time = time.time() - start
+
+        start = time.time()
+        scorer = ClassifierScorer(classifier_feeds=classifier_feeds,
+                                  classifier_authors=classifier_authors,
+                                  classifier_titles=classifier_titles,
+                                  classifier_tags=classifier_tags)
+        compiled = scorer.score_stories(stories)
+        compiled_time = time.time() - start
+
+        print " ---> %s stories x %s classifiers" % (len(stories), options['classifiers'])
+        print " ---> apply_classifier_*: %.3fs" % legacy_time
+        print " ---> ClassifierScorer:   %.3fs (%.1fx)" % (compiled_time, legacy_time / max(compiled_time, 1e-6))
+        print " ---> Identical scores:   %s" % (legacy == compiled)
@@ -1,3 +1,4 @@
+import re
 import mongoengine as mongo
 from collections import defaultdict
 from django.db import models
@@ -152,7 +153,121 @@ def apply_classifier_feeds(classifiers, feed, social_user_ids=None):
             classifier.social_user_id in social_user_ids):
             return classifier.score
     return 0
-    
+
+
+class ClassifierScorer(object):
+    """
+    A user's classifiers compiled once and indexed by feed id, so a whole page (or
+    a whole feed's unread stories) can be scored without rescanning every classifier
+    for every story. Scores are identical to the apply_classifier_* functions: the
+    first positive match wins, otherwise the last match in classifier order.
+
+    Title phrases are checked with one combined regex per feed. Most stories match
+    nothing and are rejected in a single search; only titles that hit the regex are
+    re-checked against the individual phrases to keep the exact score semantics.
+    """
+
+    def __init__(self, classifier_feeds=None, classifier_authors=None,
+                 classifier_titles=None, classifier_tags=None):
+        self.feeds   = {}
+        self.authors = defaultdict(lambda: defaultdict(list))
+        self.tags    = defaultdict(lambda: defaultdict(list))
+        self.titles  = defaultdict(list)
+        self.title_patterns = {}
+
+        for classifier in classifier_feeds or []:
+            if classifier.feed_id not in self.feeds:
+                self.feeds[classifier.feed_id] = classifier.score
+        for position, classifier in enumerate(classifier_authors or []):
+            self.authors[classifier.feed_id][classifier.author].append((position, classifier.score))
+        for position, classifier in enumerate(classifier_tags or []):
+            self.tags[classifier.feed_id][classifier.tag].append((position, classifier.score))
+        for classifier in classifier_titles or []:
+            if classifier.title is None: continue
+            self.titles[classifier.feed_id].append((classifier.title.lower(), classifier.score))
+        for feed_id, titles in self.titles.items():
+            phrases = sorted(set(title for title, _ in titles), key=len, reverse=True)
+            self.title_patterns[feed_id] = re.compile(u'|'.join(re.escape(p) for p in phrases))
+
+    @classmethod
+    def for_user(cls, user_id, feed_ids):
+        if not isinstance(feed_ids, list):
+            feed_ids = [feed_ids]
+        params = dict(user_id=user_id, feed_id__in=feed_ids)
+        return cls(classifier_feeds=list(MClassifierFeed.objects(social_user_id=0, **params)),
+                   classifier_authors=list(MClassifierAuthor.objects(**params)),
+                   classifier_titles=list(MClassifierTitle.objects(**params)),
+                   classifier_tags=list(MClassifierTag.objects(**params)))
+
+    @staticmethod
+    def _resolve(matches):
+        score = 0
+        for _, match_score in sorted(matches):
+            score = match_score
+            if score > 0: return score
+        return score
+
+    def score_feed(self, feed_id):
+        return self.feeds.get(feed_id, 0)
+
+    def score_title(self, story):
+        feed_id = story['story_feed_id']
+        pattern = self.title_patterns.get(feed_id)
+        if not pattern: return 0
+        story_title = story['story_title'].lower()
+        if not pattern.search(story_title): return 0
+        score = 0
+        for title, title_score in self.titles[feed_id]:
+            if title in story_title:
+                score = title_score
+                if score > 0: return score
+        return score
+
+    def score_author(self, story):
+        story_authors = story.get('story_authors')
+        if not story_authors: return 0
+        feed_authors = self.authors.get(story['story_feed_id'])
+        if not feed_authors or story_authors not in feed_authors: return 0
+        return self._resolve(feed_authors[story_authors])
+
+    def score_tags(self, story):
+        story_tags = story['story_tags']
+        if not story_tags: return 0
+        feed_tags = self.tags.get(story['story_feed_id'])
+        if not feed_tags: return 0
+        matches = []
+        for tag in set(story_tags):
+            if tag in feed_tags:
+                matches.extend(feed_tags[tag])
+        return self._resolve(matches)
+
+    def score_story(self, story, feed_id=None):
+        return {
+            'feed':   self.score_feed(feed_id or story['story_feed_id']),
+            'author': self.score_author(story),
+            'tags':   self.score_tags(story),
+            'title':  self.score_title(story),
+        }
+
+    def score_stories(self, stories, feed_id=None):
+        return [self.score_story(story, feed_id=feed_id) for story in stories]
+
+    @staticmethod
+    def category(scores):
+        """ Which unread count a story's scores put it in: positive, neutral or negative. """
+        max_score = max(scores['author'], scores['tags'], scores['title'])
+        min_score = min(scores['author'], scores['tags'], scores['title'])
+        if max_score > 0:
+            return 'positive'
+        elif min_score < 0:
+            return 'negative'
+        elif scores['feed'] > 0:
+            return 'positive'
+        elif scores['feed'] < 0:
+            return 'negative'
+        return 'neutral'
+
+
 def get_classifiers_for_user(user, feed_id=None, social_user_id=None, classifier_feeds=None, classifier_authors=None, 
                              classifier_titles=None, classifier_tags=None):
     params = dict(user_id=user.pk)
@@ -8,6 +8,10 @@ from itertools import groupby
 from apps.analyzer.tokenizer import Tokenizer
 from vendor.reverend.thomas import Bayes
 from apps.analyzer.phrase_filter import PhraseFilter
+from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTag, MClassifierTitle
+from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds
+from apps.analyzer.models import apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import ClassifierScorer
 
 
 class QuadgramCollocationFinder(nltk.collocations.AbstractCollocationFinder):
@@ -196,4 +200,46 @@ class ClassifierTest(TestCase):
         guess = classifier.guess('Nothing doing: 393 Pacific St.')
         self.assertTrue('bad' not in guess)
         self.assertTrue('good' not in guess)
-        
\ No newline at end of file
+        
+
+
+class ClassifierScorerTest(TestCase):
+    
+    def test_matches_apply_classifiers(self):
+        classifier_feeds = [MClassifierFeed(feed_id=1, score=-1), MClassifierFeed(feed_id=2, score=1)]
+        classifier_authors = [MClassifierAuthor(feed_id=1, author='Jane', score=-1),
+                              MClassifierAuthor(feed_id=2, author='Jane', score=1)]
+        classifier_tags = [MClassifierTag(feed_id=1, tag='politics', score=-1),
+                           MClassifierTag(feed_id=1, tag='science', score=1)]
+        classifier_titles = [MClassifierTitle(feed_id=1, title='Of The Day', score=-1),
+                             MClassifierTitle(feed_id=1, title='house', score=1),
+                             MClassifierTitle(feed_id=2, title='watch', score=-1)]
+        stories = [
+            dict(story_feed_id=1, story_title='House of the Day', story_authors='Jane',
+                 story_tags=['politics', 'science']),
+            dict(story_feed_id=1, story_title='Condo of the day', story_authors='',
+                 story_tags=['politics']),
+            dict(story_feed_id=2, story_title='Development Watch', story_authors='Jane',
+                 story_tags=[]),
+            dict(story_feed_id=3, story_title='Streetlevel', story_authors='Jane',
+                 story_tags=['science']),
+        ]
+        
+        scorer = ClassifierScorer(classifier_feeds=classifier_feeds,
+                                  classifier_authors=classifier_authors,
+                                  classifier_titles=classifier_titles,
+                                  classifier_tags=classifier_tags)
+        for story, scores in zip(stories, scorer.score_stories(stories)):
+            self.assertEquals(scores, {
+                'feed': apply_classifier_feeds(classifier_feeds, story['story_feed_id']),
+                'author': apply_classifier_authors(classifier_authors, story),
+                'tags': apply_classifier_tags(classifier_tags, story),
+                'title': apply_classifier_titles(classifier_titles, story),
+            })
+    
+    def test_category(self):
+        self.assertEquals(ClassifierScorer.category(dict(feed=0, author=0, tags=0, title=0)), 'neutral')
+        self.assertEquals(ClassifierScorer.category(dict(feed=-1, author=1, tags=-1, title=0)), 'positive')
+        self.assertEquals(ClassifierScorer.category(dict(feed=1, author=0, tags=-1, title=0)), 'negative')
+        self.assertEquals(ClassifierScorer.category(dict(feed=1, author=0, tags=0, title=0)), 'positive')
+        self.assertEquals(ClassifierScorer.category(dict(feed=-1, author=0, tags=0, title=0)), 'negative')
@@ -0,0 +1,131 @@
+import datetime
+import hashlib
+import os
+import resource
+import time
+from xml.etree.ElementTree import Element, SubElement, Comment, tostring
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import connection
+from apps.feed_import.models import OPMLExporter
+from apps.reader.models import UserSubscription, UserSubscriptionFolders
+from apps.rss_feeds.models import Feed
+from utils import json_functions as json
+from optparse import make_option
+
+
+def legacy_export(user):
+    """ OPMLExporter.process before streaming, kept as the baseline. """
+    subs = UserSubscription.objects.filter(user=user)
+    feeds = dict((sub.feed_id, sub.canonical()) for sub in subs)
+    usf = UserSubscriptionFolders.objects.get(user=user)
+
+    def process_outline(body, folders):
+        for obj in folders:
+            if isinstance(obj, int) and obj in feeds:
+                feed = feeds[obj]
+                body.append(Element('outline', {
+                    'text': feed['feed_title'],
+                    'title': feed['feed_title'],
+                    'type': 'rss',
+                    'version': 'RSS',
+                    'htmlUrl': feed['feed_link'] or "",
+                    'xmlUrl': feed['feed_address'] or "",
+                }))
+            elif isinstance(obj, dict):
+                for folder_title, folder_objs in obj.items():
+                    folder_element = Element('outline', {'text': folder_title, 'title': folder_title})
+                    body.append(process_outline(folder_element, folder_objs))
+        return body
+
+    root = Element('opml')
+    root.set('version', '1.1')
+    root.append(Comment('Generated by NewsBlur - www.newsblur.com'))
+    process_outline(SubElement(root, 'body'), json.decode(usf.folders))
+    yield tostring(root)
+
+def measure(export):
+    """
+    Runs `export` in a forked child so each run starts from the same peak RSS.
+    Returns (seconds to first chunk, total seconds, bytes, peak RSS growth in KB).
+    """
+    connection.close()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        first_byte = None
+        size = 0
+        for chunk in export():
+            if first_byte is None:
+                first_byte = time.time() - start
+            size += len(chunk)
+        elapsed = time.time() - start
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+        os.write(write_fd, json.encode([first_byte, elapsed, size, rss]))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 1024)
+    os.waitpid(pid, 0)
+    return json.decode(result)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-u", "--username", dest="username", default=None,
+            help="Export this user's feeds instead of generated ones."),
+        make_option("-n", "--count", dest="count", type="int", default=10000,
+            help="Number of feeds to generate for a throwaway user."),
+        make_option("-f", "--folders", dest="folders", type="int", default=50),
+    )
+
+    def handle(self, *args, **options):
+        generated = not options['username']
+        if generated:
+            user = self.generate_user(options['count'], options['folders'])
+        else:
+            user = User.objects.get(username=options['username'])
+
+        try:
+            feed_count = UserSubscription.objects.filter(user=user).count()
+            print " ---> Exporting %s feeds for %s" % (feed_count, user.username)
+            print "%10s  %10s  %10s  %10s  %12s" % ("exporter", "first (s)", "total (s)", "bytes", "peak RSS KB")
+            for name, export in (('streaming', lambda: OPMLExporter(user).stream()),
+                                 ('legacy', lambda: legacy_export(user))):
+                first_byte, elapsed, size, rss = measure(export)
+                print "%10s  %10.3f  %10.3f  %10s  %12s" % (name, first_byte, elapsed, size, rss)
+        finally:
+            if generated:
+                self.delete_user(user)
+
+    def generate_user(self, count, folder_count):
+        username = 'opml_benchmark_%s' % int(time.time())
+        user = User.objects.create(username=username, email='%s@newsblur.com' % username)
+        now = datetime.datetime.utcnow()
+        feeds = []
+        for i in xrange(count):
+            address = 'http://opml-benchmark.newsblur.com/%s/%s/rss' % (username, i)
+            link = 'http://opml-benchmark.newsblur.com/%s/%s' % (username, i)
+            feeds.append(Feed(feed_address=address, feed_link=link,
+                              feed_title='Benchmark feed %s' % i,
+                              hash_address_and_link=hashlib.sha1(address + link).hexdigest(),
+                              last_update=now, next_scheduled_update=now, active=False))
+        Feed.objects.bulk_create(feeds, batch_size=1000)
+        feed_ids = list(Feed.objects.filter(feed_address__startswith='http://opml-benchmark.newsblur.com/%s/' % username)
+                                    .values_list('pk', flat=True))
+        UserSubscription.objects.bulk_create([UserSubscription(user=user, feed_id=feed_id)
+                                              for feed_id in feed_ids], batch_size=1000)
+        folders = [{'Folder %s' % f: feed_ids[f::folder_count]} for f in xrange(folder_count)]
+        UserSubscriptionFolders.objects.create(user=user, folders=json.encode(folders))
+
+        return user
+
+    def delete_user(self, user):
+        feed_ids = list(UserSubscription.objects.filter(user=user).values_list('feed_id', flat=True))
+        UserSubscription.objects.filter(user=user).delete()
+        UserSubscriptionFolders.objects.filter(user=user).delete()
+        for i in xrange(0, len(feed_ids), 1000):
+            Feed.objects.filter(pk__in=feed_ids[i:i+1000]).delete()
+        user.delete()
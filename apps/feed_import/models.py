@@ -1,17 +1,21 @@
 import datetime
+import time
+import hashlib
 import mongoengine as mongo
 import httplib2
 import pickle
 import base64
 from StringIO import StringIO
-from xml.etree.ElementTree import Element, SubElement, Comment, tostring
+from xml.sax.saxutils import quoteattr
 from lxml import etree
 from django.db import models
+from django.db import IntegrityError
 from django.contrib.auth.models import User
 from mongoengine.queryset import OperationError
 import vendor.opml as opml
 from apps.rss_feeds.models import Feed, DuplicateFeed, MStarredStory
 from apps.reader.models import UserSubscription, UserSubscriptionFolders
+from apps.rss_feeds.subscriber_counts import RFeedSubscriberCounts
 from utils import json_functions as json, urlnorm
 from utils import log as logging
 from utils.feed_functions import timelimit
@@ -50,46 +54,78 @@ class Importer:
     
 
 class OPMLExporter(Importer):
+    """
+    Writes a user's folders and feeds out as OPML a piece at a time, so that even
+    thousands of feeds never sit in memory at once: feeds are looked up in chunks
+    as the folders are walked, and each chunk is rendered as soon as it's loaded.
+    """
+    
+    CHUNK_SIZE = 500
     
     def __init__(self, user):
         self.user = user
-        self.fetch_feeds()
         
     def process(self, verbose=False):
+        return ''.join(self.stream(verbose=verbose))
+    
+    def stream(self, verbose=False):
         now = str(datetime.datetime.now())
-
-        root = Element('opml')
-        root.set('version', '1.1')
-        root.append(Comment('Generated by NewsBlur - www.newsblur.com'))
-
-        head       = SubElement(root, 'head')
-        title      = SubElement(head, 'title')
-        title.text = 'NewsBlur Feeds'
-        dc         = SubElement(head, 'dateCreated')
-        dc.text    = now
-        dm         = SubElement(head, 'dateModified')
-        dm.text    = now
-        folders    = self.get_folders()
-        body       = SubElement(root, 'body')
-        self.process_outline(body, folders, verbose=verbose)
-        return tostring(root)
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<opml version="1.1">'
+               '<!--Generated by NewsBlur - www.newsblur.com-->'
+               '<head><title>NewsBlur Feeds</title>'
+               '<dateCreated>%s</dateCreated><dateModified>%s</dateModified></head>'
+               '<body>' % (now, now))
+        
+        events = []
+        feed_ids = []
+        for event in self.walk_folders(self.get_folders()):
+            events.append(event)
+            if event[0] == 'feed':
+                feed_ids.append(event[1])
+                if len(feed_ids) >= self.CHUNK_SIZE:
+                    yield self.render(events, feed_ids, verbose=verbose)
+                    events, feed_ids = [], []
+        if events:
+            yield self.render(events, feed_ids, verbose=verbose)
         
-    def process_outline(self, body, folders, verbose=False):
+        yield '</body></opml>'
+    
+    def walk_folders(self, folders):
+        """ Yields ('feed', feed_id), ('folder', title) and ('end', None) in outline order. """
         for obj in folders:
-            if isinstance(obj, int) and obj in self.feeds:
-                feed = self.feeds[obj]
-                if verbose:
-                    print "     ---> Adding feed: %s - %s" % (feed['id'],
-                                                              feed['feed_title'][:30])
-                feed_attrs = self.make_feed_row(feed)
-                body.append(Element('outline', feed_attrs))
+            if isinstance(obj, int):
+                yield 'feed', obj
             elif isinstance(obj, dict):
                 for folder_title, folder_objs in obj.items():
-                    if verbose:
-                        print " ---> Adding folder: %s" % folder_title
-                    folder_element = Element('outline', {'text': folder_title, 'title': folder_title})
-                    body.append(self.process_outline(folder_element, folder_objs, verbose=verbose))
-        return body
+                    yield 'folder', folder_title
+                    for event in self.walk_folders(folder_objs):
+                        yield event
+                    yield 'end', None
+    
+    def render(self, events, feed_ids, verbose=False):
+        feeds = self.fetch_feeds(feed_ids)
+        xml = []
+        for kind, value in events:
+            if kind == 'feed':
+                feed = feeds.get(value)
+                if not feed: continue
+                if verbose:
+                    print "     ---> Adding feed: %s - %s" % (feed['id'], feed['feed_title'][:30])
+                xml.append(self.outline(self.make_feed_row(feed), close=True))
+            elif kind == 'folder':
+                if verbose:
+                    print " ---> Adding folder: %s" % value
+                xml.append(self.outline({'text': value, 'title': value}))
+            else:
+                xml.append('</outline>')
+        return ''.join(xml)
+    
+    def outline(self, attrs, close=False):
+        attrs = ' '.join('%s=%s' % (name, quoteattr(value or ''))
+                         for name, value in sorted(attrs.items()))
+        xml = u'<outline %s%s>' % (attrs, ' /' if close else '')
+        return xml.encode('utf-8')
     
     def make_feed_row(self, feed):
         feed_attrs = {
@@ -102,12 +138,26 @@ class OPMLExporter(Importer):
         }
         return feed_attrs
         
-    def fetch_feeds(self):
-        subs = UserSubscription.objects.filter(user=self.user)
-        self.feeds = dict((sub.feed_id, sub.canonical()) for sub in subs)
+    def fetch_feeds(self, feed_ids):
+        """ Just the columns an outline needs, for the feeds the user subscribes to. """
+        subs = UserSubscription.objects.filter(user=self.user, feed__in=feed_ids).values_list(
+            'feed_id', 'user_title', 'feed__feed_title', 'feed__feed_link', 'feed__feed_address')
+        return dict((feed_id, {
+            'id': feed_id,
+            'feed_title': user_title or feed_title or "",
+            'feed_link': feed_link,
+            'feed_address': feed_address,
+        }) for feed_id, user_title, feed_title, feed_link, feed_address in subs)
         
 
 class OPMLImporter(Importer):
+    """
+    Imports an OPML file in bulk: the outline is parsed once, every address is
+    resolved against DuplicateFeed and Feed with a handful of IN queries, missing
+    feeds and subscriptions are bulk created, and the folders are saved once.
+    """
+    
+    CHUNK_SIZE = 500
     
     def __init__(self, opml_xml, user):
         self.user = user
@@ -119,83 +169,230 @@ class OPMLImporter(Importer):
         return folders
         
     def process(self):
-        # self.clear_feeds()
+        start = time.time()
         outline = opml.from_string(str(self.opml_xml))
         folders = self.get_folders()
-        folders = self.process_outline(outline, folders)
-        # self.clear_folders()
+        entries = self.parse_outline(outline)
+        feed_entries = dict((e['feed_address'], e) for e in entries if 'feed_address' in e)
+        
+        feeds, new_feed_ids = self.resolve_feeds(feed_entries.values())
+        new_subs = self.subscribe(feeds, feed_entries)
+        folders = self.add_to_folders(entries, feeds, folders)
         self.usf.folders = json.encode(folders)
         self.usf.save()
         
-        return folders
+        if new_feed_ids and self.user.profile.is_premium:
+            self.user.profile.queue_new_feeds(new_feed_ids)
+        logging.user(self.user, "~FR~SBOPML import: ~SB%s~SN feeds, ~SB%s~SN new feeds, "
+                     "~SB%s~SN new subscriptions in ~SB%.2fs" % (
+                     len(feeds), len(new_feed_ids), new_subs, time.time() - start))
         
-    def process_outline(self, outline, folders, in_folder=''):
+        return folders
+    
+    def parse_outline(self, outline, in_folder='', entries=None):
+        """
+        Flattens the outline into folder and feed entries, in order, each with the
+        folder it's in. Feed addresses are normalized and overlong ones dropped.
+        """
+        if entries is None:
+            entries = []
+        max_address = Feed._meta.get_field('feed_address').max_length
+        max_link = Feed._meta.get_field('feed_link').max_length
         for item in outline:
             if (not hasattr(item, 'xmlUrl') and 
                 (hasattr(item, 'text') or hasattr(item, 'title'))):
-                folder = item
                 title = getattr(item, 'text', None) or getattr(item, 'title', None)
-                # if hasattr(folder, 'text'):
-                #     logging.info(' ---> [%s] ~FRNew Folder: %s' % (self.user, folder.text))
-                obj = {title: []}
-                folders = add_object_to_folder(obj, in_folder, folders)
-                folders = self.process_outline(folder, folders, title)
+                entries.append({'folder': title, 'in_folder': in_folder})
+                self.parse_outline(item, title, entries)
             elif hasattr(item, 'xmlUrl'):
-                feed = item
-                if not hasattr(feed, 'htmlUrl'):
-                    setattr(feed, 'htmlUrl', None)
+                html_url = getattr(item, 'htmlUrl', None)
                 # If feed title matches what's in the DB, don't override it on subscription.
-                feed_title = getattr(feed, 'title', None) or getattr(feed, 'text', None)
-                if not feed_title:
-                    setattr(feed, 'title', feed.htmlUrl or feed.xmlUrl)
-                    user_feed_title = None
-                else:
-                    setattr(feed, 'title', feed_title)
-                    user_feed_title = feed.title
-
-                feed_address = urlnorm.normalize(feed.xmlUrl)
-                feed_link = urlnorm.normalize(feed.htmlUrl)
-                if len(feed_address) > Feed._meta.get_field('feed_address').max_length:
+                feed_title = getattr(item, 'title', None) or getattr(item, 'text', None)
+                feed_address = urlnorm.normalize(item.xmlUrl)
+                feed_link = urlnorm.normalize(html_url)
+                if not feed_address or len(feed_address) > max_address:
                     continue
-                if feed_link and len(feed_link) > Feed._meta.get_field('feed_link').max_length:
+                if feed_link and len(feed_link) > max_link:
                     continue
-                # logging.info(' ---> \t~FR%s - %s - %s' % (feed.title, feed_link, feed_address,))
-                feed_data = dict(feed_address=feed_address, feed_link=feed_link, feed_title=feed.title)
-                # feeds.append(feed_data)
-
-                # See if it exists as a duplicate first
-                duplicate_feed = DuplicateFeed.objects.filter(duplicate_address=feed_address)
-                if duplicate_feed:
-                    feed_db = duplicate_feed[0].feed
-                else:
-                    feed_data['active_subscribers'] = 1
-                    feed_data['num_subscribers'] = 1
-                    feed_db, _ = Feed.find_or_create(feed_address=feed_address, 
-                                                     feed_link=feed_link,
-                                                     defaults=dict(**feed_data))
-
-                if user_feed_title == feed_db.feed_title:
-                    user_feed_title = None
-                
-                us, _ = UserSubscription.objects.get_or_create(
-                    feed=feed_db, 
-                    user=self.user,
-                    defaults={
-                        'needs_unread_recalc': True,
-                        'mark_read_date': datetime.datetime.utcnow() - datetime.timedelta(days=1),
-                        'active': self.user.profile.is_premium,
-                        'user_title': user_feed_title
-                    }
-                )
-                if self.user.profile.is_premium and not us.active:
-                    us.active = True
-                    us.save()
-                if not us.needs_unread_recalc:
-                    us.needs_unread_recalc = True
-                    us.save()
-
-                folders = add_object_to_folder(feed_db.pk, in_folder, folders)
-
+                entries.append({
+                    'feed_address': feed_address,
+                    'feed_link': feed_link,
+                    'feed_title': feed_title or html_url or item.xmlUrl,
+                    'user_title': feed_title,
+                    'in_folder': in_folder,
+                })
+        
+        return entries
+    
+    def chunks(self, items):
+        items = list(items)
+        for i in xrange(0, len(items), self.CHUNK_SIZE):
+            yield items[i:i+self.CHUNK_SIZE]
+    
+    def resolve_feeds(self, feed_entries):
+        """
+        Maps each feed address to a Feed: first through DuplicateFeed, then by
+        address and link like `Feed.find_or_create`, then by creating the rest in
+        bulk. Returns (address -> feed, ids of the created feeds).
+        """
+        feeds = {}
+        feed_ids = {}
+        for addresses in self.chunks(e['feed_address'] for e in feed_entries):
+            dupes = DuplicateFeed.objects.filter(duplicate_address__in=addresses)
+            feed_ids.update(dupes.values_list('duplicate_address', 'feed_id'))
+        if feed_ids:
+            feeds_by_id = dict((feed.pk, feed) for ids in self.chunks(set(feed_ids.values()))
+                               for feed in Feed.objects.filter(pk__in=ids))
+            feeds.update((address, feeds_by_id[feed_id]) for address, feed_id in feed_ids.items()
+                         if feed_id in feeds_by_id)
+        
+        missing = [e for e in feed_entries if e['feed_address'] not in feeds]
+        existing = {}
+        for addresses in self.chunks(e['feed_address'] for e in missing):
+            for feed in Feed.objects.filter(feed_address__in=addresses):
+                existing[(feed.feed_address, feed.feed_link)] = feed
+        to_create = []
+        for entry in missing:
+            address, link = entry['feed_address'], entry['feed_link']
+            feed = existing.get((address, link))
+            if not feed and link and link.endswith('/'):
+                feed = existing.get((address, link[:-1]))
+            if feed:
+                feeds[address] = feed
+            else:
+                to_create.append(entry)
+        
+        new_feed_ids = []
+        if to_create:
+            created, new_feed_ids = self.create_feeds(to_create)
+            feeds.update(created)
+        
+        return feeds, new_feed_ids
+    
+    def create_feeds(self, entries):
+        """
+        Bulk creates feeds, doing what `Feed.save` would to each. Returns
+        (address -> feed, ids of the feeds that were actually created).
+        """
+        now = datetime.datetime.utcnow()
+        max_title = Feed._meta.get_field('feed_title').max_length
+        new_feeds = {}
+        for entry in entries:
+            feed = Feed(feed_address=entry['feed_address'], feed_link=entry['feed_link'],
+                        feed_title=(entry['feed_title'] or '')[:max_title],
+                        active_subscribers=1, num_subscribers=1,
+                        last_update=now, next_scheduled_update=now)
+            feed.fix_google_alerts_urls()
+            feed.hash_address_and_link = hashlib.sha1((feed.feed_address or "") + 
+                                                      (feed.feed_link or "")).hexdigest()
+            new_feeds.setdefault(feed.hash_address_and_link, (entry['feed_address'], feed))
+        
+        created = {}
+        try:
+            for batch in self.chunks(new_feed for _, new_feed in new_feeds.values()):
+                Feed.objects.bulk_create(batch)
+        except IntegrityError:
+            # Somebody else created one of these feeds mid-import, so fall back to
+            # creating them one at a time. find_or_create may hand back a variant
+            # with a different link, so keep the feeds it returns.
+            new_feed_ids = []
+            for address, new_feed in new_feeds.values():
+                feed, was_created = Feed.find_or_create(feed_address=new_feed.feed_address,
+                                                        feed_link=new_feed.feed_link,
+                                                        defaults=dict(feed_title=new_feed.feed_title,
+                                                                      active_subscribers=1,
+                                                                      num_subscribers=1))
+                created[address] = feed
+                if was_created:
+                    new_feed_ids.append(feed.pk)
+            return created, new_feed_ids
+        
+        for hashes in self.chunks(new_feeds.keys()):
+            for feed in Feed.objects.filter(hash_address_and_link__in=hashes):
+                created[new_feeds[feed.hash_address_and_link][0]] = feed
+        return created, [feed.pk for feed in created.values()]
+    
+    def subscribe(self, feeds, feed_entries):
+        """
+        Subscribes the user to every feed, bulk creating the new subscriptions and
+        flagging existing ones for an unread recalc. Returns how many were created.
+        """
+        is_premium = self.user.profile.is_premium
+        feed_ids = set(feed.pk for feed in feeds.values())
+        subscribed = set()
+        for ids in self.chunks(feed_ids):
+            subs = UserSubscription.objects.filter(user=self.user, feed__in=ids)
+            subscribed.update(subs.values_list('feed_id', flat=True))
+            subs.update(needs_unread_recalc=True)
+            if is_premium:
+                subs.filter(active=False).update(active=True)
+        
+        max_user_title = UserSubscription._meta.get_field('user_title').max_length
+        mark_read_date = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        new_subs = []
+        for address, feed in feeds.items():
+            if feed.pk in subscribed: continue
+            subscribed.add(feed.pk)
+            user_title = feed_entries[address]['user_title']
+            if user_title == feed.feed_title:
+                user_title = None
+            new_subs.append(UserSubscription(user=self.user, feed=feed,
+                                             needs_unread_recalc=True,
+                                             mark_read_date=mark_read_date,
+                                             active=is_premium,
+                                             user_title=user_title and user_title[:max_user_title]))
+        created_subs = 0
+        for subs in self.chunks(new_subs):
+            try:
+                UserSubscription.objects.bulk_create(subs)
+                created_subs += len(subs)
+            except IntegrityError:
+                # A concurrent import (like the ProcessOPML fallback) got to some
+                # of these first, so create the rest one at a time.
+                for sub in subs:
+                    _, was_created = UserSubscription.objects.get_or_create(
+                        user=self.user, feed=sub.feed,
+                        defaults=dict(needs_unread_recalc=True,
+                                      mark_read_date=sub.mark_read_date,
+                                      active=sub.active,
+                                      user_title=sub.user_title))
+                    created_subs += int(was_created)
+        
+        # Bulk creates skip the post_save signal that keeps subscriber counts.
+        if new_subs:
+            RFeedSubscriberCounts.recount([sub.feed_id for sub in new_subs])
+        
+        return created_subs
+    
+    def add_to_folders(self, entries, feeds, folders):
+        """
+        Adds the imported folders and feeds to the user's folders in one pass, the
+        same way `add_object_to_folder` would one at a time: a folder is found by
+        its title, and nothing is added to a folder twice.
+        """
+        folder_lists = {}
+        def index(items):
+            for item in items:
+                if isinstance(item, dict):
+                    for title, children in item.items():
+                        folder_lists.setdefault(title, children)
+                        index(children)
+        index(folders)
+        
+        for entry in entries:
+            parent = folders if not entry['in_folder'] else folder_lists.get(entry['in_folder'])
+            if parent is None: continue
+            if 'folder' in entry:
+                title = entry['folder']
+                if not any(isinstance(item, dict) and title in item for item in parent):
+                    children = []
+                    parent.append({title: children})
+                    folder_lists.setdefault(title, children)
+            else:
+                feed = feeds.get(entry['feed_address'])
+                if feed and feed.pk not in parent:
+                    parent.append(feed.pk)
+        
         return folders
     
     def count_feeds_in_opml(self):
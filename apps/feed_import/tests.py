@@ -4,8 +4,10 @@ from django.test import TestCase
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from apps.reader.models import UserSubscription, UserSubscriptionFolders
-from apps.feed_import.models import GoogleReaderImporter
+from apps.feed_import.models import GoogleReaderImporter, OPMLImporter, OPMLExporter
+from apps.rss_feeds.models import Feed
 from utils import json_functions as json
+import vendor.opml as opml
 
 class ImportTest(TestCase):
     fixtures = ['opml_import.json']
@@ -31,6 +33,37 @@ class ImportTest(TestCase):
         subs = UserSubscription.objects.filter(user=user)
         self.assertEquals(subs.count(), 54)
         
+    def test_opml_import__twice(self):
+        user = User.objects.get(username='conesus')
+        f = open(os.path.join(os.path.dirname(__file__), 'fixtures/opml.xml'))
+        xml = f.read()
+        f.close()
+        
+        folders = OPMLImporter(xml, user).process()
+        feed_count = Feed.objects.count()
+        self.assertEquals(UserSubscription.objects.filter(user=user).count(), 54)
+        
+        # Importing again resolves every feed to the ones just created.
+        self.assertEquals(OPMLImporter(xml, user).process(), folders)
+        self.assertEquals(Feed.objects.count(), feed_count)
+        self.assertEquals(UserSubscription.objects.filter(user=user).count(), 54)
+        
+    def test_opml_export(self):
+        user = User.objects.get(username='conesus')
+        f = open(os.path.join(os.path.dirname(__file__), 'fixtures/opml.xml'))
+        OPMLImporter(f.read(), user).process()
+        f.close()
+        
+        exporter = OPMLExporter(user)
+        exporter.CHUNK_SIZE = 10
+        chunks = list(exporter.stream())
+        self.assertTrue(len(chunks) > 2)
+        
+        outline = opml.from_string(''.join(chunks))
+        def feed_count(items):
+            return sum(1 if hasattr(item, 'xmlUrl') else feed_count(item) for item in items)
+        self.assertEquals(feed_count(outline), 54)
+        
     def test_opml_import__empty(self):
         self.client.login(username='conesus', password='test')
         user = User.objects.get(username='conesus')
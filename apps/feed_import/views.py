@@ -7,7 +7,7 @@ from bson.errors import InvalidStringData
 import uuid
 from django.contrib.sites.models import Site
 # from django.db import IntegrityError
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
@@ -72,10 +72,9 @@ def opml_upload(request):
 def opml_export(request):
     user     = get_user(request)
     exporter = OPMLExporter(user)
-    opml     = exporter.process()
     now      = datetime.datetime.now()
     
-    response = HttpResponse(opml, mimetype='text/xml')
+    response = StreamingHttpResponse(exporter.stream(), content_type='text/xml')
     response['Content-Disposition'] = 'attachment; filename=NewsBlur Subscriptions - %s' % (
         now.strftime('%Y-%m-%d')
     )
@@ -6,6 +6,8 @@ from utils import log as logging
 from django.conf import settings
 from django.db import connection
 from django.template import Template, Context
+from apps.rss_feeds.subscriber_counts import RFeedSubscriberCounts
+from apps.rss_feeds.tasks import RecountSubscribers
 
 
 class LastSeenMiddleware(object):
@@ -20,9 +22,12 @@ class LastSeenMiddleware(object):
                     request.user.profile.last_seen_on, request.META['REMOTE_ADDR']))
             # if request.user.profile.last_seen_on < SUBSCRIBER_EXPIRE:
                 # request.user.profile.refresh_stale_feeds()
+            returning = request.user.profile.last_seen_on < RFeedSubscriberCounts.expire_date()
             request.user.profile.last_seen_on = datetime.datetime.utcnow()
             request.user.profile.last_seen_ip = request.META['REMOTE_ADDR']
             request.user.profile.save()
+            if returning:
+                RecountSubscribers.apply_async(kwargs=dict(user_ids=[request.user.pk]))
         
         return response
         
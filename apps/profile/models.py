@@ -18,6 +18,7 @@ from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
 from apps.reader.models import UserSubscription
 from apps.rss_feeds.models import Feed, MStory
+from apps.rss_feeds.subscriber_counts import RFeedSubscriberCounts
 from apps.rss_feeds.tasks import NewFeeds
 from apps.rss_feeds.tasks import SchedulePremiumSetup
 from apps.feed_import.models import GoogleReaderImporter, OPMLExporter
@@ -83,6 +84,7 @@ class Profile(models.Model):
         
         from apps.social.models import MSocialProfile, MSharedStory, MSocialSubscription
         from apps.social.models import MActivity, MInteraction
+        from apps.social.social_graph import RSocialGraph
         try:
             social_profile = MSocialProfile.objects.get(user_id=self.user.pk)
             logging.user(self.user, "Unfollowing %s followings and %s followers" %
@@ -94,6 +96,7 @@ class Profile(models.Model):
                 follower_profile = MSocialProfile.objects.get(user_id=follower)
                 follower_profile.unfollow_user(self.user.pk)
             social_profile.delete()
+            RSocialGraph.delete(self.user.pk)
         except MSocialProfile.DoesNotExist:
             logging.user(self.user, " ***> No social profile found. S'ok, moving on.")
             pass
@@ -148,6 +151,7 @@ class Profile(models.Model):
                 sub.save()
             except (IntegrityError, Feed.DoesNotExist):
                 pass
+        RFeedSubscriberCounts.recount_users([self.user.pk])
         
         try:
             scheduled_feeds = [sub.feed.pk for sub in subs]
@@ -173,9 +177,14 @@ class Profile(models.Model):
             sub.active = False
             try:
                 sub.save()
-                sub.feed.setup_feed_for_premium_subscribers()
             except (IntegrityError, Feed.DoesNotExist):
                 pass
+        RFeedSubscriberCounts.recount_users([self.user.pk])
+        for sub in subs:
+            try:
+                sub.feed.setup_feed_for_premium_subscribers()
+            except Feed.DoesNotExist:
+                pass
         
         logging.user(self.user, "~BY~FW~SBBOO! Deactivating premium account: ~FR%s subscriptions~SN!" % (subs.count()))
     
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from apps.reader.models import UserSubscription
+from utils.benchmark_functions import RoundTripCounter
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-u", "--username", dest="username"),
+        make_option("-s", "--sizes", dest="sizes", default="10,50,100,200,500,1000",
+                    help="Comma-separated subscription counts to benchmark."),
+        make_option("-r", "--read_filter", dest="read_filter", default="unread"),
+    )
+
+    def handle(self, *args, **options):
+        user = User.objects.get(username=options['username'])
+        usersubs = list(UserSubscription.objects.filter(user=user, active=True))
+        sizes = [int(s) for s in options['sizes'].split(',') if int(s) <= len(usersubs)]
+        read_filter = options['read_filter']
+
+        print " ---> %s has %s active subscriptions" % (user.username, len(usersubs))
+        print "%8s  %22s  %22s" % ("subs", "per-feed (redis/sql/s)", "batched (redis/sql/s)")
+        for size in sizes:
+            subs = usersubs[:size]
+            feed_ids = [sub.feed_id for sub in subs]
+
+            with RoundTripCounter() as legacy:
+                for feed_id in feed_ids:
+                    try:
+                        us = UserSubscription.objects.get(user=user.pk, feed=feed_id)
+                    except UserSubscription.DoesNotExist:
+                        continue
+                    us.get_stories(offset=0, limit=200, read_filter=read_filter, withscores=True)
+                    us.get_stories(read_filter='unread', limit=200, hashes_only=True)
+
+            with RoundTripCounter() as batched:
+                UserSubscription.feed_stories(user.pk, feed_ids, offset=0, limit=11,
+                                              read_filter=read_filter)
+
+            print "%8s  %22s  %22s" % (
+                size,
+                "%s/%s/%.3f" % (legacy.redis, legacy.sql, legacy.elapsed),
+                "%s/%s/%.3f" % (batched.redis, batched.sql, batched.elapsed),
+            )
@@ -3,17 +3,21 @@ import time
 import redis
 import hashlib
 import re
+from collections import defaultdict
 from utils import log as logging
 from utils import json_functions as json
-from django.db import models, IntegrityError
+from django.db import models, IntegrityError, connection, transaction
+from django.db.models.signals import post_save, post_delete
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from mongoengine.queryset import OperationError
 from apps.reader.managers import UserSubscriptionManager
 from apps.rss_feeds.models import Feed, MStory, DuplicateFeed
+from apps.rss_feeds.story_cache import RStoryCache
+from apps.rss_feeds.subscriber_counts import subscription_created, subscription_deleted
 from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTag, MClassifierTitle
-from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds, apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import ClassifierScorer
 from utils.feed_functions import add_object_to_folder
 
 class UserSubscription(models.Model):
@@ -148,9 +152,7 @@ class UserSubscription(models.Model):
         if withscores or hashes_only:
             return story_ids
         elif story_ids:
-            story_date_order = "%sstory_date" % ('' if order == 'oldest' else '-')
-            mstories = MStory.objects(story_hash__in=story_ids).order_by(story_date_order)
-            stories = Feed.format_stories(mstories)
+            stories = RStoryCache.format_stories(story_ids, order=order)
             return stories
         else:
             return []
@@ -174,28 +176,99 @@ class UserSubscription(models.Model):
             story_hashes = range_func(ranked_stories_keys, offset, limit)
             return story_hashes, unread_story_hashes
         else:
-            r.delete(ranked_stories_keys)
             cache.delete(unread_ranked_stories_keys)
-        
-        unread_feed_story_hashes = {}
-        for feed_id in feed_ids:
-            try:
-                us = cls.objects.get(user=user_id, feed=feed_id)
-            except cls.DoesNotExist:
-                continue
-            story_hashes = us.get_stories(offset=0, limit=200, 
-                                          order=order, read_filter=read_filter, 
-                                          withscores=True)
-            unread_feed_story_hashes[feed_id] = us.get_stories(read_filter='unread', limit=200,
-                                                               hashes_only=True)
-            if story_hashes:
-                r.zadd(ranked_stories_keys, **dict(story_hashes))
-            
-        story_hashes = range_func(ranked_stories_keys, offset, limit)
-        r.expire(ranked_stories_keys, 60*60)
+
+        usersubs = cls.objects.filter(user=user_id, feed__in=feed_ids).only('feed', 'mark_read_date')
+        feed_story_hashes, unread_feed_story_hashes = cls.batch_feed_stories(user_id, usersubs,
+                                                                             order=order,
+                                                                             read_filter=read_filter,
+                                                                             r=r)
+
+        p = r.pipeline()
+        p.delete(ranked_stories_keys)
+        ranked_story_hashes = {}
+        for story_hashes in feed_story_hashes.values():
+            ranked_story_hashes.update(story_hashes)
+        if ranked_story_hashes:
+            p.zadd(ranked_stories_keys, **ranked_story_hashes)
+        if order == 'oldest':
+            p.zrange(ranked_stories_keys, offset, limit)
+        else:
+            p.zrevrange(ranked_stories_keys, offset, limit)
+        p.expire(ranked_stories_keys, 60*60)
+        story_hashes = p.execute()[-2]
         cache.set(unread_ranked_stories_keys, unread_feed_story_hashes, 24*60*60)
-        
+
         return story_hashes, unread_feed_story_hashes
+
+    @classmethod
+    def batch_feed_stories(cls, user_id, usersubs, order='newest', read_filter='all', limit=200, r=None):
+        """
+        Computes the ranked and unread story hashes for many subscriptions at once.
+
+        Does the same work as calling `get_stories` twice per subscription (once with
+        scores for ranking, once for unread hashes), but queues every feed's
+        SDIFFSTORE/ZINTERSTORE/ZRANGEBYSCORE into a single pipeline, so the number of
+        round trips no longer grows with the number of subscriptions.
+
+        Returns ({feed_id: [(story_hash, score), ...]}, {feed_id: [story_hash, ...]}).
+        """
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline()
+
+        current_time  = int(time.time() + 60*60*24)
+        two_weeks_ago = datetime.datetime.now() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
+        all_min_score = int(time.mktime(two_weeks_ago.timetuple()))-1000
+
+        feed_ids = []
+        for us in usersubs:
+            feed_ids.append(us.feed_id)
+            stories_key                = 'F:%s' % (us.feed_id)
+            sorted_stories_key         = 'zF:%s' % (us.feed_id)
+            read_stories_key           = 'RS:%s:%s' % (user_id, us.feed_id)
+            unread_stories_key         = 'U:%s:%s' % (user_id, us.feed_id)
+            unread_ranked_stories_key  = 'zhU:%s:%s' % (user_id, us.feed_id)
+            # +1 for the intersection b/w zF and F, which carries an implicit score of 1.
+            mark_read_score = int(time.mktime(us.mark_read_date.timetuple())) + 1
+
+            # A missing RS key diffs to the whole feed, same as get_stories' fallback.
+            p.sdiffstore(unread_stories_key, stories_key, read_stories_key)
+            p.zinterstore(unread_ranked_stories_key, [sorted_stories_key, unread_stories_key])
+
+            if read_filter == 'unread':
+                ranked_key = unread_ranked_stories_key
+                min_score  = mark_read_score
+            elif order == 'oldest':
+                ranked_key = sorted_stories_key
+                min_score  = all_min_score
+            else:
+                # Same as get_stories: newest-first 'all' isn't bounded by the unread cutoff.
+                ranked_key = sorted_stories_key
+                min_score  = 0
+            if order == 'oldest':
+                p.zrangebyscore(ranked_key, min_score, current_time,
+                                start=0, num=limit, withscores=True)
+            else:
+                p.zrevrangebyscore(ranked_key, current_time, min_score,
+                                   start=0, num=limit, withscores=True)
+
+            p.zrevrangebyscore(unread_ranked_stories_key, current_time, mark_read_score,
+                               start=0, num=limit)
+            p.delete(unread_stories_key, unread_ranked_stories_key)
+
+        results = p.execute() if feed_ids else []
+
+        feed_story_hashes = {}
+        unread_feed_story_hashes = {}
+        for i, feed_id in enumerate(feed_ids):
+            # Five commands per feed: sdiffstore, zinterstore, ranked, unread, delete.
+            story_hashes, unread_story_hashes = results[i*5+2], results[i*5+3]
+            if story_hashes:
+                feed_story_hashes[feed_id] = story_hashes
+            unread_feed_story_hashes[feed_id] = unread_story_hashes
+
+        return feed_story_hashes, unread_feed_story_hashes
         
     @classmethod
     def add_subscription(cls, user, feed_address, folder=None, bookmarklet=False, auto_active=True,
@@ -265,12 +338,15 @@ class UserSubscription(models.Model):
         
         
         UNREAD_CUTOFF = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
-
+        
+        user_subs = list(user_subs)
+        stale_subs = set(cls.load_unread_counts(user.pk, user_subs))
         for i, sub in enumerate(user_subs):
-            # Count unreads if subscription is stale.
-            if (sub.needs_unread_recalc or 
-                sub.unread_count_updated < UNREAD_CUTOFF or 
-                sub.oldest_unread_story_date < UNREAD_CUTOFF):
+            # Count unreads if subscription has no live counters and is stale.
+            if (sub in stale_subs and
+                (sub.needs_unread_recalc or 
+                 sub.unread_count_updated < UNREAD_CUTOFF or 
+                 sub.oldest_unread_story_date < UNREAD_CUTOFF)):
                 sub = sub.calculate_feed_scores(silent=True)
             if not sub: continue # TODO: Figure out the correct sub and give it a new feed_id
 
@@ -295,6 +371,7 @@ class UserSubscription(models.Model):
         return feeds
         
     def mark_feed_read(self):
+        UserSubscription.load_unread_counts(self.user_id, [self])
         if (self.unread_count_negative == 0
             and self.unread_count_neutral == 0
             and self.unread_count_positive == 0
@@ -321,6 +398,7 @@ class UserSubscription(models.Model):
         self.needs_unread_recalc = False
         
         self.save()
+        RUserUnreadCount.mark_feed_read(self.user_id, self.feed_id)
         
         return True
         
@@ -330,7 +408,8 @@ class UserSubscription(models.Model):
         if not request:
             request = self.user
     
-        if not self.needs_unread_recalc:
+        # Without live counters, the stored counts can only be fixed by a recalc.
+        if not self.needs_unread_recalc and not RUserUnreadCount.live_subscriptions([self]):
             self.needs_unread_recalc = True
             self.save()
     
@@ -339,8 +418,8 @@ class UserSubscription(models.Model):
         else:
             logging.user(request, "~FYRead story in feed: %s" % (self.feed))
         
-        for story_hash in set(story_hashes):
-            RUserStory.mark_read(self.user_id, self.feed_id, story_hash)
+        RUserStory.mark_stories_read(self.user_id, [(self.feed_id, story_hash) 
+                                                    for story_hash in story_hashes])
             
         return data
     
@@ -376,8 +455,7 @@ class UserSubscription(models.Model):
         unread_story_hashes = self.get_stories(read_filter='unread', limit=500, hashes_only=True)
         
         if not stories:
-            stories_db = MStory.objects(story_hash__in=unread_story_hashes)
-            stories = Feed.format_stories(stories_db, self.feed_id)
+            stories = RStoryCache.format_stories(unread_story_hashes, feed_id=self.feed_id)
         
         oldest_unread_story_date = now
         unread_stories = []
@@ -400,34 +478,24 @@ class UserSubscription(models.Model):
         # if not silent:
         #     logging.info(' ---> [%s]    Classifiers: %s (%s)' % (self.user, datetime.datetime.now() - now, classifier_feeds.count() + classifier_authors.count() + classifier_tags.count() + classifier_titles.count()))
             
-        scores = {
-            'feed': apply_classifier_feeds(classifier_feeds, self.feed),
-        }
-        
-        for story in unread_stories:
-            scores.update({
-                'author' : apply_classifier_authors(classifier_authors, story),
-                'tags'   : apply_classifier_tags(classifier_tags, story),
-                'title'  : apply_classifier_titles(classifier_titles, story),
-            })
-            
-            max_score = max(scores['author'], scores['tags'], scores['title'])
-            min_score = min(scores['author'], scores['tags'], scores['title'])
-            if max_score > 0:
-                feed_scores['positive'] += 1
-            elif min_score < 0:
-                feed_scores['negative'] += 1
-            else:
-                if scores['feed'] > 0:
-                    feed_scores['positive'] += 1
-                elif scores['feed'] < 0:
-                    feed_scores['negative'] += 1
-                else:
-                    feed_scores['neutral'] += 1
-                
+        scorer = ClassifierScorer(classifier_feeds=classifier_feeds,
+                                  classifier_authors=classifier_authors,
+                                  classifier_titles=classifier_titles,
+                                  classifier_tags=classifier_tags)
+        
+        unread_counts = []
+        for story, scores in zip(unread_stories, scorer.score_stories(unread_stories, feed_id=self.feed_id)):
+            category = ClassifierScorer.category(scores)
+            feed_scores[category] += 1
+            unread_counts.append((story['story_hash'], story['story_date'], category))
         
         # if not silent:
         #     logging.info(' ---> [%s]    End classifiers: %s' % (self.user, datetime.datetime.now() - now))
+        
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline()
+        RUserUnreadCount.reset(self.user_id, self.feed_id, unread_counts, r=p)
+        p.execute()
 
         self.unread_count_positive = feed_scores['positive']
         self.unread_count_neutral = feed_scores['neutral']
@@ -446,7 +514,228 @@ class UserSubscription(models.Model):
             logging.user(self.user, '~FC~SNComputing scores: %s (~SB%s~SN/~SB%s~SN/~SB%s~SN)' % (self.feed, feed_scores['negative'], feed_scores['neutral'], feed_scores['positive']))
             
         return self
-    
+
+    @classmethod
+    def bulk_calculate_feed_scores(cls, feed_id, usersubs, stories=None):
+        """
+        Recomputes unread counts for many subscribers of one feed at once. Same
+        results as `calculate_feed_scores` on each subscription, but classifiers are
+        loaded with one query per collection, every subscriber's unread set comes
+        back from a single Redis pipeline, rows with identical counts are written
+        together with one UPDATE, and every row's oldest unread date goes out in
+        one more.
+        """
+        now = datetime.datetime.now()
+        UNREAD_CUTOFF = now - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
+        usersubs = list(usersubs)
+        if not usersubs:
+            return 0
+
+        cls.objects.filter(pk__in=[us.pk for us in usersubs],
+                           needs_unread_recalc=False).update(needs_unread_recalc=True)
+
+        if not stories:
+            stories = cache.get('S:%s' % feed_id)
+        if not stories:
+            stories_db = MStory.objects(story_feed_id=feed_id, story_date__gte=UNREAD_CUTOFF)
+            stories = Feed.format_stories(stories_db, feed_id)
+
+        classifiers = cls.classifiers_by_user(feed_id, [us.user_id for us in usersubs])
+
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline()
+        current_time = int(time.time() + 60*60*24)
+        stories_key = 'F:%s' % feed_id
+        sorted_stories_key = 'zF:%s' % feed_id
+        for us in usersubs:
+            # Two weeks in age. If mark_read_date is older, mark old stories as read.
+            us.mark_read_date = max(UNREAD_CUTOFF, us.mark_read_date)
+            read_stories_key = 'RS:%s:%s' % (us.user_id, feed_id)
+            unread_stories_key = 'U:%s:%s' % (us.user_id, feed_id)
+            unread_ranked_stories_key = 'zhU:%s:%s' % (us.user_id, feed_id)
+            p.sdiffstore(unread_stories_key, stories_key, read_stories_key)
+            p.zinterstore(unread_ranked_stories_key, [sorted_stories_key, unread_stories_key])
+            p.zrevrangebyscore(unread_ranked_stories_key, current_time,
+                               int(time.mktime(us.mark_read_date.timetuple())) + 1,
+                               start=0, num=500)
+            p.delete(unread_stories_key, unread_ranked_stories_key)
+        results = p.execute()
+
+        updates = defaultdict(list)
+        oldest_unread_dates = {}
+        mark_read_ids = []
+        p = r.pipeline()
+        for i, us in enumerate(usersubs):
+            unread_story_hashes = set(results[i*4+2])
+            feed_scores = dict(negative=0, neutral=0, positive=0)
+            oldest_unread_story_date = now
+            unread_stories = []
+            for story in stories:
+                if story['story_date'] < us.mark_read_date:
+                    continue
+                if story['story_hash'] in unread_story_hashes:
+                    unread_stories.append(story)
+                    if story['story_date'] < oldest_unread_story_date:
+                        oldest_unread_story_date = story['story_date']
+
+            scorer = ClassifierScorer(**classifiers[us.user_id])
+            unread_counts = []
+            for story, scores in zip(unread_stories, scorer.score_stories(unread_stories, feed_id=feed_id)):
+                category = ClassifierScorer.category(scores)
+                feed_scores[category] += 1
+                unread_counts.append((story['story_hash'], story['story_date'], category))
+
+            if (feed_scores['positive'] == 0 and feed_scores['neutral'] == 0 and
+                feed_scores['negative'] > 0):
+                mark_read_ids.append(us.pk)
+                RUserUnreadCount.reset(us.user_id, feed_id, [], r=p)
+                continue
+            RUserUnreadCount.reset(us.user_id, feed_id, unread_counts, r=p)
+            mark_read_date = us.mark_read_date if us.mark_read_date == UNREAD_CUTOFF else None
+            updates[(feed_scores['positive'], feed_scores['neutral'], feed_scores['negative'],
+                     mark_read_date)].append(us.pk)
+            oldest_unread_dates[us.pk] = oldest_unread_story_date
+
+        p.execute()
+
+        for (positive, neutral, negative, mark_read_date), sub_ids in updates.items():
+            fields = dict(unread_count_positive=positive,
+                          unread_count_neutral=neutral,
+                          unread_count_negative=negative,
+                          unread_count_updated=now,
+                          needs_unread_recalc=False)
+            if mark_read_date:
+                fields['mark_read_date'] = mark_read_date
+            cls.objects.filter(pk__in=sub_ids).update(**fields)
+        cls.bulk_update_oldest_unread_dates(oldest_unread_dates)
+
+        if mark_read_ids:
+            # Same as `mark_feed_read`, applied to every all-negative subscription at once.
+            latest_story = MStory.objects(story_feed_id=feed_id).order_by('-story_date').only('story_date').limit(1)
+            if latest_story and len(latest_story) >= 1:
+                latest_story_date = latest_story[0]['story_date'] + datetime.timedelta(seconds=1)
+            else:
+                latest_story_date = now
+            cls.objects.filter(pk__in=mark_read_ids).update(last_read_date=latest_story_date,
+                                                            mark_read_date=latest_story_date,
+                                                            unread_count_negative=0,
+                                                            unread_count_positive=0,
+                                                            unread_count_neutral=0,
+                                                            unread_count_updated=now,
+                                                            oldest_unread_story_date=now,
+                                                            needs_unread_recalc=False)
+
+        logging.debug("   ---> [%-30s] ~FCComputed scores for ~SB%s subscribers~SN in %s updates" % (
+                      feed_id, len(usersubs), len(updates) + bool(oldest_unread_dates) + bool(mark_read_ids)))
+
+        return len(usersubs)
+
+    @classmethod
+    def bulk_update_oldest_unread_dates(cls, dates, batch_size=500):
+        """
+        Sets each subscription's own oldest_unread_story_date, given as {pk: date},
+        with one UPDATE ... CASE per batch instead of one UPDATE per row.
+        """
+        qn = connection.ops.quote_name
+        pk_column = qn(cls._meta.pk.column)
+        sub_ids = dates.keys()
+        cursor = connection.cursor()
+        for i in range(0, len(sub_ids), batch_size):
+            batch = sub_ids[i:i+batch_size]
+            params = []
+            for sub_id in batch:
+                params.extend([sub_id, dates[sub_id]])
+            params.extend(batch)
+            cursor.execute("UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+                qn(cls._meta.db_table),
+                qn(cls._meta.get_field('oldest_unread_story_date').column),
+                pk_column,
+                ' '.join(['WHEN %s THEN %s'] * len(batch)),
+                pk_column,
+                ', '.join(['%s'] * len(batch)),
+            ), params)
+        transaction.commit_unless_managed()
+
+    @classmethod
+    def reconcile_unread_counts(cls, limit=5000):
+        """
+        Recounts the stalest subscriptions of recently seen users from scratch, which
+        reseeds their live counters and corrects any drift in them.
+        """
+        day_ago = datetime.datetime.now() - datetime.timedelta(days=1)
+        usersubs = cls.objects.filter(active=True,
+                                      user__profile__last_seen_on__gte=day_ago,
+                                      unread_count_updated__lt=day_ago)\
+                              .order_by('unread_count_updated')[:limit]
+        feed_usersubs = defaultdict(list)
+        for us in usersubs:
+            feed_usersubs[us.feed_id].append(us)
+        for feed_id, feed_subs in feed_usersubs.items():
+            cls.bulk_calculate_feed_scores(feed_id, feed_subs)
+        
+        logging.debug(" ---> ~FCReconciled unread counts for ~SB%s subscriptions~SN in ~SB%s feeds" % (
+                      sum(len(subs) for subs in feed_usersubs.values()), len(feed_usersubs)))
+        
+        return feed_usersubs
+
+    @classmethod
+    def classifiers_by_user(cls, feed_id, user_ids):
+        """ Every listed user's classifiers for a feed, one query per classifier type. """
+        params = dict(user_id__in=user_ids, feed_id=feed_id)
+        classifiers = defaultdict(lambda: defaultdict(list))
+        for classifier_type, classifier_query in [
+            ('classifier_feeds', MClassifierFeed.objects(social_user_id=0, **params)),
+            ('classifier_authors', MClassifierAuthor.objects(**params)),
+            ('classifier_titles', MClassifierTitle.objects(**params)),
+            ('classifier_tags', MClassifierTag.objects(**params))]:
+            for classifier in classifier_query:
+                classifiers[classifier.user_id][classifier_type].append(classifier)
+        return classifiers
+
+    @classmethod
+    def bulk_add_unread_stories(cls, feed_id, usersubs, new_stories):
+        """
+        Adds a fetch's new stories to the live unread counters of subscribers that
+        have them, scoring only the new stories instead of recounting the feed.
+        """
+        usersubs = list(usersubs)
+        if not usersubs or not new_stories:
+            return 0
+
+        classifiers = cls.classifiers_by_user(feed_id, [us.user_id for us in usersubs])
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline()
+        for us in usersubs:
+            scorer = ClassifierScorer(**classifiers[us.user_id])
+            unread_counts = [(story['story_hash'], story['story_date'], ClassifierScorer.category(scores))
+                             for story, scores in zip(new_stories,
+                                                      scorer.score_stories(new_stories, feed_id=feed_id))]
+            RUserUnreadCount.add_stories(us.user_id, feed_id, unread_counts, r=p)
+        p.execute()
+
+        logging.debug("   ---> [%-30s] ~FCCounted ~SB%s new stories~SN for ~SB%s subscribers~SN" % (
+                      feed_id, len(new_stories), len(usersubs)))
+
+        return len(usersubs)
+
+    @classmethod
+    def load_unread_counts(cls, user_id, usersubs):
+        """
+        Fills in unread counts on `usersubs` from their live counters, in memory only.
+        Returns the subscriptions that have no live counters and still need
+        `calculate_feed_scores`.
+        """
+        counts = RUserUnreadCount.counts(user_id, [us for us in usersubs if not us.needs_unread_recalc])
+        stale_subs = []
+        for us in usersubs:
+            if us.feed_id not in counts:
+                stale_subs.append(us)
+                continue
+            us.unread_count_positive = counts[us.feed_id]['ps']
+            us.unread_count_neutral = counts[us.feed_id]['nt']
+            us.unread_count_negative = counts[us.feed_id]['ng']
+        return stale_subs
+
     def switch_feed(self, new_feed, old_feed):
         # Rewrite feed in subscription folders
         try:
@@ -587,6 +876,18 @@ class RUserStory:
         read_story_key = 'RS:%s:%s' % (user_id, story_feed_id)
         r.sadd(read_story_key, story_hash)
         r.expire(read_story_key, settings.DAYS_OF_UNREAD*24*60*60)
+        
+        RUserUnreadCount.mark_read(user_id, story_feed_id, story_hash, r=r)
+    
+    @classmethod
+    def mark_stories_read(cls, user_id, stories, r=None):
+        """ Marks many (feed_id, story_hash) pairs read in one pipeline. """
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline()
+        for story_feed_id, story_hash in set(stories):
+            cls.mark_read(user_id, story_feed_id, story_hash, r=p)
+        p.execute()
     
     @staticmethod
     def mark_unread(user_id, story_feed_id, story_hash):
@@ -594,6 +895,8 @@ class RUserStory:
         
         r.srem('RS:%s' % user_id, story_hash)
         r.srem('RS:%s:%s' % (user_id, story_feed_id), story_hash)
+        
+        RUserUnreadCount.mark_unread(user_id, story_feed_id, story_hash, r=r)
     
     @staticmethod
     def get_stories(user_id, feed_id, r=None):
@@ -636,6 +939,109 @@ class RUserStory:
         p.execute()
 
 
+class RUserUnreadCount:
+    """
+    Unread counts kept current on every write instead of recounted on every read.
+    Each subscription keeps its unread story hashes in one sorted set per classifier
+    outcome, scored by story date like zF:
+
+        zUC:<user_id>:<feed_id>:ps / :nt / :ng
+    
+    A count is a ZCOUNT from the later of mark_read_date and the unread cutoff, so
+    stories age out without any bookkeeping. A feed's counters are only trusted
+    once `calculate_feed_scores` has seeded them, which adds the feed to the
+    user's UC:<user_id> set, and only while the subscription isn't marked
+    needs_unread_recalc.
+    """
+    
+    CATEGORIES = [('positive', 'ps'), ('neutral', 'nt'), ('negative', 'ng')]
+    
+    @classmethod
+    def keys(cls, user_id, feed_id):
+        return dict((category, 'zUC:%s:%s:%s' % (user_id, feed_id, abbr))
+                    for category, abbr in cls.CATEGORIES)
+    
+    @classmethod
+    def add_stories(cls, user_id, feed_id, unread_counts, r):
+        """ `unread_counts` is a list of (story_hash, story_date, category). """
+        keys = cls.keys(user_id, feed_id)
+        for story_hash, story_date, category in unread_counts:
+            r.zadd(keys[category], story_hash, time.mktime(story_date.timetuple()))
+        for key in keys.values():
+            r.expire(key, settings.DAYS_OF_UNREAD*24*60*60)
+    
+    @classmethod
+    def reset(cls, user_id, feed_id, unread_counts, r):
+        r.delete(*cls.keys(user_id, feed_id).values())
+        cls.add_stories(user_id, feed_id, unread_counts, r)
+        r.sadd('UC:%s' % user_id, feed_id)
+        r.expire('UC:%s' % user_id, settings.DAYS_OF_UNREAD*24*60*60)
+    
+    @classmethod
+    def mark_read(cls, user_id, feed_id, story_hash, r):
+        for key in cls.keys(user_id, feed_id).values():
+            r.zrem(key, story_hash)
+    
+    @classmethod
+    def mark_unread(cls, user_id, feed_id, story_hash, r):
+        if not r.sismember('UC:%s' % user_id, feed_id):
+            return
+        story = MStory.objects(story_hash=story_hash).first()
+        if not story:
+            return
+        story = Feed.format_story(story, feed_id)
+        scorer = ClassifierScorer.for_user(user_id, feed_id)
+        category = ClassifierScorer.category(scorer.score_story(story, feed_id=feed_id))
+        cls.add_stories(user_id, feed_id, [(story_hash, story['story_date'], category)], r)
+    
+    @classmethod
+    def mark_feed_read(cls, user_id, feed_id, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        r.delete(*cls.keys(user_id, feed_id).values())
+    
+    @classmethod
+    def counts(cls, user_id, usersubs, r=None):
+        """
+        Live unread counts for a user's subscriptions in one round trip, as a dict of
+        feed_id -> {'ps', 'nt', 'ng'}. Subscriptions without live counters are left out.
+        """
+        if not usersubs:
+            return {}
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        UNREAD_CUTOFF = datetime.datetime.now() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
+        
+        p = r.pipeline()
+        p.smembers('UC:%s' % user_id)
+        for us in usersubs:
+            min_score = time.mktime(max(UNREAD_CUTOFF, us.mark_read_date).timetuple())
+            keys = cls.keys(user_id, us.feed_id)
+            for category, _ in cls.CATEGORIES:
+                p.zcount(keys[category], min_score, '+inf')
+        results = p.execute()
+        
+        live_feed_ids = set(int(feed_id) for feed_id in results[0])
+        counts = {}
+        for i, us in enumerate(usersubs):
+            if us.feed_id not in live_feed_ids:
+                continue
+            counts[us.feed_id] = dict((abbr, results[1 + i*3 + c])
+                                      for c, (_, abbr) in enumerate(cls.CATEGORIES))
+        return counts
+    
+    @classmethod
+    def live_subscriptions(cls, usersubs, r=None):
+        """ The subscriptions whose counters can be updated incrementally. """
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        usersubs = [us for us in usersubs if not us.needs_unread_recalc]
+        p = r.pipeline()
+        for us in usersubs:
+            p.sismember('UC:%s' % us.user_id, us.feed_id)
+        return [us for us, live in zip(usersubs, p.execute()) if live]
+
+
 class UserSubscriptionFolders(models.Model):
     """
     A JSON list of folders and feeds for while a user has subscribed. The list
@@ -867,6 +1273,10 @@ class UserSubscriptionFolders(models.Model):
                         us.save()
 
 
+post_save.connect(subscription_created, sender=UserSubscription)
+post_delete.connect(subscription_deleted, sender=UserSubscription)
+
+
 class Feature(models.Model):
     """
     Simple blog-like feature board shown to all users on the home page.
@@ -32,14 +32,30 @@ class FreshenHomepage(Task):
             sub.save()
             sub.calculate_feed_scores(silent=True)
 
+class CalculateFeedScores(Task):
+    name = 'calculate-feed-scores'
+    max_retries = 0
+    ignore_result = True
+
+    def run(self, feed_id, user_sub_ids, **kwargs):
+        usersubs = UserSubscription.objects.filter(pk__in=user_sub_ids)
+        UserSubscription.bulk_calculate_feed_scores(feed_id, usersubs)
+
+class ReconcileUnreadCounts(Task):
+    name = 'reconcile-unread-counts'
+    max_retries = 0
+    ignore_result = True
+
+    def run(self, **kwargs):
+        UserSubscription.reconcile_unread_counts()
+
 class CleanAnalytics(Task):
     name = 'clean-analytics'
 
     def run(self, **kwargs):
+        from apps.statistics.models import MAnalyticsFetcher
+        # Old fetches are expired by mongo with a TTL index, rather than swept here.
         logging.debug(" ---> Cleaning analytics... %s feed fetches" % (
             settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.count(),
         ))
-        day_ago = datetime.datetime.utcnow() - datetime.timedelta(days=1)
-        settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.remove({
-            "date": {"$lt": day_ago},
-        })
+        MAnalyticsFetcher.ensure_ttl_index()
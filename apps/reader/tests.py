@@ -1,3 +1,4 @@
+import time
 from utils import json_functions as json
 from django.test.client import Client
 from django.test import TestCase
@@ -93,4 +94,103 @@ class ReaderTest(TestCase):
         self.assertEquals(len(feed['classifiers']['tags']), 0)
         # self.assert_(connection.queries)
         
-        # settings.DEBUG = False
\ No newline at end of file
+        # settings.DEBUG = False
+    def test_mark_feed_stories_as_read(self):
+        from django.contrib.auth.models import User
+        from apps.reader.models import RUserStory
+        self.client.login(username='conesus', password='test')
+        user = User.objects.get(username='conesus')
+        
+        url = reverse('mark-feed-stories-as-read')
+        feeds_stories = {'1': ['1:a1b2c3', '1:d4e5f6']}
+        response = self.client.post(url, {'feeds_stories': json.encode(feeds_stories)})
+        content = json.decode(response.content)
+        self.assertEquals(content['code'], 0)
+        self.assertEquals(RUserStory.get_stories(user.pk, 1), set(['1:a1b2c3', '1:d4e5f6']))
+        
+        feeds_stories = {'1': ['1:0a0b0c'], '99999': ['99999:a1b2c3']}
+        response = self.client.post(url, {'feeds_stories': json.encode(feeds_stories)})
+        content = json.decode(response.content)
+        self.assertEquals(content['code'], -1)
+        self.assertEquals(RUserStory.get_stories(user.pk, 1), set(['1:a1b2c3', '1:d4e5f6']))
+
+    def test_load_single_feed_keeps_live_counts(self):
+        import redis
+        from django.contrib.auth.models import User
+        from apps.reader.models import UserSubscription
+        self.client.login(username='conesus', password='test')
+        user = User.objects.get(username='conesus')
+        usersub = UserSubscription.objects.get(user=user, feed=1)
+        UserSubscription.objects.filter(pk=usersub.pk).update(needs_unread_recalc=False)
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        r.sadd('UC:%s' % user.pk, 1)
+        
+        try:
+            self.client.get(reverse('load-single-feed', kwargs=dict(feed_id=1)))
+        finally:
+            r.srem('UC:%s' % user.pk, 1)
+        
+        opened = UserSubscription.objects.get(pk=usersub.pk)
+        self.assertEquals(opened.feed_opens, usersub.feed_opens + 1)
+        self.assertFalse(opened.needs_unread_recalc)
+        
+        self.client.get(reverse('load-single-feed', kwargs=dict(feed_id=1)))
+        self.assertTrue(UserSubscription.objects.get(pk=usersub.pk).needs_unread_recalc)
+
+class RatelimitTest(TestCase):
+    
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from django.test.client import RequestFactory
+        from utils.ratelimit import ratelimit
+        self.request = RequestFactory().get('/')
+        self.request.user = User(pk=42, username='ratelimit')
+        self.limiter = ratelimit(name='test_ratelimit', minutes=1, requests=3)
+        self.limiter.redis().delete(self.limiter.current_key(self.request))
+        
+    def tearDown(self):
+        self.limiter.redis().delete(self.limiter.current_key(self.request))
+        
+    def test_allows_up_to_the_limit(self):
+        outcomes = [self.limiter.hit(self.request) for _ in range(4)]
+        self.assertEquals(outcomes, ['allowed', 'allowed', 'allowed', 'limited'])
+        
+        view = self.limiter(lambda request: 'ok')
+        self.assertEquals(view(self.request).status_code, 429)
+        
+    def test_window_expires(self):
+        self.limiter.minutes = 1 / 60.
+        outcomes = [self.limiter.hit(self.request) for _ in range(4)]
+        self.assertEquals(outcomes[-1], 'limited')
+        
+        time.sleep(1.1)
+        self.assertEquals(self.limiter.hit(self.request), 'allowed')
+        
+    def test_overrides(self):
+        from django.test.utils import override_settings
+        policies = {
+            'test_ratelimit': {'requests': 10, 'minutes': 5},
+            'test_ratelimit:42': {'requests': 1},
+        }
+        with override_settings(RATELIMITS=policies):
+            policy = self.limiter.policy(self.request)
+            self.assertEquals(policy['requests'], 1)
+            self.assertEquals(policy['minutes'], 5)
+            self.assertEquals(policy['shadow'], False)
+            
+            outcomes = [self.limiter.hit(self.request) for _ in range(2)]
+            self.assertEquals(outcomes, ['allowed', 'limited'])
+            
+        with override_settings(RATELIMITS={'test_ratelimit': {'requests': 10}}):
+            self.assertEquals(self.limiter.policy(self.request)['requests'], 10)
+            
+        with override_settings(RATELIMITS={}):
+            self.assertEquals(self.limiter.policy(self.request)['requests'], 3)
+        
+    def test_shadow_mode_never_blocks(self):
+        self.limiter.shadow = True
+        outcomes = [self.limiter.hit(self.request) for _ in range(5)]
+        self.assertEquals(outcomes, ['allowed'] * 3 + ['shadowed'] * 2)
+        
+        view = self.limiter(lambda request: 'ok')
+        self.assertEquals(view(self.request), 'ok')
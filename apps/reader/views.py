@@ -22,11 +22,11 @@ from django.contrib.sites.models import Site
 from mongoengine.queryset import OperationError
 from apps.recommendations.models import RecommendedFeed
 from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
-from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds
-from apps.analyzer.models import apply_classifier_authors, apply_classifier_tags
 from apps.analyzer.models import get_classifiers_for_user, sort_classifiers_by_feed
+from apps.analyzer.models import ClassifierScorer
 from apps.profile.models import Profile
 from apps.reader.models import UserSubscription, UserSubscriptionFolders, RUserStory, Feature
+from apps.reader.models import RUserUnreadCount
 from apps.reader.forms import SignupForm, LoginForm, FeatureForm
 from apps.rss_feeds.models import MFeedIcon
 from apps.statistics.models import MStatistics
@@ -40,6 +40,8 @@ from apps.social.models import MSocialSubscription, MActivity, MInteraction
 from apps.categories.models import MCategory
 from apps.social.views import load_social_page
 from apps.rss_feeds.tasks import ScheduleImmediateFetches
+from apps.rss_feeds.story_cache import RStoryCache
+from apps.rss_feeds.subscriber_counts import RFeedSubscriberCounts
 from utils import json_functions as json
 from utils.user_functions import get_user, ajax_login_required
 from utils.feed_functions import relative_timesince
@@ -227,13 +229,14 @@ def load_feeds(request):
         UserSubscriptionFolders.objects.filter(user=user)[1:].delete()
         folders = UserSubscriptionFolders.objects.get(user=user)
     
-    user_subs = UserSubscription.objects.select_related('feed').filter(user=user)
+    user_subs = list(UserSubscription.objects.select_related('feed').filter(user=user))
+    stale_subs = set(UserSubscription.load_unread_counts(user.pk, user_subs))
     
     day_ago = datetime.datetime.now() - datetime.timedelta(days=1)
     scheduled_feeds = []
     for sub in user_subs:
         pk = sub.feed_id
-        if update_counts:
+        if update_counts and sub in stale_subs:
             sub.calculate_feed_scores(silent=True)
         feeds[pk] = sub.canonical(include_favicon=include_favicons)
         
@@ -312,10 +315,11 @@ def load_feeds_flat(request):
     except UserSubscriptionFolders.DoesNotExist:
         folders = []
         
-    user_subs = UserSubscription.objects.select_related('feed').filter(user=user, active=True)
+    user_subs = list(UserSubscription.objects.select_related('feed').filter(user=user, active=True))
+    stale_subs = set(UserSubscription.load_unread_counts(user.pk, user_subs))
 
     for sub in user_subs:
-        if update_counts and sub.needs_unread_recalc:
+        if update_counts and sub in stale_subs:
             sub.calculate_feed_scores(silent=True)
         feeds[sub.feed_id] = sub.canonical(include_favicon=include_favicons)
     
@@ -542,6 +546,10 @@ def load_single_feed(request, feed_id):
                                            classifier_authors=classifier_authors, 
                                            classifier_titles=classifier_titles,
                                            classifier_tags=classifier_tags)
+    scorer = ClassifierScorer(classifier_feeds=classifier_feeds,
+                              classifier_authors=classifier_authors,
+                              classifier_titles=classifier_titles,
+                              classifier_tags=classifier_tags)
     checkpoint3 = time.time()
     
     unread_story_hashes = []
@@ -588,12 +596,7 @@ def load_single_feed(request, feed_id):
                 story['shared_comments'] = strip_tags(shared_stories[story['story_hash']]['comments'])
         else:
             story['read_status'] = 1
-        story['intelligence'] = {
-            'feed': apply_classifier_feeds(classifier_feeds, feed),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags': apply_classifier_tags(classifier_tags, story),
-            'title': apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = scorer.score_story(story, feed_id=feed.pk)
     
     # Intelligence
     feed_tags = json.decode(feed.data.popular_tags) if feed.data.popular_tags else []
@@ -601,7 +604,8 @@ def load_single_feed(request, feed_id):
     
     if usersub:
         usersub.feed_opens += 1
-        usersub.needs_unread_recalc = True
+        if not usersub.needs_unread_recalc and not RUserUnreadCount.live_subscriptions([usersub]):
+            usersub.needs_unread_recalc = True
         usersub.save()
         
     diff1 = checkpoint1-start
@@ -770,9 +774,7 @@ def load_river_stories__redis(request):
                                                                            offset=offset, limit=limit,
                                                                            order=order,
                                                                            read_filter=read_filter)
-    story_date_order = "%sstory_date" % ('' if order == 'oldest' else '-')
-    mstories = MStory.objects(story_hash__in=story_hashes).order_by(story_date_order)
-    stories = Feed.format_stories(mstories)
+    stories = RStoryCache.format_stories(story_hashes, order=order)
     found_feed_ids = list(set([story['story_feed_id'] for story in stories]))
     stories, user_profiles = MSharedStory.stories_with_comments_and_profiles(stories, user.pk)
     
@@ -807,7 +809,10 @@ def load_river_stories__redis(request):
                                            classifier_authors=classifier_authors,
                                            classifier_titles=classifier_titles,
                                            classifier_tags=classifier_tags)
-    
+    scorer = ClassifierScorer(classifier_feeds=classifier_feeds,
+                              classifier_authors=classifier_authors,
+                              classifier_titles=classifier_titles,
+                              classifier_tags=classifier_tags)
 
     # Just need to format stories
     for story in stories:
@@ -823,18 +828,13 @@ def load_river_stories__redis(request):
             starred_date = localtime_for_timezone(starred_stories[story['story_hash']],
                                                   user.profile.timezone)
             story['starred_date'] = format_story_link_date__long(starred_date, now)
-        story['intelligence'] = {
-            'feed':   apply_classifier_feeds(classifier_feeds, story['story_feed_id']),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags':   apply_classifier_tags(classifier_tags, story),
-            'title':  apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = scorer.score_story(story)
 
     diff = time.time() - start
     timediff = round(float(diff), 2)
     logging.user(request, "~FYLoading ~FCriver stories~FY: ~SBp%s~SN (%s/%s "
                                "stories, ~SN%s/%s/%s feeds, %s/%s)" % 
-                               (page, len(stories), len(mstories), len(found_feed_ids), 
+                               (page, len(stories), len(story_hashes), len(found_feed_ids), 
                                len(feed_ids), len(original_feed_ids), order, read_filter))
     
     return dict(stories=stories,
@@ -928,6 +928,14 @@ def mark_story_as_read(request):
 
     return data
     
+def canonical_feed_ids(feed_ids):
+    """ Maps each feed_id to the feed it was merged into, if it's a duplicate. """
+    duplicate_feeds = DuplicateFeed.objects.filter(duplicate_feed_id__in=[str(f) for f in feed_ids])
+    feed_ids = dict((feed_id, feed_id) for feed_id in feed_ids)
+    for duplicate_feed in duplicate_feeds:
+        feed_ids[int(duplicate_feed.duplicate_feed_id)] = duplicate_feed.feed_id
+    return feed_ids
+
 @ajax_login_required
 @json.json_view
 def mark_feed_stories_as_read(request):
@@ -938,69 +946,78 @@ def mark_feed_stories_as_read(request):
         'code': -1,
         'message': 'Nothing was marked as read'
     }
+    if not feeds_stories:
+        return data
     
+    feed_ids = canonical_feed_ids([int(feed_id) for feed_id in feeds_stories.keys()])
+    subscribed_feed_ids = set(UserSubscription.objects.filter(user=request.user,
+                                                              feed__in=set(feed_ids.values()))
+                                                      .values_list('feed_id', flat=True))
+    stories = []
     for feed_id, story_ids in feeds_stories.items():
         feed_id = int(feed_id)
-        try:
-            usersub = UserSubscription.objects.select_related('feed').get(user=request.user, feed=feed_id)
-            data = usersub.mark_story_ids_as_read(story_ids)
-        except UserSubscription.DoesNotExist:
+        if feed_ids[feed_id] not in subscribed_feed_ids:
             return dict(code=-1, error="You are not subscribed to this feed_id: %d" % feed_id)
-        except Feed.DoesNotExist:
-            duplicate_feed = DuplicateFeed.objects.filter(duplicate_feed_id=feed_id)
-            try:
-                if not duplicate_feed: raise Feed.DoesNotExist
-                usersub = UserSubscription.objects.get(user=request.user, 
-                                                       feed=duplicate_feed[0].feed)
-                data = usersub.mark_story_ids_as_read(story_ids)
-            except (UserSubscription.DoesNotExist, Feed.DoesNotExist):
-                return dict(code=-1, error="No feed exists for feed_id: %d" % feed_id)
-
-        r.publish(request.user.username, 'feed:%s' % feed_id)
+        stories.extend((feed_ids[feed_id], story_id) for story_id in story_ids)
     
-    return data
+    logging.user(request, "~FYRead %s stories in %s feeds" % (len(stories), len(feeds_stories)))
+    MSocialSubscription.mark_stories_as_read(request.user.pk, stories)
+    
+    p = r.pipeline()
+    for feed_id in feeds_stories.keys():
+        p.publish(request.user.username, 'feed:%s' % feed_id)
+    p.execute()
+    
+    return dict(code=0, payload=[story_id for _, story_id in stories])
     
 @ajax_login_required
 @json.json_view
 def mark_social_stories_as_read(request):
     code = 1
     errors = []
-    data = {}
     r = redis.Redis(connection_pool=settings.REDIS_POOL)
     users_feeds_stories = request.REQUEST.get('users_feeds_stories', "{}")
     users_feeds_stories = json.decode(users_feeds_stories)
-
+    
+    feed_ids = canonical_feed_ids(set(int(feed_id) for feeds in users_feeds_stories.values()
+                                                   for feed_id in feeds.keys()))
+    social_user_ids = [int(social_user_id) for social_user_id in users_feeds_stories.keys()]
+    subscribed_user_ids = set(s.subscription_user_id for s in 
+                              MSocialSubscription.objects(user_id=request.user.pk,
+                                                          subscription_user_id__in=social_user_ids)
+                                                 .only('subscription_user_id'))
+    
+    stories = []
+    story_ids_read = []
     for social_user_id, feeds in users_feeds_stories.items():
+        social_user_id = int(social_user_id)
         for feed_id, story_ids in feeds.items():
-            feed_id = int(feed_id)
-            try:
-                socialsub = MSocialSubscription.objects.get(user_id=request.user.pk, 
-                                                            subscription_user_id=social_user_id)
-                data = socialsub.mark_story_ids_as_read(story_ids, feed_id, request=request)
-            except OperationError, e:
-                code = -1
-                errors.append("Already read story: %s" % e)
-            except MSocialSubscription.DoesNotExist:
+            story_ids_read.extend(story_ids)
+            if social_user_id in subscribed_user_ids:
+                stories.extend((feed_ids[int(feed_id)], story_id) for story_id in story_ids)
+            else:
                 MSocialSubscription.mark_unsub_story_ids_as_read(request.user.pk, social_user_id,
                                                                  story_ids, feed_id,
                                                                  request=request)
-            except Feed.DoesNotExist:
-                duplicate_feed = DuplicateFeed.objects.filter(duplicate_feed_id=feed_id)
-                if duplicate_feed:
-                    try:
-                        socialsub = MSocialSubscription.objects.get(user_id=request.user.pk,
-                                                                    subscription_user_id=social_user_id)
-                        data = socialsub.mark_story_ids_as_read(story_ids, duplicate_feed[0].feed.pk, request=request)
-                    except (UserSubscription.DoesNotExist, Feed.DoesNotExist):
-                        code = -1
-                        errors.append("No feed exists for feed_id %d." % feed_id)
-                else:
-                    continue
-            r.publish(request.user.username, 'feed:%s' % feed_id)
-        r.publish(request.user.username, 'social:%s' % social_user_id)
-
-    data.update(code=code, errors=errors)
-    return data
+    
+    if stories:
+        logging.user(request, "~FYRead %s stories in %s social subscriptions" % (
+                     len(stories), len(subscribed_user_ids)))
+        try:
+            MSocialSubscription.mark_stories_as_read(request.user.pk, stories,
+                                                     social_user_ids=subscribed_user_ids)
+        except OperationError, e:
+            code = -1
+            errors.append("Already read story: %s" % e)
+    
+    p = r.pipeline()
+    for social_user_id, feeds in users_feeds_stories.items():
+        for feed_id in feeds.keys():
+            p.publish(request.user.username, 'feed:%s' % feed_id)
+        p.publish(request.user.username, 'social:%s' % social_user_id)
+    p.execute()
+    
+    return dict(code=code, errors=errors, payload=story_ids_read)
     
 @ajax_login_required
 @json.json_view
@@ -1016,7 +1033,8 @@ def mark_story_as_unread(request):
         usersub = None
         feed = Feed.get_by_id(feed_id)
         
-    if usersub and not usersub.needs_unread_recalc:
+    if (usersub and not usersub.needs_unread_recalc and
+        not RUserUnreadCount.live_subscriptions([usersub])):
         usersub.needs_unread_recalc = True
         usersub.save()
         
@@ -1351,6 +1369,7 @@ def save_feed_chooser(request):
         approved_feeds = [int(feed_id) for feed_id in request.POST.getlist('approved_feeds') if feed_id][:64]
     activated = 0
     usersubs = UserSubscription.objects.filter(user=request.user)
+    newly_active = []
     
     for sub in usersubs:
         try:
@@ -1359,13 +1378,20 @@ def save_feed_chooser(request):
                 if not sub.active:
                     sub.active = True
                     sub.save()
-                    if sub.feed.active_subscribers <= 0:
-                        sub.feed.count_subscribers()
+                    newly_active.append(sub)
             elif sub.active:
                 sub.active = False
                 sub.save()
         except Feed.DoesNotExist:
             pass
+    
+    RFeedSubscriberCounts.recount_users([request.user.pk])
+    for sub in newly_active:
+        try:
+            if sub.feed.active_subscribers <= 0:
+                sub.feed.count_subscribers()
+        except Feed.DoesNotExist:
+            pass
             
     request.user.profile.queue_new_feeds()
     request.user.profile.refresh_stale_feeds(exclude_new=True)
@@ -1392,6 +1418,8 @@ def activate_premium_account(request):
         for sub in usersubs:
             sub.active = True
             sub.save()
+        RFeedSubscriberCounts.recount_users([request.user.pk])
+        for sub in usersubs:
             if sub.feed.premium_subscribers <= 0:
                 sub.feed.count_subscribers()
                 sub.feed.schedule_feed_fetch_immediately()
@@ -0,0 +1,134 @@
+import time
+import redis
+from collections import defaultdict
+from operator import itemgetter
+from django.conf import settings
+from utils import json_functions as json
+
+
+class RFeedStatistics(object):
+    """
+    Running per-feed story statistics, updated as stories are added, changed and
+    trimmed, so the story_count_history, popular_tags and popular_authors fields
+    on FeedData can be rebuilt without scanning a feed's stories:
+
+        FSM:<feed_id>   hash of 'YYYY-M' -> stories published that month
+        FST:<feed_id>   hash of tag -> stories currently carrying it
+        FSA:<feed_id>   hash of author -> stories currently by them
+
+    Months only ever go up, since trimming old stories shouldn't erase a feed's
+    history. Tags and authors describe the stories the feed still has. The months
+    hash also carries a `backfilled` timestamp once the feed's existing stories
+    have been counted by `backfill`; until then it is only a partial count.
+    """
+
+    MONTHS     = 'FSM'
+    TAGS       = 'FST'
+    AUTHORS    = 'FSA'
+    BACKFILLED = 'backfilled'
+
+    @classmethod
+    def redis(cls):
+        return redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+
+    @staticmethod
+    def key(kind, feed_id):
+        return "%s:%s" % (kind, feed_id)
+
+    @staticmethod
+    def month(story_date):
+        return u'%s-%s' % (story_date.year, story_date.month)
+
+    @classmethod
+    def count_stories(cls, stories, deltas=None, sign=1, months=True):
+        """
+        Adds each story's month, tags and author to `deltas`, a dict of kind ->
+        (field -> change), and returns it. Pass sign=-1 to take stories away.
+        """
+        if deltas is None:
+            deltas = dict((kind, defaultdict(int)) for kind in (cls.MONTHS, cls.TAGS, cls.AUTHORS))
+        for story in stories:
+            if months and story.story_date:
+                deltas[cls.MONTHS][cls.month(story.story_date)] += sign
+            for tag in set(story.story_tags or []):
+                if tag:
+                    deltas[cls.TAGS][tag] += sign
+            if story.story_author_name:
+                deltas[cls.AUTHORS][story.story_author_name] += sign
+        return deltas
+
+    @classmethod
+    def adjust(cls, feed_id, deltas):
+        """ Applies `deltas` from `count_stories`, dropping anything that reaches zero. """
+        changes = [(kind, field, delta) for kind, fields in deltas.items()
+                   for field, delta in fields.items() if delta]
+        if not changes: return
+        r = cls.redis()
+        p = r.pipeline()
+        for kind, field, delta in changes:
+            p.hincrby(cls.key(kind, feed_id), field, delta)
+        counts = p.execute()
+
+        emptied = [(kind, field) for (kind, field, _), count in zip(changes, counts) if int(count) <= 0]
+        if emptied:
+            p = r.pipeline()
+            for kind, field in emptied:
+                p.hdel(cls.key(kind, feed_id), field)
+            p.execute()
+
+    @classmethod
+    def backfilled(cls, feed_id):
+        return cls.redis().hexists(cls.key(cls.MONTHS, feed_id), cls.BACKFILLED)
+
+    @classmethod
+    def months(cls, feed_id):
+        counts = cls.redis().hgetall(cls.key(cls.MONTHS, feed_id))
+        counts.pop(cls.BACKFILLED, None)
+        return dict((month, int(count)) for month, count in counts.items())
+
+    @classmethod
+    def popular(cls, kind, feed_id, limit):
+        """ The `limit` most common tags or authors as [(name, count), ...]. """
+        counts = cls.redis().hgetall(cls.key(kind, feed_id))
+        counts = [(name.decode('utf-8'), int(count)) for name, count in counts.items() if int(count) > 0]
+        return sorted(counts, key=itemgetter(1), reverse=True)[:limit]
+
+    @classmethod
+    def ensure_backfilled(cls, feed):
+        if cls.backfilled(feed.pk): return
+        history = feed.data.story_count_history and json.decode(feed.data.story_count_history)
+        if isinstance(history, dict):
+            history = history['months']
+        cls.backfill(feed, history=history)
+
+    @classmethod
+    def backfill(cls, feed, history=None):
+        """
+        Rebuilds a feed's statistics from its stories, in one pass over just the
+        fields that are counted. Months already in `history`, a list of
+        ('YYYY-M', count) from story_count_history, are kept if they're higher,
+        since those stories may have been trimmed.
+        """
+        from apps.rss_feeds.models import MStory
+        stories = MStory.objects(story_feed_id=feed.pk).only('story_date', 'story_tags', 'story_author_name')
+        deltas = cls.count_stories(stories)
+        for month, count in (history or []):
+            if count > deltas[cls.MONTHS].get(month, 0):
+                deltas[cls.MONTHS][month] = count
+
+        p = cls.redis().pipeline()
+        for kind, counts in deltas.items():
+            key = cls.key(kind, feed.pk)
+            p.delete(key)
+            counts = dict((field, count) for field, count in counts.items() if count > 0)
+            if kind == cls.MONTHS:
+                counts[cls.BACKFILLED] = int(time.time())
+            if counts:
+                p.hmset(key, counts)
+        p.execute()
+
+        return deltas
+
+    @classmethod
+    def delete(cls, feed_id):
+        cls.redis().delete(*[cls.key(kind, feed_id) for kind in (cls.MONTHS, cls.TAGS, cls.AUTHORS)])
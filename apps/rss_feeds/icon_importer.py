@@ -1,19 +1,22 @@
 import urllib2
 import lxml.html
 import numpy
-import scipy
-import scipy.misc
-import scipy.cluster
 import urlparse
 import struct
 import operator
 import gzip
 import datetime
+import hashlib
+import multiprocessing
+import time
+import redis
 from PIL import BmpImagePlugin, PngImagePlugin, Image
 from boto.s3.key import Key
 from StringIO import StringIO
 from django.conf import settings
-from apps.rss_feeds.models import MFeedPage, MFeedIcon
+from apps.rss_feeds.models import Feed, MFeedPage, MFeedIcon
+from utils import log as logging
+from utils.feed_downloader import FeedDownloader
 from utils.feed_functions import timelimit, TimeoutError
 
 HEADERS = {
@@ -29,52 +32,62 @@ class IconImporter(object):
         self.page_data = page_data
         self.feed_icon, _ = MFeedIcon.objects.get_or_create(feed_id=self.feed.pk)
     
-    def save(self):
+    def needs_icon(self):
         if not self.force and self.feed.favicon_not_found:
-            # print 'Not found, skipping...'
-            return
+            return False
         if (not self.force and 
             not self.feed.favicon_not_found and 
             self.feed_icon.icon_url and 
             self.feed.s3_icon):
-            # print 'Found, but skipping...'
+            return False
+        return True
+    
+    def save(self):
+        if not self.needs_icon():
             return
         image, image_file, icon_url = self.fetch_image_from_page_data()
         if not image:
             image, image_file, icon_url = self.fetch_image_from_path(force=self.force)
 
+        processed = None
         if image:
-            try:
-                ico_image = self.load_icon(image_file)
-                if ico_image: image = ico_image
-            except ValueError:
-                # print "Bad .ICO"
-                pass
-            image     = self.normalize_image(image)
-            color     = self.determine_dominant_color_in_image(image)
-            image_str = self.string_from_image(image)
-
-            if (self.force or 
-                self.feed_icon.color != color or 
-                self.feed_icon.data != image_str or 
-                self.feed_icon.icon_url != icon_url or
-                self.feed_icon.not_found or
-                (settings.BACKED_BY_AWS.get('icons_on_s3') and not self.feed.s3_icon)):
-                self.feed_icon.data      = image_str
-                self.feed_icon.icon_url  = icon_url
-                self.feed_icon.color     = color
-                self.feed_icon.not_found = False
-                self.feed_icon.save()
-                if settings.BACKED_BY_AWS.get('icons_on_s3'):
-                    self.save_to_s3(image_str)
-            self.feed.favicon_color     = color
-            self.feed.favicon_not_found = False
+            icon = image_file.getvalue()
+            content_hash = hashlib.sha1(icon).hexdigest()
+            if not self.force:
+                processed = MFeedIcon.processed_icons([content_hash]).get(content_hash)
+            if not processed:
+                processed = process_icon(icon)
+        
+        if processed:
+            color, image_str = processed
+            self.save_icon(icon_url, color, image_str, content_hash)
         else:
-            self.feed_icon.not_found = True
-            self.feed.favicon_not_found = True
-            
-        self.feed.save()
+            self.save_not_found()
         return not self.feed.favicon_not_found
+    
+    def save_icon(self, icon_url, color, image_str, content_hash=None):
+        if (self.force or 
+            self.feed_icon.color != color or 
+            self.feed_icon.data != image_str or 
+            self.feed_icon.icon_url != icon_url or
+            self.feed_icon.not_found or
+            (settings.BACKED_BY_AWS.get('icons_on_s3') and not self.feed.s3_icon)):
+            self.feed_icon.data         = image_str
+            self.feed_icon.icon_url     = icon_url
+            self.feed_icon.color        = color
+            self.feed_icon.content_hash = content_hash
+            self.feed_icon.not_found    = False
+            self.feed_icon.save()
+            if settings.BACKED_BY_AWS.get('icons_on_s3'):
+                self.save_to_s3(image_str)
+        self.feed.favicon_color     = color
+        self.feed.favicon_not_found = False
+        self.feed.save()
+    
+    def save_not_found(self):
+        self.feed_icon.not_found = True
+        self.feed.favicon_not_found = True
+        self.feed.save()
 
     def save_to_s3(self, image_str):
         expires = datetime.datetime.now() + datetime.timedelta(days=60)
@@ -88,7 +101,8 @@ class IconImporter(object):
         
         self.feed.s3_icon = True
         
-    def load_icon(self, image_file, index=None):
+    @staticmethod
+    def load_icon(image_file, index=None):
         '''
         Load Windows ICO image.
 
@@ -168,23 +182,36 @@ class IconImporter(object):
     def fetch_image_from_page_data(self):
         image = None
         image_file = None
+        url = self.page_icon_url()
+        if url:
+            image, image_file = self.get_image_from_url(url)
+        return image, image_file, url
+
+    def candidate_urls(self, page_data_url=None, force=False):
+        """ The urls `save` would try, in order: the page's <link rel=icon>, then favicon.ico. """
+        urls = [page_data_url]
+        if not force:
+            urls.append(self.feed_icon.icon_url)
+        if self.feed.feed_link and len(self.feed.feed_link) > 6:
+            urls.append(urlparse.urljoin(self.feed.feed_link, 'favicon.ico'))
+            urls.append(urlparse.urljoin(self.feed.feed_link, '/favicon.ico'))
+        seen = set()
+        return [url for url in urls if url and not (url in seen or seen.add(url))]
+    
+    def page_icon_url(self):
+        """ Like `fetch_image_from_page_data`, but only finds the url. """
         if self.page_data:
             content = self.page_data
         elif settings.BACKED_BY_AWS.get('pages_on_s3') and self.feed.s3_page:
             key = settings.S3_PAGES_BUCKET.get_key(self.feed.s3_pages_key)
-            compressed_content = key.get_contents_as_string()
-            stream = StringIO(compressed_content)
-            gz = gzip.GzipFile(fileobj=stream)
+            stream = StringIO(key.get_contents_as_string())
             try:
-                content = gz.read()
+                content = gzip.GzipFile(fileobj=stream).read()
             except IOError:
                 content = None
         else:
             content = MFeedPage.get_data(feed_id=self.feed.pk)
-        url = self._url_from_html(content)
-        if url:
-            image, image_file = self.get_image_from_url(url)
-        return image, image_file, url
+        return self._url_from_html(content)
 
     def fetch_image_from_path(self, path='favicon.ico', force=False):
         image = None
@@ -248,7 +275,8 @@ class IconImporter(object):
                 url = urlparse.urljoin(self.feed.feed_link, icon_path[0])
         return url
         
-    def normalize_image(self, image):
+    @staticmethod
+    def normalize_image(image):
         # if image.size != (16, 16):
         #     image = image.resize((16, 16), Image.BICUBIC)
         if image.mode != 'RGBA':
@@ -259,55 +287,171 @@ class IconImporter(object):
         
         return image
 
-    def determine_dominant_color_in_image(self, image):
-        NUM_CLUSTERS = 5
-        
-        # Convert image into array of values for each point.
-        if image.mode == '1':
-            image.convert('L')
-        ar = numpy.array(image)
-        # ar = scipy.misc.fromimage(image)
-        shape = ar.shape
-        
-        # Reshape array of values to merge color bands. [[R], [G], [B], [A]] => [R, G, B, A]
-        if len(shape) > 2:
-            ar = ar.reshape(scipy.product(shape[:2]), shape[2])
-            
-        # Get NUM_CLUSTERS worth of centroids.
-        codes, _ = scipy.cluster.vq.kmeans(ar, NUM_CLUSTERS)
+    @staticmethod
+    def determine_dominant_color_in_image(image):
+        """
+        The most common color in the icon. Transparent pixels are ignored, and so are
+        near-blacks and near-whites unless that's all there is. Pixels of a small copy
+        of the image are binned by the top four bits of each channel with a single
+        bincount, and the pixels in the fullest bin are averaged.
+        """
+        image = image.copy()
+        image.thumbnail((64, 64))
+        ar = numpy.asarray(image.convert('RGBA'), dtype=numpy.uint8).reshape(-1, 4)
+        opaque = ar[ar[:, 3] >= 128]
+        if len(opaque):
+            ar = opaque
+        rgb = ar[:, :3].astype(numpy.int32)
+        if not len(rgb):
+            return None
         
-        # Pare centroids, removing blacks and whites and shades of really dark and really light.
-        original_codes = codes
+        # Pare pixels, removing blacks and whites and shades of really dark and really light.
+        pixels = rgb
         for low, hi in [(60, 200), (35, 230), (10, 250)]:
-            codes = scipy.array([code for code in codes 
-                                 if not ((code[0] < low and code[1] < low and code[2] < low) or
-                                         (code[0] > hi and code[1] > hi and code[2] > hi))])
-            if not len(codes): codes = original_codes
-            else: break
-    
-        # Assign codes (vector quantization). Each vector is compared to the centroids
-        # and assigned the nearest one.
-        vecs, _ = scipy.cluster.vq.vq(ar, codes)
-        
-        # Count occurences of each clustered vector.
-        counts, bins = scipy.histogram(vecs, len(codes))
-
-        # Show colors for each code in its hex value.
-        # colors = [''.join(chr(c) for c in code).encode('hex') for code in codes]
-        # total = scipy.sum(counts)
-        # print dict(zip(colors, [count/float(total) for count in counts]))
+            pared = rgb[~((rgb < low).all(axis=1) | (rgb > hi).all(axis=1))]
+            if len(pared):
+                pixels = pared
+                break
         
-        # Find the most frequent color, based on the counts.
-        index_max = scipy.argmax(counts)
-        peak = codes[index_max]
-        color = ''.join(chr(c) for c in peak).encode('hex')
+        bins = ((pixels[:, 0] >> 4) << 8) | ((pixels[:, 1] >> 4) << 4) | (pixels[:, 2] >> 4)
+        peak = pixels[bins == numpy.bincount(bins).argmax()].mean(axis=0)
+        color = ''.join('%02x' % int(round(c)) for c in peak)
         
         return color[:6]
 
-    def string_from_image(self, image):
+    @staticmethod
+    def string_from_image(image):
         output = StringIO()
         image.save(output, 'png', quality=95)
         contents = output.getvalue()
         output.close()
         return contents.encode('base64')
-    
\ No newline at end of file
+
+
+def process_icon(icon):
+    """
+    Decodes a downloaded icon and returns its (color, base64 png), or None if it
+    isn't an image. Only takes and returns strings, so it can run on a process pool.
+    """
+    image_file = StringIO(icon)
+    try:
+        image = Image.open(image_file)
+        try:
+            ico_image = IconImporter.load_icon(image_file)
+            if ico_image: image = ico_image
+        except ValueError:
+            # Bad .ICO
+            pass
+        image = IconImporter.normalize_image(image)
+        return (IconImporter.determine_dominant_color_in_image(image),
+                IconImporter.string_from_image(image))
+    except Exception:
+        return None
+
+
+class IconPipeline(object):
+    """
+    Fetches icons for feeds in batches, off the feed fetcher's critical path. The
+    fetcher adds feed ids to the `icon_feeds` redis set and a batch is popped and:
+
+        1. The candidate urls for each feed are found from its stored page.
+        2. Icons are downloaded on a thread pool, trying the next candidate url for
+           feeds whose download wasn't an image.
+        3. Icons are deduped by a sha1 of their bytes. Colors and pngs already on an
+           MFeedIcon with the same hash are reused, since many feeds share the same
+           platform favicon, and only new icons are processed on the process pool.
+        4. MFeedIcon, the feed and S3 are updated as `IconImporter.save` would.
+    """
+    
+    QUEUE = 'icon_feeds'
+    
+    def __init__(self, processes=None, concurrency=20, per_host=2, timeout=15):
+        self.processes = processes
+        self.downloader = FeedDownloader(concurrency=concurrency, per_host=per_host, timeout=timeout)
+    
+    @classmethod
+    def queue(cls, feed_ids):
+        if not feed_ids: return
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        r.sadd(cls.QUEUE, *feed_ids)
+    
+    @classmethod
+    def pop(cls, count):
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        p = r.pipeline()
+        for _ in xrange(count):
+            p.spop(cls.QUEUE)
+        return [int(feed_id) for feed_id in p.execute() if feed_id]
+    
+    def download(self, importers, candidates):
+        """ Returns importer -> (icon_url, icon bytes) for the importers that found an image. """
+        found = {}
+        attempt = 0
+        while True:
+            jobs = [dict(feed_id=i, address=candidates[i][attempt], agent=HEADERS['User-Agent'])
+                    for i in xrange(len(importers))
+                    if i not in found and len(candidates[i]) > attempt]
+            if not jobs: break
+            for i, download in self.downloader.download(jobs):
+                if download.get('error') or download['status'] >= 400 or not download['content']:
+                    continue
+                try:
+                    Image.open(StringIO(download['content']))
+                except (IOError, ValueError):
+                    continue
+                found[i] = (candidates[i][attempt], download['content'])
+            attempt += 1
+        return found
+    
+    def process(self, icons):
+        """ Runs `process_icon` over {content_hash: icon}, on a process pool if there is one. """
+        hashes = icons.keys()
+        if self.processes:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                results = pool.map(process_icon, [icons[h] for h in hashes])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(process_icon, [icons[h] for h in hashes])
+        return dict((h, result) for h, result in zip(hashes, results) if result)
+    
+    def run(self, feed_ids, force=False):
+        start = time.time()
+        importers = [IconImporter(feed, force=force) for feed in Feed.objects.filter(pk__in=feed_ids)]
+        importers = [importer for importer in importers if importer.needs_icon()]
+        if not importers: return 0
+        candidates = [importer.candidate_urls(importer.page_icon_url(), force=force)
+                      for importer in importers]
+        
+        found = self.download(importers, candidates)
+        download_duration = time.time() - start
+        
+        icons = {}
+        content_hashes = {}
+        for i, (icon_url, icon) in found.items():
+            content_hashes[i] = hashlib.sha1(icon).hexdigest()
+            icons[content_hashes[i]] = icon
+        processed = {} if force else MFeedIcon.processed_icons(icons.keys())
+        unique = dict((h, icon) for h, icon in icons.items() if h not in processed)
+        processed.update(self.process(unique))
+        
+        for i, importer in enumerate(importers):
+            result = i in found and processed.get(content_hashes[i])
+            try:
+                if result:
+                    color, image_str = result
+                    importer.save_icon(found[i][0], color, image_str, content_hashes[i])
+                else:
+                    importer.save_not_found()
+            except Exception, e:
+                logging.debug('   ---> [%-30s] ~FRIcon save failed: %s' % (importer.feed.title[:30], e))
+        
+        duration = time.time() - start
+        logging.debug(" ---> ~FYIcons: ~SB%s~SN feeds, ~SB%s~SN found, ~SB%s~SN unique, ~SB%s~SN processed "
+                      "in %.2ss (%.2ss downloading), ~SB%.1f~SN icons/s" % (
+                      len(importers), len(found), len(icons), len(unique),
+                      duration, download_duration, len(importers) / max(duration, .001)))
+        
+        return len(importers)
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed
+from apps.rss_feeds.feed_statistics import RFeedStatistics
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--feed", dest="feed_id", default=None),
+        make_option("-s", "--start", dest="start", type="int", default=0,
+            help="Feed id to start from, to resume an interrupted backfill."),
+        make_option("-F", "--force", dest="force", action="store_true", default=False,
+            help="Rebuild feeds that have already been backfilled."),
+        make_option('-V', '--verbose', action='store_true', dest='verbose', default=False),
+    )
+
+    def handle(self, *args, **options):
+        if options['feed_id']:
+            feed_ids = [int(options['feed_id'])]
+        else:
+            feed_ids = list(Feed.objects.filter(pk__gte=options['start']).order_by('pk')
+                                        .values_list('pk', flat=True))
+
+        backfilled = 0
+        for feed_id in feed_ids:
+            if not options['force'] and RFeedStatistics.backfilled(feed_id):
+                continue
+            feed = Feed.get_by_id(feed_id)
+            if not feed or feed.pk != feed_id:
+                continue
+            if options['force']:
+                RFeedStatistics.delete(feed.pk)
+            RFeedStatistics.ensure_backfilled(feed)
+            feed.save_feed_story_history_statistics()
+            feed.save_popular_tags()
+            feed.save_popular_authors()
+            backfilled += 1
+
+            if options['verbose'] or not backfilled % 1000:
+                print " ---> [%s] %s: %s feeds backfilled" % (feed.pk, feed.feed_title[:30], backfilled)
+
+        print " ---> Backfilled statistics for %s feeds" % backfilled
@@ -0,0 +1,147 @@
+import difflib
+import glob
+import os
+import time
+import zlib
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from apps.rss_feeds.models import Feed, MStory, StoryDedupIndex
+from utils import feedparser
+from utils import log as logging
+from utils.feed_functions import levenshtein_distance
+from utils.story_functions import pre_process_story, strip_comments
+from optparse import make_option
+
+
+def legacy_exists_story(self, story=None, story_content=None, existing_stories=None):
+    """ Feed._exists_story before the dedup index, copied verbatim as the baseline. """
+    story_in_system = None
+    story_has_changed = False
+    story_link = self.get_permalink(story)
+    existing_stories_guids = existing_stories.keys()
+    # story_pub_date = story.get('published')
+    # story_published_now = story.get('published_now', False)
+    # start_date = story_pub_date - datetime.timedelta(hours=8)
+    # end_date = story_pub_date + datetime.timedelta(hours=8)
+    
+    for existing_story in existing_stories.values():
+        content_ratio = 0
+        # existing_story_pub_date = existing_story.story_date
+        # print 'Story pub date: %s %s' % (story_published_now, story_pub_date)
+        
+        if 'story_latest_content_z' in existing_story:
+            existing_story_content = unicode(zlib.decompress(existing_story.story_latest_content_z))
+        elif 'story_latest_content' in existing_story:
+            existing_story_content = existing_story.story_latest_content
+        elif 'story_content_z' in existing_story:
+            existing_story_content = unicode(zlib.decompress(existing_story.story_content_z))
+        elif 'story_content' in existing_story:
+            existing_story_content = existing_story.story_content
+        else:
+            existing_story_content = u''
+            
+        if isinstance(existing_story.id, unicode):
+            existing_story.story_guid = existing_story.id
+        if (story.get('guid') in existing_stories_guids and 
+            story.get('guid') != existing_story.story_guid):
+            continue
+        elif story.get('guid') == existing_story.story_guid:
+            story_in_system = existing_story
+        
+        # Title distance + content distance, checking if story changed
+        story_title_difference = abs(levenshtein_distance(story.get('title'),
+                                                          existing_story.story_title))
+        
+        seq = difflib.SequenceMatcher(None, story_content, existing_story_content)
+        
+        if (seq
+            and story_content
+            and len(story_content) > 100
+            and existing_story_content
+            and seq.real_quick_ratio() > .9 
+            and seq.quick_ratio() > .95):
+            content_ratio = seq.ratio()
+            
+        if story_title_difference > 0 and content_ratio > .98:
+            story_in_system = existing_story
+            if story_title_difference > 0 or content_ratio < 1.0:
+                if settings.DEBUG:
+                    logging.debug(" ---> Title difference - %s/%s (%s): %s" % (story.get('title'), existing_story.story_title, story_title_difference, content_ratio))
+                story_has_changed = True
+                break
+        
+        # More restrictive content distance, still no story match
+        if not story_in_system and content_ratio > .98:
+            if settings.DEBUG:
+                logging.debug(" ---> Content difference - %s/%s (%s): %s" % (story.get('title'), existing_story.story_title, story_title_difference, content_ratio))
+            story_in_system = existing_story
+            story_has_changed = True
+            break
+            
+        if story_in_system and not story_has_changed:
+            if story_content != existing_story_content:
+                if settings.DEBUG:
+                    logging.debug(" ---> Content difference - %s/%s" % (story_content, existing_story_content))
+                story_has_changed = True
+            if story_link != existing_story.story_permalink:
+                if settings.DEBUG:
+                    logging.debug(" ---> Permalink difference - %s/%s" % (story_link, existing_story.story_permalink))
+                story_has_changed = True
+            # if story_pub_date != existing_story.story_date:
+            #     story_has_changed = True
+            break
+            
+    
+    # if story_has_changed or not story_in_system:
+    #     print 'New/updated story: %s' % (story), 
+    return story_in_system, story_has_changed
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-r", "--runs", dest="runs", type="int", default=10),
+    )
+    
+    def handle(self, *args, **options):
+        fixtures = os.path.join(settings.NEWSBLUR_DIR, 'apps/rss_feeds/fixtures')
+        feed = Feed(feed_address='http://example.com/rss', feed_title='Benchmark')
+        
+        for first in sorted(glob.glob(os.path.join(fixtures, '*1.xml'))):
+            second = first.replace('1.xml', '2.xml')
+            if not os.path.exists(second):
+                second = first
+            
+            existing_stories = {}
+            for entry in feedparser.parse(first).entries:
+                story = pre_process_story(entry)
+                content = strip_comments(story.get('story_content'))
+                existing_story = MStory(story_feed_id=1, story_guid=story.get('guid'),
+                                        story_title=story.get('title'), story_date=story.get('published'),
+                                        story_permalink=feed.get_permalink(story))
+                if content:
+                    existing_story.story_content_z = zlib.compress(content.encode('utf-8'))
+                existing_stories[story.get('guid')] = existing_story
+            
+            stories = []
+            for entry in feedparser.parse(second).entries[:50]:
+                story = pre_process_story(entry)
+                stories.append((story, strip_comments(story.get('story_content'))))
+            
+            start = time.time()
+            for _ in range(options['runs']):
+                legacy = [legacy_exists_story(feed, new_story, new_content, existing_stories)
+                          for new_story, new_content in stories]
+            legacy_time = (time.time() - start) / options['runs']
+            
+            start = time.time()
+            for _ in range(options['runs']):
+                dedup = StoryDedupIndex(existing_stories,
+                                        incoming_guids=[new_story.get('guid') for new_story, _ in stories])
+                indexed = [feed._exists_story(new_story, new_content, existing_stories, dedup=dedup)
+                           for new_story, new_content in stories]
+            indexed_time = (time.time() - start) / options['runs']
+            
+            agree = sum(1 for a, b in zip(legacy, indexed) if a == b)
+            print " ---> %-28s %3s vs %3s stories: %7.1fms -> %6.1fms per fetch (%s/%s same result)" % (
+                  os.path.basename(second), len(stories), len(existing_stories),
+                  legacy_time * 1000, indexed_time * 1000, agree, len(stories))
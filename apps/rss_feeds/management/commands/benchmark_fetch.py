@@ -0,0 +1,93 @@
+import glob
+import multiprocessing
+import os
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from utils import feedparser
+from utils.feed_downloader import FeedDownloader, parse_download
+from optparse import make_option
+
+
+class RecordedFeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the recorded feeds in rss_feeds/fixtures after an artificial delay. """
+    
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        feeds = self.server.feeds
+        body = feeds[hash(self.path) % len(feeds)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+class RecordedFeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def parse_entries(download):
+    return len(parse_download(download).entries)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-n", "--feeds", dest="feeds", type="int", default=500),
+        make_option("-l", "--latency", dest="latency", type="float", default=0.5,
+                    help="Seconds the stand-in server waits before responding."),
+        make_option("-s", "--serial", dest="serial", type="int", default=20,
+                    help="Feeds to fetch one at a time for the baseline."),
+        make_option("-c", "--concurrency", dest="concurrency", type="int", default=100),
+        make_option("-p", "--per_host", dest="per_host", type="int", default=4),
+        make_option("-H", "--hosts", dest="hosts", type="int", default=50,
+                    help="Loopback addresses (127.0.0.x) to spread the feeds over."),
+        make_option("-w", "--workers", dest="workers", type="int", default=4),
+    )
+    
+    def handle(self, *args, **options):
+        fixtures = os.path.join(settings.NEWSBLUR_DIR, 'apps/rss_feeds/fixtures/*.xml')
+        server = RecordedFeedServer(('', 0), RecordedFeedHandler)
+        server.feeds = [open(f).read() for f in sorted(glob.glob(fixtures))]
+        server.latency = options['latency']
+        port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        
+        addresses = ['http://127.0.0.%s:%s/feed/%s.xml' % (i % options['hosts'] + 1, port, i)
+                     for i in range(options['feeds'])]
+        print " ---> Serving %s recorded feeds on port %s with %ss latency" % (
+              len(server.feeds), port, options['latency'])
+        
+        start = time.time()
+        for address in addresses[:options['serial']]:
+            feedparser.parse(address)
+        serial_rate = options['serial'] / (time.time() - start) * 60
+        print " ---> feedparser, one at a time:  %8.1f feeds/min/core" % serial_rate
+        
+        pool = multiprocessing.Pool(options['workers'])
+        downloader = FeedDownloader(concurrency=options['concurrency'],
+                                    per_host=options['per_host'])
+        jobs = [dict(feed_id=i, address=address, agent='NewsBlur Fetch Benchmark')
+                for i, address in enumerate(addresses)]
+        start = time.time()
+        results = [pool.apply_async(parse_entries, (download,))
+                   for _, download in downloader.download(jobs)]
+        download_duration = time.time() - start
+        entries = sum(result.get() for result in results)
+        duration = time.time() - start
+        pool.close()
+        rate = len(jobs) / duration * 60
+        print " ---> FeedDownloader + %s parsers: %8.1f feeds/min/core (%.1f feeds/min total)" % (
+              options['workers'], rate / options['workers'], rate)
+        print " ---> Downloaded in %.2fs, parsed %s entries in %.2fs" % (
+              download_duration, entries, duration)
+        server.shutdown()
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from apps.rss_feeds.models import Feed
+from apps.rss_feeds.subscriber_counts import RFeedSubscriberCounts
 from optparse import make_option
 
 class Command(BaseCommand):
@@ -21,15 +22,17 @@ class Command(BaseCommand):
         feeds_count = feeds.count()
         
         for i in xrange(0, feeds_count, 100):
-            feeds = Feed.objects.all()[i:i+100]
-            for feed in feeds.iterator():
+            feeds = list(Feed.objects.all()[i:i+100])
+            RFeedSubscriberCounts.recount([feed.pk for feed in feeds],
+                                          roots=dict((feed.pk, feed.branch_from_feed_id or feed.pk) for feed in feeds))
+            for feed in feeds:
                 feed.count_subscribers(verbose=options['verbose'])
         
         if options['delete']:
             print "# Deleting old feeds..."
             old_feeds = Feed.objects.filter(num_subscribers=0)
             for feed in old_feeds:
-                feed.count_subscribers(verbose=True)
+                feed.count_subscribers(verbose=True, recount=True)
                 if feed.num_subscribers == 0:
                     print ' ---> Deleting: [%s] %s' % (feed.pk, feed)
                     feed.delete()
\ No newline at end of file
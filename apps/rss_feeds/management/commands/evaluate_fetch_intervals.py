@@ -0,0 +1,94 @@
+import datetime
+import random
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed, MStory, MFeedPublishProfile
+from optparse import make_option
+
+
+def replay(story_dates, start, end, next_minutes):
+    """
+    Fetches from `start` to `end`, asking `next_minutes(fetch_date)` for each gap.
+    Returns the number of fetches and each story's delay in minutes until the first
+    fetch after it was published.
+    """
+    fetches = []
+    fetch_date = start
+    while fetch_date < end:
+        fetch_date += datetime.timedelta(minutes=next_minutes(fetch_date))
+        fetches.append(fetch_date)
+
+    delays = []
+    fetch = 0
+    for story_date in story_dates:
+        while fetch < len(fetches) and fetches[fetch] < story_date:
+            fetch += 1
+        if fetch < len(fetches):
+            delays.append((fetches[fetch] - story_date).total_seconds() / 60)
+    return len(fetches), delays
+
+def median(values):
+    if not values: return 0
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--feed", dest="feed_id", default=None),
+        make_option("-n", "--count", dest="count", type="int", default=100,
+            help="Number of the most subscribed feeds to replay."),
+        make_option("-w", "--weeks", dest="weeks", type="int", default=4,
+            help="Weeks to learn from, followed by the same number of weeks to replay."),
+        make_option('-V', '--verbose', action='store_true', dest='verbose', default=False),
+    )
+
+    def handle(self, *args, **options):
+        if options['feed_id']:
+            feeds = Feed.objects.filter(pk=options['feed_id'])
+        else:
+            feeds = Feed.objects.filter(active=True, is_push=False, active_subscribers__gte=1)\
+                                .order_by('-active_subscribers')[:options['count']]
+
+        now = datetime.datetime.utcnow()
+        split = now - datetime.timedelta(weeks=options['weeks'])
+        history_start = split - datetime.timedelta(weeks=options['weeks'])
+        days = options['weeks'] * 7.0
+        totals = {'current': [0, []], 'adaptive': [0, []]}
+        replayed = 0
+
+        for feed in feeds:
+            story_dates = sorted(s.story_date for s in MStory.objects(story_feed_id=feed.pk,
+                                                                      story_date__gte=history_start,
+                                                                      story_date__lte=now)
+                                                              .only('story_date'))
+            train = [d for d in story_dates if d < split]
+            test = [d for d in story_dates if d >= split]
+            hours = MFeedPublishProfile.shape_from_dates(train, split,
+                        weekly_rate=feed.average_stories_per_month * 7 / 30.0)
+            if not hours or not test:
+                continue
+
+            interval = int(feed.get_next_scheduled_update(force=True, verbose=False))
+            results = {
+                'current': replay(test, split, now,
+                                  lambda d: interval + random.randint(0, interval) / 4),
+                'adaptive': replay(test, split, now,
+                                   lambda d: MFeedPublishProfile.next_fetch_minutes(hours, d, interval)),
+            }
+            for policy, (fetches, delays) in results.items():
+                totals[policy][0] += fetches
+                totals[policy][1].extend(delays)
+            replayed += 1
+
+            if options['verbose']:
+                print " ---> %-30s %4s stories, every %4s min: %5.1f/%5.1f fetches/day, %5s/%5s min median delay" % (
+                      feed.feed_title[:30], len(test), interval,
+                      results['current'][0] / days, results['adaptive'][0] / days,
+                      int(median(results['current'][1])), int(median(results['adaptive'][1])))
+
+        print " ---> Replayed %s weeks of %s feeds" % (options['weeks'], replayed)
+        for policy in ('current', 'adaptive'):
+            fetches, delays = totals[policy]
+            print " ---> %-8s %8.1f fetches/day, %6s min median story delay, %6s min p90" % (
+                  policy, fetches / days, int(median(delays)),
+                  int(sorted(delays)[int(len(delays) * .9)]) if delays else 0)
@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.icon_importer import IconPipeline
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--feed", dest="feed_ids", action="append", default=[],
+            help="Fetch the icon of this feed instead of draining the queue. Repeatable."),
+        make_option("-b", "--batch", dest="batch", type="int", default=500),
+        make_option("-p", "--processes", dest="processes", type="int", default=4),
+        make_option("-c", "--concurrency", dest="concurrency", type="int", default=20),
+        make_option("-F", "--force", dest="force", action="store_true", default=False),
+        make_option("-d", "--daemon", dest="daemon", action="store_true", default=False,
+            help="Keep draining the queue, sleeping when it's empty."),
+    )
+
+    def handle(self, *args, **options):
+        pipeline = IconPipeline(processes=options['processes'], concurrency=options['concurrency'])
+        if options['feed_ids']:
+            pipeline.run([int(feed_id) for feed_id in options['feed_ids']], force=options['force'])
+            return
+
+        while True:
+            start = time.time()
+            feed_ids = IconPipeline.pop(options['batch'])
+            if feed_ids:
+                count = pipeline.run(feed_ids, force=options['force'])
+                duration = time.time() - start
+                print " ---> %s icons in %.1fs (%.1f icons/s)" % (count, duration, count / max(duration, .001))
+            elif not options['daemon']:
+                break
+            else:
+                time.sleep(10)
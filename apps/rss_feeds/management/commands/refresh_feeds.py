@@ -26,6 +26,12 @@ class Command(BaseCommand):
             dest='skip', default=0, help='Skip stories per month < #.'),
         make_option('-w', '--workerthreads', type='int', default=4,
             help='Worker threads that will fetch feeds in parallel.'),
+        make_option('-a', '--async', dest='async_fetch', action='store_true',
+            help='Download all feeds at once, processing them on the worker processes.'),
+        make_option('-c', '--concurrency', type='int', default=100,
+            help='Simultaneous downloads when fetching asynchronously.'),
+        make_option('-p', '--per_host', type='int', default=4,
+            help='Simultaneous downloads from a single host when fetching asynchronously.'),
     )
 
     def handle(self, *args, **options):
@@ -0,0 +1,177 @@
+import heapq
+import random
+import time
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.scheduler import FeedScheduler
+from optparse import make_option
+
+
+class SimulatedFeeds(object):
+    """
+    A synthetic feed population. Subscribers follow a long tail, fetch intervals
+    loosely follow Feed.get_next_scheduled_update, and hosts are skewed so a few
+    big publishers (think feedburner, blogspot) carry a large share of feeds.
+    """
+
+    def __init__(self, count, hosts):
+        self.count = count
+        self.subscribers = []
+        self.bonus = []
+        self.interval = []
+        self.host = []
+        for _ in xrange(count):
+            active = int(random.paretovariate(1.1)) - 1
+            premium = sum(1 for _ in xrange(min(active, 50)) if random.random() < .1)
+            if active > 1 and random.random() < .3:
+                interval = 10
+            elif active > 1:
+                interval = 60
+            elif random.random() < .5:
+                interval = 60 * 12
+            else:
+                interval = 60 * 24
+            self.subscribers.append(active)
+            self.bonus.append(FeedScheduler.priority_bonus(active, premium) / 60)
+            self.interval.append(interval)
+            self.host.append('host%s' % int(hosts * random.random() ** 2))
+        self.host_latency = defaultdict(lambda: 1)
+        for host in set(self.host):
+            if random.random() < .05:
+                self.host_latency[host] = random.randint(5, 15)
+
+    def fetch_minutes(self, feed_id):
+        return self.host_latency[self.host[feed_id]] + int(random.expovariate(1))
+
+
+class Simulation(object):
+    """
+    Replays the population minute by minute with a fixed number of fetch slots.
+    `policy` is either 'random', the old srandmember over queued_feeds with no
+    host limit, or 'priority', the FeedScheduler queue with per-host limits.
+    """
+
+    def __init__(self, feeds, policy, capacity, max_per_host):
+        self.feeds = feeds
+        self.policy = policy
+        self.capacity = capacity
+        self.max_per_host = max_per_host
+        self.scheduled = defaultdict(list)
+        self.due_at = [0] * feeds.count
+        self.finishing = defaultdict(list)
+        self.in_flight = defaultdict(int)
+        self.in_flight_count = 0
+        self.queue = []
+        self.queue_index = {}
+        self.lags = []
+        self.weighted_lag = 0
+        self.weight = 0
+        self.peak_per_host = 0
+        for feed_id in xrange(feeds.count):
+            self.schedule(feed_id, random.randint(0, feeds.interval[feed_id]))
+
+    def schedule(self, feed_id, minute):
+        self.due_at[feed_id] = minute
+        self.scheduled[minute].append(feed_id)
+
+    def enqueue(self, feed_id):
+        if self.policy == 'priority':
+            priority = self.due_at[feed_id] - self.feeds.bonus[feed_id]
+            heapq.heappush(self.queue, (priority, feed_id))
+        else:
+            self.queue_index[feed_id] = len(self.queue)
+            self.queue.append(feed_id)
+
+    def take(self, limit):
+        if self.policy == 'priority':
+            candidates = []
+            while self.queue and len(candidates) < limit * 2:
+                candidates.append(heapq.heappop(self.queue))
+            hosts = [(feed_id, self.feeds.host[feed_id]) for _, feed_id in candidates]
+            selected = FeedScheduler.select(hosts, self.in_flight, self.max_per_host, limit)
+            chosen = set(selected)
+            for item in candidates:
+                if item[1] not in chosen:
+                    heapq.heappush(self.queue, item)
+            return selected
+
+        selected = []
+        while self.queue and len(selected) < limit:
+            position = random.randrange(len(self.queue))
+            feed_id = self.queue[position]
+            last = self.queue.pop()
+            if position < len(self.queue):
+                self.queue[position] = last
+                self.queue_index[last] = position
+            del self.queue_index[feed_id]
+            selected.append(feed_id)
+        return selected
+
+    def step(self, minute):
+        for feed_id in self.finishing.pop(minute, []):
+            self.in_flight[self.feeds.host[feed_id]] -= 1
+            self.in_flight_count -= 1
+            self.schedule(feed_id, minute + self.feeds.interval[feed_id])
+        for feed_id in self.scheduled.pop(minute, []):
+            self.enqueue(feed_id)
+
+        for feed_id in self.take(self.capacity - self.in_flight_count):
+            host = self.feeds.host[feed_id]
+            lag = minute - self.due_at[feed_id]
+            self.lags.append(lag)
+            self.weighted_lag += lag * max(1, self.feeds.subscribers[feed_id])
+            self.weight += max(1, self.feeds.subscribers[feed_id])
+            self.in_flight[host] += 1
+            self.in_flight_count += 1
+            self.peak_per_host = max(self.peak_per_host, self.in_flight[host])
+            self.finishing[minute + self.feeds.fetch_minutes(feed_id)].append(feed_id)
+
+    def run(self, minutes):
+        for minute in xrange(minutes):
+            self.step(minute)
+
+    def percentile(self, lags, fraction):
+        if not lags: return 0
+        return lags[min(len(lags) - 1, int(len(lags) * fraction))]
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-n", "--feeds", dest="feeds", type="int", default=1000000),
+        make_option("-m", "--minutes", dest="minutes", type="int", default=60*24),
+        make_option("-c", "--capacity", dest="capacity", type="int", default=0,
+            help="Concurrent fetch slots. Defaults to 90% of the offered load."),
+        make_option("-H", "--hosts", dest="hosts", type="int", default=50000),
+        make_option("-p", "--per_host", dest="per_host", type="int", default=FeedScheduler.MAX_PER_HOST),
+        make_option("-s", "--seed", dest="seed", type="int", default=1),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        start = time.time()
+        feeds = SimulatedFeeds(options['feeds'], options['hosts'])
+        sample = xrange(0, feeds.count, 100)
+        mean_fetch = sum(feeds.fetch_minutes(feed_id) for feed_id in sample) / float(len(sample))
+        # A feed is rescheduled when its fetch finishes, so each cycle is interval + fetch.
+        fetches_per_minute = sum(1.0 / (interval + mean_fetch) for interval in feeds.interval)
+        capacity = options['capacity'] or int(fetches_per_minute * mean_fetch * .9)
+        print " ---> %s feeds on %s hosts in %.1fs: %.0f fetches/min offered, %.1f min per fetch, %s slots" % (
+              feeds.count, len(set(feeds.host)), time.time() - start,
+              fetches_per_minute, mean_fetch, capacity)
+
+        for policy in ('random', 'priority'):
+            random.seed(options['seed'])
+            start = time.time()
+            simulation = Simulation(feeds, policy, capacity, options['per_host'])
+            simulation.run(options['minutes'])
+            lags = sorted(simulation.lags)
+            print " ---> %-8s %8s fetches, lag p50/p90/p99: %4s/%4s/%4s min, subscriber-weighted mean %6.1f min, " \
+                  "backlog %7s, peak per host %4s (%.1fs)" % (
+                  policy, len(lags),
+                  simulation.percentile(lags, .5),
+                  simulation.percentile(lags, .9),
+                  simulation.percentile(lags, .99),
+                  simulation.weighted_lag / float(max(1, simulation.weight)),
+                  len(simulation.queue),
+                  simulation.peak_per_host,
+                  time.time() - start)
@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand
 from apps.rss_feeds.models import Feed
 from optparse import make_option
 import gc
+import time
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -18,8 +19,12 @@ class Command(BaseCommand):
         else:
             feeds = Feed.objects.filter(feed_id=options['feed'])
 
+        start = time.time()
+        trimmed = 0
         for f in queryset_iterator(feeds):
-            f.trim_feed(verbose=True)
+            trimmed += f.trim_feed(verbose=True)
+        duration = time.time() - start
+        print "Trimmed %s stories in %.1fs (%.0f stories/s)." % (trimmed, duration, trimmed / max(duration, .001))
         
 
 def queryset_iterator(queryset, chunksize=100):
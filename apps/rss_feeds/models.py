@@ -10,7 +10,6 @@ import hashlib
 import redis
 import pymongo
 from collections import defaultdict
-from operator import itemgetter
 from bson.objectid import ObjectId
 # from nltk.collocations import TrigramCollocationFinder, BigramCollocationFinder, TrigramAssocMeasures, BigramAssocMeasures
 from django.db import models
@@ -23,7 +22,11 @@ from mongoengine.queryset import OperationError, Q, NotUniqueError
 from mongoengine.base import ValidationError
 from vendor.timezones.utilities import localtime_for_timezone
 from apps.rss_feeds.tasks import UpdateFeeds, PushFeeds
-from apps.rss_feeds.text_importer import TextImporter
+from apps.rss_feeds.scheduler import FeedScheduler
+from apps.rss_feeds.story_cache import RStoryCache
+from apps.rss_feeds.subscriber_counts import RFeedSubscriberCounts
+from apps.rss_feeds.feed_statistics import RFeedStatistics
+from apps.rss_feeds.original_text import ROriginalText
 from apps.search.models import SearchStarredStory, SearchFeed
 from apps.statistics.rstats import RStats
 from utils import json_functions as json
@@ -31,7 +34,6 @@ from utils import feedfinder, feedparser
 from utils import urlnorm
 from utils import log as logging
 from utils.fields import AutoOneToOneField
-from utils.feed_functions import levenshtein_distance
 from utils.feed_functions import timelimit, TimeoutError
 from utils.feed_functions import relative_timesince
 from utils.feed_functions import seconds_timesince
@@ -276,6 +278,7 @@ class Feed(models.Model):
                      len(feed_ids))
         
         feeds = Feed.objects.filter(pk__in=feed_ids)
+        RFeedSubscriberCounts.get(feed_ids)
         for feed in feeds:
             feed.count_subscribers()
             feed.schedule_feed_fetch_immediately(verbose=False)
@@ -361,23 +364,22 @@ class Feed(models.Model):
         if isinstance(feeds, QuerySet):
             feeds = [f.pk for f in feeds]
         
-        r.srem('queued_feeds', *feeds)
         now = datetime.datetime.now().strftime("%s")
         p = r.pipeline()
+        p.zrem('queued_feeds', *feeds)
         for feed_id in feeds:
             p.zadd('tasked_feeds', feed_id, now)
         p.execute()
         
-        # for feed_ids in (feeds[pos:pos + queue_size] for pos in xrange(0, len(feeds), queue_size)):
-        for feed_id in feeds:
-            UpdateFeeds.apply_async(args=(feed_id,), queue='update_feeds')
+        for feed_ids in (feeds[pos:pos + queue_size] for pos in xrange(0, len(feeds), queue_size)):
+            UpdateFeeds.apply_async(args=(feed_ids,), queue='update_feeds')
     
     @classmethod
     def drain_task_feeds(cls, empty=False):
         r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
         if not empty:
             tasked_feeds = r.zrange('tasked_feeds', 0, -1)
-            r.sadd('queued_feeds', *tasked_feeds)
+            FeedScheduler(r=r).queue([(feed_id, time.time()) for feed_id in tasked_feeds])
         r.zremrangebyrank('tasked_feeds', 0, -1)
         
     def update_all_statistics(self, full=True, force=False):
@@ -386,14 +388,8 @@ class Feed(models.Model):
         if not self.last_story_date:
             self.calculate_last_story_date()
         
-        count_extra = False
-        if random.random() > .99 or not self.data.popular_tags or not self.data.popular_authors:
-            count_extra = True
-        
         if force or full:
             self.save_feed_stories_last_month()
-
-        if force or (full and count_extra):
             self.save_popular_authors()
             self.save_popular_tags()
             self.save_feed_story_history_statistics()        
@@ -422,6 +418,7 @@ class Feed(models.Model):
              len(feed_ids))
         
         feeds = Feed.objects.filter(pk__in=feed_ids)
+        RFeedSubscriberCounts.get(feed_ids)
         for feed in feeds:
             feed.setup_feed_for_premium_subscribers()
 
@@ -540,44 +537,24 @@ class Feed(models.Model):
         
         return errors, non_errors
     
-    def count_subscribers(self, verbose=False):
-        SUBSCRIBER_EXPIRE = datetime.datetime.now() - datetime.timedelta(days=settings.SUBSCRIBER_EXPIRE)
-        from apps.reader.models import UserSubscription
-        
-        if self.branch_from_feed:
-            original_feed_id = self.branch_from_feed.pk
+    def count_subscribers(self, verbose=False, recount=False):
+        """
+        Reads this feed's subscriber counts from `RFeedSubscriberCounts`, counting
+        them only if they aren't already stored, and saves them if they changed.
+        """
+        roots = {self.pk: self.branch_from_feed_id or self.pk}
+        if recount:
+            counts = RFeedSubscriberCounts.recount([self.pk], roots=roots)[self.pk]
         else:
-            original_feed_id = self.pk
-        feed_ids = [f['id'] for f in Feed.objects.filter(branch_from_feed=original_feed_id).values('id')]
-        feed_ids.append(original_feed_id)
-        feed_ids = list(set(feed_ids))
-
-        subs = UserSubscription.objects.filter(feed__in=feed_ids)
-        self.num_subscribers = subs.count()
-        
-        active_subs = UserSubscription.objects.filter(
-            feed__in=feed_ids, 
-            active=True,
-            user__profile__last_seen_on__gte=SUBSCRIBER_EXPIRE
-        )
-        self.active_subscribers = active_subs.count()
-        
-        premium_subs = UserSubscription.objects.filter(
-            feed__in=feed_ids, 
-            active=True,
-            user__profile__is_premium=True
-        )
-        self.premium_subscribers = premium_subs.count()
-        
-        active_premium_subscribers = UserSubscription.objects.filter(
-            feed__in=feed_ids, 
-            active=True,
-            user__profile__is_premium=True,
-            user__profile__last_seen_on__gte=SUBSCRIBER_EXPIRE
-        )
-        self.active_premium_subscribers = active_premium_subscribers.count()
-        
-        self.save()
+            counts = RFeedSubscriberCounts.get([self.pk], roots=roots)[self.pk]
+        
+        changed = False
+        for field, count in counts.items():
+            if getattr(self, field) != count:
+                setattr(self, field, count)
+                changed = True
+        if changed:
+            self.save()
         
         if verbose:
             if self.num_subscribers <= 1:
@@ -689,27 +666,11 @@ class Feed(models.Model):
         if not current_counts:
             current_counts = []
 
-        # Count stories, aggregate by year and month. Map Reduce!
-        map_f = """
-            function() {
-                var date = (this.story_date.getFullYear()) + "-" + (this.story_date.getMonth()+1);
-                emit(date, 1);
-            }
-        """
-        reduce_f = """
-            function(key, values) {
-                var total = 0;
-                for (var i=0; i < values.length; i++) {
-                    total += values[i];
-                }
-                return total;
-            }
-        """
-        dates = {}
-        res = MStory.objects(story_feed_id=self.pk).map_reduce(map_f, reduce_f, output='inline')
-        for r in res:
-            dates[r.key] = r.value
-            year = int(re.findall(r"(\d{4})-\d{1,2}", r.key)[0])
+        # Stories by year and month, kept up to date as stories come and go.
+        RFeedStatistics.ensure_backfilled(self)
+        dates = RFeedStatistics.months(self.pk)
+        for key in dates:
+            year = int(re.findall(r"(\d{4})-\d{1,2}", key)[0])
             if year < min_year and year > 2000:
                 min_year = year
                 
@@ -864,8 +825,11 @@ class Feed(models.Model):
             return [Feed.get_by_id(f) for f in feed_ids][:limit]
         
     def add_update_stories(self, stories, existing_stories, verbose=False):
-        ret_values = dict(new=0, updated=0, same=0, error=0)
+        ret_values = dict(new=0, updated=0, same=0, error=0, new_story_hashes=[])
         error_count = self.error_count
+        new_stories = []
+        updated_stories = []
+        stat_deltas = None
         
         if settings.DEBUG or verbose:
             logging.debug("   ---> [%-30s] ~FBChecking ~SB%s~SN new/updated against ~SB%s~SN stories" % (
@@ -873,6 +837,8 @@ class Feed(models.Model):
                           len(stories),
                           len(existing_stories.keys())))
         
+        dedup = StoryDedupIndex(existing_stories,
+                                incoming_guids=[story.get('guid') for story in stories])
         for story in stories:
             if not story.get('title'):
                 continue
@@ -885,7 +851,8 @@ class Feed(models.Model):
             story_tags = self.get_tags(story)
             story_link = self.get_permalink(story)
             
-            existing_story, story_has_changed = self._exists_story(story, story_content, existing_stories)
+            existing_story, story_has_changed = self._exists_story(story, story_content, existing_stories,
+                                                                   dedup=dedup)
             if existing_story is None:
                 if settings.DEBUG and False:
                     logging.debug('   ---> New story in feed (%s - %s): %s' % (self.feed_title, story.get('title'), len(story_content)))
@@ -899,81 +866,114 @@ class Feed(models.Model):
                        story_guid = story.get('guid'),
                        story_tags = story_tags
                 )
-                try:
-                    s.save()
-                    ret_values['new'] += 1
-                except (IntegrityError, OperationError), e:
-                    ret_values['error'] += 1
-                    if settings.DEBUG:
-                        logging.info('   ---> [%-30s] ~SN~FRIntegrityError on new story: %s - %s' % (self.feed_title[:30], story.get('guid'), e))
+                new_stories.append(s)
             elif existing_story and story_has_changed:
-                # update story
-                original_content = None
-                try:
-                    if existing_story and existing_story.id:
-                        try:
-                            existing_story = MStory.objects.get(id=existing_story.id)
-                        except ValidationError:
-                            existing_story, _ = MStory.find_story(existing_story.story_feed_id,
-                                                                  existing_story.id,
-                                                                  original_only=True)
-                    elif existing_story and existing_story.story_guid:
+                updated_stories.append((existing_story, story, story_content, story_tags, story_link))
+            else:
+                ret_values['same'] += 1
+                # logging.debug("Unchanged story: %s " % story.get('title'))
+        
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline()
+        
+        if new_stories:
+            try:
+                inserted_stories = MStory.bulk_insert(new_stories, r=p)
+            except (IntegrityError, OperationError, pymongo.errors.OperationFailure), e:
+                inserted_stories = []
+                logging.info('   ---> [%-30s] ~SN~FRError inserting %s new stories: %s' % (self.feed_title[:30], len(new_stories), e))
+            ret_values['new'] += len(inserted_stories)
+            ret_values['new_story_hashes'] = [inserted_story.story_hash for inserted_story in inserted_stories]
+            stat_deltas = RFeedStatistics.count_stories(inserted_stories, stat_deltas)
+            ret_values['error'] += len(new_stories) - len(inserted_stories)
+            if settings.DEBUG and len(inserted_stories) < len(new_stories):
+                inserted_guids = set(s.story_guid for s in inserted_stories)
+                for s in new_stories:
+                    if s.story_guid not in inserted_guids:
+                        logging.info('   ---> [%-30s] ~SN~FRIntegrityError on new story: %s - %s' % (self.feed_title[:30], s.story_guid, s.story_hash))
+        
+        # Reload every changed story with a single query instead of one get() each.
+        story_ids = [updated_story.id for updated_story, _, _, _, _ in updated_stories
+                     if isinstance(updated_story.id, ObjectId)]
+        reloaded_stories = {}
+        if story_ids:
+            reloaded_stories = dict((s.id, s) for s in MStory.objects(id__in=story_ids))
+        
+        for existing_story, story, story_content, story_tags, story_link in updated_stories:
+            # update story
+            original_content = None
+            try:
+                if existing_story and existing_story.id:
+                    if existing_story.id in reloaded_stories:
+                        existing_story = reloaded_stories[existing_story.id]
+                    else:
                         existing_story, _ = MStory.find_story(existing_story.story_feed_id,
-                                                              existing_story.story_guid,
+                                                              existing_story.id,
                                                               original_only=True)
-                    else:
-                        raise MStory.DoesNotExist
-                except (MStory.DoesNotExist, OperationError), e:
-                    ret_values['error'] += 1
-                    if verbose:
-                        logging.info('   ---> [%-30s] ~SN~FROperation on existing story: %s - %s' % (self.feed_title[:30], story.get('guid'), e))
-                    continue
-                if existing_story.story_original_content_z:
-                    original_content = zlib.decompress(existing_story.story_original_content_z)
-                elif existing_story.story_content_z:
-                    original_content = zlib.decompress(existing_story.story_content_z)
-                # print 'Type: %s %s' % (type(original_content), type(story_content))
-                if story_content and len(story_content) > 10:
-                    story_content_diff = htmldiff(unicode(original_content), unicode(story_content))
+                elif existing_story and existing_story.story_guid:
+                    existing_story, _ = MStory.find_story(existing_story.story_feed_id,
+                                                          existing_story.story_guid,
+                                                          original_only=True)
                 else:
-                    story_content_diff = original_content
-                # logging.debug("\t\tDiff: %s %s %s" % diff.getStats())
-                # logging.debug("\t\tDiff content: %s" % diff.getDiff())
-                # if existing_story.story_title != story.get('title'):
-                #    logging.debug('\tExisting title / New: : \n\t\t- %s\n\t\t- %s' % (existing_story.story_title, story.get('title')))
-                if existing_story.story_guid != story.get('guid'):
-                    self.update_story_with_new_guid(existing_story, story.get('guid'))
-
-                if settings.DEBUG and False:
-                    logging.debug('- Updated story in feed (%s - %s): %s / %s' % (self.feed_title, story.get('title'), len(story_content_diff), len(story_content)))
-                
-                existing_story.story_feed = self.pk
-                existing_story.story_title = story.get('title')
-                existing_story.story_content = story_content_diff
-                existing_story.story_latest_content = story_content
-                existing_story.story_original_content = original_content
-                existing_story.story_author_name = story.get('author')
-                existing_story.story_permalink = story_link
-                existing_story.story_guid = story.get('guid')
-                existing_story.story_tags = story_tags
-                # Do not allow publishers to change the story date once a story is published.
-                # Leads to incorrect unread story counts.
-                # existing_story.story_date = story.get('published') # No, don't
-                
-                try:
-                    existing_story.save()
-                    ret_values['updated'] += 1
-                except (IntegrityError, OperationError):
-                    ret_values['error'] += 1
-                    if verbose:
-                        logging.info('   ---> [%-30s] ~SN~FRIntegrityError on updated story: %s' % (self.feed_title[:30], story.get('title')[:30]))
-                except ValidationError:
-                    ret_values['error'] += 1
-                    if verbose:
-                        logging.info('   ---> [%-30s] ~SN~FRValidationError on updated story: %s' % (self.feed_title[:30], story.get('title')[:30]))
+                    raise MStory.DoesNotExist
+                if not existing_story:
+                    raise MStory.DoesNotExist
+            except (MStory.DoesNotExist, OperationError), e:
+                ret_values['error'] += 1
+                if verbose:
+                    logging.info('   ---> [%-30s] ~SN~FROperation on existing story: %s - %s' % (self.feed_title[:30], story.get('guid'), e))
+                continue
+            if existing_story.story_original_content_z:
+                original_content = zlib.decompress(existing_story.story_original_content_z)
+            elif existing_story.story_content_z:
+                original_content = zlib.decompress(existing_story.story_content_z)
+            # print 'Type: %s %s' % (type(original_content), type(story_content))
+            if story_content and len(story_content) > 10:
+                story_content_diff = htmldiff(unicode(original_content), unicode(story_content))
             else:
-                ret_values['same'] += 1
-                # logging.debug("Unchanged story: %s " % story.get('title'))
+                story_content_diff = original_content
+            # logging.debug("\t\tDiff: %s %s %s" % diff.getStats())
+            # logging.debug("\t\tDiff content: %s" % diff.getDiff())
+            # if existing_story.story_title != story.get('title'):
+            #    logging.debug('\tExisting title / New: : \n\t\t- %s\n\t\t- %s' % (existing_story.story_title, story.get('title')))
+            if existing_story.story_guid != story.get('guid'):
+                self.update_story_with_new_guid(existing_story, story.get('guid'))
+
+            if settings.DEBUG and False:
+                logging.debug('- Updated story in feed (%s - %s): %s / %s' % (self.feed_title, story.get('title'), len(story_content_diff), len(story_content)))
+            
+            old_story = MStory(story_tags=existing_story.story_tags,
+                               story_author_name=existing_story.story_author_name)
+            existing_story.story_feed = self.pk
+            existing_story.story_title = story.get('title')
+            existing_story.story_content = story_content_diff
+            existing_story.story_latest_content = story_content
+            existing_story.story_original_content = original_content
+            existing_story.story_author_name = story.get('author')
+            existing_story.story_permalink = story_link
+            existing_story.story_guid = story.get('guid')
+            existing_story.story_tags = story_tags
+            # Do not allow publishers to change the story date once a story is published.
+            # Leads to incorrect unread story counts.
+            # existing_story.story_date = story.get('published') # No, don't
+            
+            try:
+                existing_story.save(r=p)
+                ret_values['updated'] += 1
+                stat_deltas = RFeedStatistics.count_stories([old_story], stat_deltas, sign=-1, months=False)
+                stat_deltas = RFeedStatistics.count_stories([existing_story], stat_deltas, months=False)
+            except (IntegrityError, OperationError):
+                ret_values['error'] += 1
+                if verbose:
+                    logging.info('   ---> [%-30s] ~SN~FRIntegrityError on updated story: %s' % (self.feed_title[:30], story.get('title')[:30]))
+            except ValidationError:
+                ret_values['error'] += 1
+                if verbose:
+                    logging.info('   ---> [%-30s] ~SN~FRValidationError on updated story: %s' % (self.feed_title[:30], story.get('title')[:30]))
+        
+        p.execute()
+        if stat_deltas:
+            RFeedStatistics.adjust(self.pk, stat_deltas)
         
         return ret_values
     
@@ -982,6 +982,7 @@ class Feed(models.Model):
         from apps.social.models import MSharedStory
 
         existing_story.remove_from_redis()
+        RStoryCache.invalidate([existing_story.story_hash])
         
         old_hash = existing_story.story_hash
         new_hash = RUserStory.story_hash(new_story_guid, self.pk)
@@ -1000,11 +1001,8 @@ class Feed(models.Model):
                 
     def save_popular_tags(self, feed_tags=None, verbose=False):
         if not feed_tags:
-            all_tags = MStory.objects(story_feed_id=self.pk,
-                                      story_tags__exists=True).item_frequencies('story_tags')
-            feed_tags = sorted([(k, v) for k, v in all_tags.items() if int(v) > 0], 
-                               key=itemgetter(1), 
-                               reverse=True)[:25]
+            RFeedStatistics.ensure_backfilled(self)
+            feed_tags = RFeedStatistics.popular(RFeedStatistics.TAGS, self.pk, 25)
         popular_tags = json.encode(feed_tags)
         if verbose:
             print "Found %s tags: %s" % (len(feed_tags), popular_tags)
@@ -1014,8 +1012,9 @@ class Feed(models.Model):
         #       popular tags the size of a small planet. I'm looking at you
         #       Tumblr writers.
         if len(popular_tags) < 1024:
-            self.data.popular_tags = popular_tags
-            self.data.save()
+            if self.data.popular_tags != popular_tags:
+                self.data.popular_tags = popular_tags
+                self.data.save()
             return
 
         tags_list = []
@@ -1026,23 +1025,21 @@ class Feed(models.Model):
     
     def save_popular_authors(self, feed_authors=None):
         if not feed_authors:
-            authors = defaultdict(int)
-            for story in MStory.objects(story_feed_id=self.pk).only('story_author_name'):
-                authors[story.story_author_name] += 1
-            feed_authors = sorted([(k, v) for k, v in authors.items() if k], 
-                               key=itemgetter(1),
-                               reverse=True)[:20]
+            RFeedStatistics.ensure_backfilled(self)
+            feed_authors = RFeedStatistics.popular(RFeedStatistics.AUTHORS, self.pk, 20)
 
         popular_authors = json.encode(feed_authors)
         if len(popular_authors) < 1023:
-            self.data.popular_authors = popular_authors
-            self.data.save()
+            if self.data.popular_authors != popular_authors:
+                self.data.popular_authors = popular_authors
+                self.data.save()
             return
 
         if len(feed_authors) > 1:
             self.save_popular_authors(feed_authors=feed_authors[:-1])
             
-    def trim_feed(self, verbose=False):
+    @property
+    def trim_cutoff(self):
         trim_cutoff = 500
         if self.active_subscribers <= 0:
             trim_cutoff = 25
@@ -1058,29 +1055,64 @@ class Feed(models.Model):
             trim_cutoff = 400
         elif self.num_subscribers <= 200 or self.active_premium_subscribers <= 20:
             trim_cutoff = 450
-            
-        stories = MStory.objects(
-            story_feed_id=self.pk,
-        ).order_by('-story_date')
+        return trim_cutoff
+    
+    def trim_feed(self, verbose=False):
+        """
+        Deletes all but the newest `trim_cutoff` stories. The cutoff date comes from
+        one skip() along the (story_feed_id, -story_date) index, and the stories past
+        it are removed together. Returns how many stories were trimmed.
+        """
+        trim_cutoff = self.trim_cutoff
+        cutoff_story = list(MStory.objects(story_feed_id=self.pk)
+                                  .order_by('-story_date')
+                                  .only('story_date')[trim_cutoff:trim_cutoff+1])
+        if not cutoff_story:
+            return 0
+        story_trim_date = cutoff_story[0].story_date
+        
+        extra_stories = list(MStory.objects(story_feed_id=self.pk, story_date__lte=story_trim_date)
+                                   .only('id', 'story_feed_id', 'story_hash', 'story_date',
+                                         'story_tags', 'story_author_name'))
+        start = time.time()
+        trimmed = MStory.bulk_delete(extra_stories)
+        RFeedStatistics.adjust(self.pk, RFeedStatistics.count_stories(extra_stories, sign=-1, months=False))
+        
+        logging.debug('   ---> [%-30s] ~FBTrimmed ~SB%s~SN stories to ~SB%s~SN in %.3ss' %
+                      (unicode(self)[:30], trimmed, trim_cutoff, time.time() - start))
+        if verbose:
+            existing_story_count = MStory.objects(story_feed_id=self.pk).count()
+            print "Deleted %s stories, %s left." % (trimmed, existing_story_count)
         
-        if stories.count() > trim_cutoff:
-            logging.debug('   ---> [%-30s] ~FBFound %s stories. Trimming to ~SB%s~SN...' %
-                          (unicode(self)[:30], stories.count(), trim_cutoff))
-            try:
-                story_trim_date = stories[trim_cutoff].story_date
-            except IndexError, e:
-                logging.debug(' ***> [%-30s] ~BRError trimming feed: %s' % (unicode(self)[:30], e))
-                return
-                
-            extra_stories = MStory.objects(story_feed_id=self.pk, 
-                                           story_date__lte=story_trim_date)
-            extra_stories_count = extra_stories.count()
-            for story in extra_stories:
-                story.delete()
-            if verbose:
-                existing_story_count = MStory.objects(story_feed_id=self.pk).count()
-                print "Deleted %s stories, %s left." % (extra_stories_count,
-                                                        existing_story_count)
+        return trimmed
+    
+    @classmethod
+    def sweep_trim_feeds(cls, count=500, verbose=False):
+        """
+        Trims the next `count` fetched feeds by primary key, picking up where the
+        last sweep stopped and wrapping around at the end. Feeds with new stories
+        are trimmed as they're fetched; this catches the ones that stopped updating.
+        """
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        last_feed_id = int(r.get('trim_sweep_feed_id') or 0)
+        feeds = list(cls.objects.filter(pk__gt=last_feed_id, fetched_once=True).order_by('pk')[:count])
+        if not feeds:
+            r.set('trim_sweep_feed_id', 0)
+            return 0
+        
+        start = time.time()
+        trimmed = 0
+        for feed in feeds:
+            trimmed += feed.trim_feed(verbose=verbose)
+        duration = time.time() - start
+        r.set('trim_sweep_feed_id', feeds[-1].pk)
+        RStats.add('story_trim', duration=duration, count=trimmed)
+        
+        logging.debug(" ---> ~FBTrim sweep: ~SB%s~SN stories from ~SB%s~SN feeds (%s-%s) in %.2ss, ~SB%.0f~SN stories/s" % (
+                      trimmed, len(feeds), feeds[0].pk, feeds[-1].pk, duration,
+                      trimmed / max(duration, .001)))
+        
+        return trimmed
 
     # @staticmethod
     # def clean_invalid_ids():
@@ -1095,8 +1127,8 @@ class Feed(models.Model):
 
         
     def get_stories(self, offset=0, limit=25, force=False):
-        stories_db = MStory.objects(story_feed_id=self.pk)[offset:offset+limit]
-        stories = self.format_stories(stories_db, self.pk)
+        stories_db = MStory.objects(story_feed_id=self.pk).only('story_hash')[offset:offset+limit]
+        stories = RStoryCache.format_stories([s.story_hash for s in stories_db], feed_id=self.pk)
         
         return stories
     
@@ -1200,87 +1232,60 @@ class Feed(models.Model):
             link = entry.get('id')
         return link
     
-    def _exists_story(self, story=None, story_content=None, existing_stories=None):
-        story_in_system = None
+    def _exists_story(self, story=None, story_content=None, existing_stories=None, dedup=None):
+        if dedup is None:
+            dedup = StoryDedupIndex(existing_stories)
         story_has_changed = False
         story_link = self.get_permalink(story)
-        existing_stories_guids = existing_stories.keys()
-        # story_pub_date = story.get('published')
-        # story_published_now = story.get('published_now', False)
-        # start_date = story_pub_date - datetime.timedelta(hours=8)
-        # end_date = story_pub_date + datetime.timedelta(hours=8)
         
-        for existing_story in existing_stories.values():
-            content_ratio = 0
-            # existing_story_pub_date = existing_story.story_date
-            # print 'Story pub date: %s %s' % (story_published_now, story_pub_date)
-            
-            if 'story_latest_content_z' in existing_story:
-                existing_story_content = unicode(zlib.decompress(existing_story.story_latest_content_z))
-            elif 'story_latest_content' in existing_story:
-                existing_story_content = existing_story.story_latest_content
-            elif 'story_content_z' in existing_story:
-                existing_story_content = unicode(zlib.decompress(existing_story.story_content_z))
-            elif 'story_content' in existing_story:
-                existing_story_content = existing_story.story_content
-            else:
-                existing_story_content = u''
-                
-            if isinstance(existing_story.id, unicode):
-                existing_story.story_guid = existing_story.id
-            if (story.get('guid') in existing_stories_guids and 
-                story.get('guid') != existing_story.story_guid):
+        # A known guid can only ever match its own story, so there's no need to fuzzy match.
+        existing_story = dedup.by_guid.get(story.get('guid'))
+        if existing_story:
+            existing_story_content = dedup.content(existing_story)
+            if story_content != existing_story_content:
+                if settings.DEBUG:
+                    logging.debug(" ---> Content difference - %s/%s" % (story_content, existing_story_content))
+                story_has_changed = True
+            elif story_link != existing_story.story_permalink:
+                if settings.DEBUG:
+                    logging.debug(" ---> Permalink difference - %s/%s" % (story_link, existing_story.story_permalink))
+                story_has_changed = True
+            elif (story.get('title') != existing_story.story_title and
+                  story_content and len(story_content) > 100):
+                if settings.DEBUG:
+                    logging.debug(" ---> Title difference - %s/%s" % (story.get('title'), existing_story.story_title))
+                story_has_changed = True
+            return existing_story, story_has_changed
+        
+        # Stories with an unknown guid only match on (nearly) identical content.
+        if not story_content or len(story_content) <= 100:
+            return None, False
+        
+        matches = dedup.find_by_content_hash(MStory.content_hash(story_content))
+        if matches:
+            return matches[0], True
+        
+        existing_story = dedup.find_by_permalink(story_link)
+        if existing_story:
+            if settings.DEBUG:
+                logging.debug(" ---> Permalink match - %s/%s" % (story.get('title'), existing_story.story_title))
+            return existing_story, True
+        
+        for existing_story in dedup.stories:
+            existing_story_content = dedup.content(existing_story)
+            if not existing_story_content:
+                continue
+            # Same bound as SequenceMatcher.real_quick_ratio(), without building the matcher.
+            if 2.0 * min(len(story_content), len(existing_story_content)) / (
+               len(story_content) + len(existing_story_content)) <= .9:
                 continue
-            elif story.get('guid') == existing_story.story_guid:
-                story_in_system = existing_story
-            
-            # Title distance + content distance, checking if story changed
-            story_title_difference = abs(levenshtein_distance(story.get('title'),
-                                                              existing_story.story_title))
-            
             seq = difflib.SequenceMatcher(None, story_content, existing_story_content)
-            
-            if (seq
-                and story_content
-                and len(story_content) > 100
-                and existing_story_content
-                and seq.real_quick_ratio() > .9 
-                and seq.quick_ratio() > .95):
-                content_ratio = seq.ratio()
-                
-            if story_title_difference > 0 and content_ratio > .98:
-                story_in_system = existing_story
-                if story_title_difference > 0 or content_ratio < 1.0:
-                    if settings.DEBUG:
-                        logging.debug(" ---> Title difference - %s/%s (%s): %s" % (story.get('title'), existing_story.story_title, story_title_difference, content_ratio))
-                    story_has_changed = True
-                    break
-            
-            # More restrictive content distance, still no story match
-            if not story_in_system and content_ratio > .98:
+            if seq.quick_ratio() > .95 and seq.ratio() > .98:
                 if settings.DEBUG:
-                    logging.debug(" ---> Content difference - %s/%s (%s): %s" % (story.get('title'), existing_story.story_title, story_title_difference, content_ratio))
-                story_in_system = existing_story
-                story_has_changed = True
-                break
-                
-            if story_in_system and not story_has_changed:
-                if story_content != existing_story_content:
-                    if settings.DEBUG:
-                        logging.debug(" ---> Content difference - %s/%s" % (story_content, existing_story_content))
-                    story_has_changed = True
-                if story_link != existing_story.story_permalink:
-                    if settings.DEBUG:
-                        logging.debug(" ---> Permalink difference - %s/%s" % (story_link, existing_story.story_permalink))
-                    story_has_changed = True
-                # if story_pub_date != existing_story.story_date:
-                #     story_has_changed = True
-                break
-                
+                    logging.debug(" ---> Content difference - %s/%s" % (story.get('title'), existing_story.story_title))
+                return existing_story, True
         
-        # if story_has_changed or not story_in_system:
-        #     print 'New/updated story: %s' % (story), 
-        return story_in_system, story_has_changed
+        return None, False
         
     def get_next_scheduled_update(self, force=False, verbose=True):
         if self.min_to_decay and not force:
@@ -1357,19 +1362,33 @@ class Feed(models.Model):
                               '~SB%s errors. Time: %s min' % (
                               unicode(self)[:30], self.errors_since_good, total))
         
+        now = datetime.datetime.utcnow()
         random_factor = random.randint(0, total) / 4
-        next_scheduled_update = datetime.datetime.utcnow() + datetime.timedelta(
-                                minutes = total + random_factor)
+        minutes = total + random_factor
+        
+        # Push feeds and failing feeds keep their flat interval and backoff.
+        if not self.is_push and not error_count:
+            profile = MFeedPublishProfile.get_for_feed(self, now=now)
+            if profile:
+                minutes = MFeedPublishProfile.next_fetch_minutes(profile.hours, now, total)
+                minutes += random.randint(0, max(1, minutes / 10))
+                if verbose:
+                    logging.debug('   ---> [%-30s] ~FBScheduling feed fetch by publish profile: '
+                                  '~SB%s min~SN (budget: %s min)' % (unicode(self)[:30], minutes, total))
+        next_scheduled_update = now + datetime.timedelta(minutes=minutes)
         
         self.min_to_decay = total
         delta = self.next_scheduled_update - datetime.datetime.now()
         minutes_to_next_fetch = delta.total_seconds() / 60
         if minutes_to_next_fetch > self.min_to_decay or not skip_scheduling:
             self.next_scheduled_update = next_scheduled_update
+            p = r.pipeline()
             if self.active_subscribers >= 1:
-                r.zadd('scheduled_updates', self.pk, self.next_scheduled_update.strftime('%s'))
-            r.zrem('tasked_feeds', self.pk)
-            r.srem('queued_feeds', self.pk)
+                p.zadd('scheduled_updates', self.pk, self.next_scheduled_update.strftime('%s'))
+                FeedScheduler.remember_feed(p, self)
+            p.zrem('tasked_feeds', self.pk)
+            p.zrem('queued_feeds', self.pk)
+            p.execute()
             
         self.save()
         
@@ -1387,7 +1406,10 @@ class Feed(models.Model):
             logging.debug('   ---> [%-30s] Scheduling feed fetch immediately...' % (unicode(self)[:30]))
             
         self.next_scheduled_update = datetime.datetime.utcnow()
-        r.zadd('scheduled_updates', self.pk, self.next_scheduled_update.strftime('%s'))
+        p = r.pipeline()
+        p.zadd('scheduled_updates', self.pk, self.next_scheduled_update.strftime('%s'))
+        FeedScheduler.remember_feed(p, self)
+        p.execute()
 
         return self.save()
         
@@ -1446,6 +1468,68 @@ class Feed(models.Model):
     #     
     #     return phrases
 
+class StoryDedupIndex(object):
+    """
+    The existing stories a fetch is compared against, indexed once per fetch so
+    that `Feed._exists_story` can match on guid, content hash and permalink before
+    falling back to fuzzy matching. Decompressed content is cached per story.
+    """
+    
+    def __init__(self, existing_stories, incoming_guids=None):
+        self.stories = []
+        self.by_guid = {}
+        self.by_content_hash = defaultdict(list)
+        self.by_permalink = defaultdict(list)
+        self.incoming_guids = set(incoming_guids or [])
+        self.contents = {}
+        self.unhashed_stories = []
+        
+        for existing_story in existing_stories.values():
+            if isinstance(existing_story.id, unicode):
+                existing_story.story_guid = existing_story.id
+            self.stories.append(existing_story)
+            self.by_guid[existing_story.story_guid] = existing_story
+            if existing_story.story_permalink:
+                self.by_permalink[existing_story.story_permalink].append(existing_story)
+            if existing_story.story_content_hash:
+                self.by_content_hash[existing_story.story_content_hash].append(existing_story)
+            else:
+                self.unhashed_stories.append(existing_story)
+    
+    def content(self, existing_story):
+        key = id(existing_story)
+        if key not in self.contents:
+            if 'story_latest_content_z' in existing_story:
+                content = unicode(zlib.decompress(existing_story.story_latest_content_z))
+            elif 'story_latest_content' in existing_story:
+                content = existing_story.story_latest_content
+            elif 'story_content_z' in existing_story:
+                content = unicode(zlib.decompress(existing_story.story_content_z))
+            elif 'story_content' in existing_story:
+                content = existing_story.story_content
+            else:
+                content = u''
+            self.contents[key] = content
+        return self.contents[key]
+    
+    def find_by_content_hash(self, content_hash):
+        # Stories saved before story_content_hash existed are hashed on first use.
+        while self.unhashed_stories:
+            existing_story = self.unhashed_stories.pop()
+            content = self.content(existing_story)
+            if content:
+                self.by_content_hash[MStory.content_hash(content)].append(existing_story)
+        return self.by_content_hash.get(content_hash)
+    
+    def find_by_permalink(self, permalink):
+        # Only trust a permalink that points at exactly one story, and only if that
+        # story isn't still in the feed under its own guid.
+        existing_stories = self.by_permalink.get(permalink)
+        if (permalink and existing_stories and len(existing_stories) == 1 and
+            existing_stories[0].story_guid not in self.incoming_guids):
+            return existing_stories[0]
+
+
 # class FeedCollocations(models.Model):
 #     feed = models.ForeignKey(Feed)
 #     phrase = models.CharField(max_length=500)
@@ -1474,12 +1558,22 @@ class MFeedIcon(mongo.Document):
     data          = mongo.StringField()
     icon_url      = mongo.StringField()
     not_found     = mongo.BooleanField(default=False)
+    content_hash  = mongo.StringField()
     
     meta = {
         'collection'        : 'feed_icons',
         'allow_inheritance' : False,
+        'indexes'           : [{'fields': ['content_hash'], 'sparse': True}],
     }
     
+    @classmethod
+    def processed_icons(cls, content_hashes):
+        """ Maps each content hash already seen on some feed's icon to its (color, data). """
+        if not content_hashes: return {}
+        icons = cls.objects(content_hash__in=content_hashes, not_found=False)\
+                   .only('content_hash', 'color', 'data')
+        return dict((icon.content_hash, (icon.color, icon.data)) for icon in icons if icon.data)
+    
     def save(self, *args, **kwargs):
         if self.icon_url:
             self.icon_url = unicode(self.icon_url)
@@ -1525,6 +1619,112 @@ class MFeedPage(mongo.Document):
 
         return data
 
+class MFeedPublishProfile(mongo.Document):
+    """
+    When a feed publishes, as a share of its stories for each of the 168 hours of
+    the week (UTC), learned from the dates of its recent stories. Feeds are then
+    polled densest in the hours they publish most, with the same number of fetches
+    per week that get_next_scheduled_update would have spent on them.
+    """
+    feed_id      = mongo.IntField(primary_key=True)
+    hours        = mongo.ListField(mongo.FloatField())
+    story_count  = mongo.IntField()
+    updated_date = mongo.DateTimeField()
+    
+    meta = {
+        'collection': 'feed_publish_profiles',
+        'allow_inheritance': False,
+    }
+    
+    HOURS_IN_WEEK   = 7 * 24
+    HISTORY_WEEKS   = 8
+    HALF_LIFE_WEEKS = 4
+    MIN_STORIES     = 10
+    SMOOTHING       = .1
+    MAX_AGE         = datetime.timedelta(days=1)
+    
+    @classmethod
+    def hour_of_week(cls, date):
+        return date.weekday() * 24 + date.hour
+    
+    @classmethod
+    def shape_from_dates(cls, story_dates, now, weekly_rate=0):
+        """
+        Share of stories per hour of the week, weighting recent weeks more heavily
+        and blending in a flat profile so a quiet hour is never treated as dead.
+        `weekly_rate` (from story_count_history) covers feeds whose trimmed story
+        history undercounts them. Returns None if there is too little to go on.
+        """
+        counts = [0.0] * cls.HOURS_IN_WEEK
+        total = 0.0
+        for story_date in story_dates:
+            age_weeks = max(0, (now - story_date).total_seconds()) / (7 * 24 * 60 * 60)
+            weight = .5 ** (age_weeks / cls.HALF_LIFE_WEEKS)
+            counts[cls.hour_of_week(story_date)] += weight
+            total += weight
+        if len(story_dates) < cls.MIN_STORIES or not total:
+            return None
+        
+        weekly_rate = max(weekly_rate, len(story_dates) / float(cls.HISTORY_WEEKS))
+        smoothing = max(cls.SMOOTHING, 1.0 / weekly_rate)
+        flat = 1.0 / cls.HOURS_IN_WEEK
+        return [(1 - smoothing) * count / total + smoothing * flat for count in counts]
+    
+    @classmethod
+    def next_fetch_minutes(cls, hours, now, interval):
+        """
+        Minutes until the next fetch. Stories that arrive at rate r(h) are picked up
+        with the least expected delay for a fixed fetch budget when fetches are spread
+        in proportion to sqrt(r(h)), so walk forward from `now` through that fetch
+        density until one fetch's worth has accumulated. The budget is one fetch per
+        `interval` minutes, and the answer is kept within 4x of `interval` either way.
+        """
+        density = [math.sqrt(share) for share in hours]
+        fetches_per_hour = 60.0 * len(density) / interval / sum(density)
+        
+        min_minutes = max(5, interval / 4.0)
+        max_minutes = min(interval * 4.0, 60*24*3)
+        hour = cls.hour_of_week(now)
+        minutes = 0.0
+        needed = 1.0
+        available = 60 - now.minute
+        while minutes < max_minutes:
+            rate = fetches_per_hour * density[hour] / 60.0
+            if rate * available >= needed:
+                minutes += needed / rate
+                break
+            needed -= rate * available
+            minutes += available
+            hour = (hour + 1) % len(density)
+            available = 60
+        
+        return int(min(max(minutes, min_minutes), max_minutes))
+    
+    @classmethod
+    def get_for_feed(cls, feed, now=None):
+        if not now:
+            now = datetime.datetime.utcnow()
+        try:
+            profile = cls.objects.get(feed_id=feed.pk)
+        except cls.DoesNotExist:
+            profile = cls(feed_id=feed.pk)
+        
+        if not profile.updated_date or now - profile.updated_date > cls.MAX_AGE:
+            history_start = now - datetime.timedelta(weeks=cls.HISTORY_WEEKS)
+            story_dates = [s.story_date for s in MStory.objects(story_feed_id=feed.pk,
+                                                                story_date__gte=history_start)
+                                                       .only('story_date')]
+            weekly_rate = feed.average_stories_per_month * 7 / 30.0
+            profile.hours = cls.shape_from_dates(story_dates, now, weekly_rate=weekly_rate) or []
+            profile.story_count = len(story_dates)
+            profile.updated_date = now
+            profile.save()
+        
+        if not profile.hours:
+            return None
+        return profile
+        
+
 class MStory(mongo.Document):
     '''A feed item'''
     story_feed_id            = mongo.IntField()
@@ -1542,6 +1742,7 @@ class MStory(mongo.Document):
     story_permalink          = mongo.StringField()
     story_guid               = mongo.StringField()
     story_hash               = mongo.StringField()
+    story_content_hash       = mongo.StringField()
     story_tags               = mongo.ListField(mongo.StringField(max_length=250))
     comment_count            = mongo.IntField()
     comment_user_ids         = mongo.ListField(mongo.IntField())
@@ -1568,11 +1769,31 @@ class MStory(mongo.Document):
     def feed_guid_hash(self):
         return "%s:%s" % (self.story_feed_id, self.guid_hash)
     
+    @staticmethod
+    def content_hash(content):
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        return hashlib.sha1(content).hexdigest()
+    
     def save(self, *args, **kwargs):
+        r = kwargs.pop('r', None)
+        self.prepare_for_save()
+        
+        super(MStory, self).save(*args, **kwargs)
+        
+        self.sync_redis(r=r)
+        RStoryCache.invalidate([self.story_hash])
+        
+        return self
+    
+    def prepare_for_save(self):
         story_title_max = MStory._fields['story_title'].max_length
         story_content_type_max = MStory._fields['story_content_type'].max_length
         self.story_hash = self.feed_guid_hash
         
+        latest_content = self.story_latest_content or self.story_content
+        if latest_content:
+            self.story_content_hash = self.content_hash(latest_content)
         if self.story_content:
             self.story_content_z = zlib.compress(self.story_content)
             self.story_content = None
@@ -1586,15 +1807,79 @@ class MStory(mongo.Document):
             self.story_title = self.story_title[:story_title_max]
         if self.story_content_type and len(self.story_content_type) > story_content_type_max:
             self.story_content_type = self.story_content_type[:story_content_type_max]
+    
+    @classmethod
+    def bulk_insert(cls, stories, r=None):
+        """
+        Inserts many new stories with a single Mongo insert. Stories that don't
+        validate, or whose story_hash is already taken, either in the database or
+        earlier in the batch, are not inserted. Returns the stories that made it in, already synced to redis (or
+        queued on `r` if it's a pipeline).
+        """
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
         
-        super(MStory, self).save(*args, **kwargs)
+        candidates = {}
+        for story in stories:
+            story.prepare_for_save()
+            # The raw insert below skips the validation save() would have done.
+            try:
+                story.validate()
+            except ValidationError, e:
+                logging.debug('   ---> ~SN~FRValidationError on new story: %s - %s' % (story.story_hash, e))
+                continue
+            if story.story_hash not in candidates:
+                candidates[story.story_hash] = story
+        existing_hashes = set(s.story_hash for s in cls.objects(story_hash__in=candidates.keys())
+                                                         .only('story_hash'))
+        stories = [story for story_hash, story in candidates.items()
+                   if story_hash not in existing_hashes]
+        if not stories:
+            return []
         
-        self.sync_redis()
+        for story in stories:
+            story.id = ObjectId()
+        try:
+            cls._get_collection().insert([story.to_mongo() for story in stories],
+                                         safe=True, continue_on_error=True)
+        except pymongo.errors.DuplicateKeyError:
+            # Lost a race with another fetch. Keep only what actually got inserted.
+            inserted_ids = set(s.id for s in cls.objects(id__in=[story.id for story in stories])
+                                                .only('id'))
+            stories = [story for story in stories if story.id in inserted_ids]
         
-        return self
+        for story in stories:
+            story.sync_redis(r=r)
+        
+        return stories
+    
+    @classmethod
+    def bulk_delete(cls, stories, chunk_size=1000):
+        """
+        Deletes many stories with one Mongo remove and one redis pipeline per chunk,
+        instead of three round trips per story. Only id, story_feed_id and
+        story_hash need to be loaded. Returns how many were deleted.
+        """
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        collection = cls._get_collection()
+        for i in xrange(0, len(stories), chunk_size):
+            chunk = stories[i:i+chunk_size]
+            story_hashes = defaultdict(list)
+            for story in chunk:
+                story_hashes[story.story_feed_id].append(story.story_hash)
+            p = r.pipeline()
+            for story_feed_id, hashes in story_hashes.items():
+                p.srem('F:%s' % story_feed_id, *hashes)
+                p.zrem('zF:%s' % story_feed_id, *hashes)
+            p.execute()
+            RStoryCache.invalidate([story.story_hash for story in chunk])
+            collection.remove({'_id': {'$in': [story.id for story in chunk]}}, safe=True)
+        
+        return len(stories)
     
     def delete(self, *args, **kwargs):
         self.remove_from_redis()
+        RStoryCache.invalidate([self.story_hash])
         
         super(MStory, self).delete(*args, **kwargs)
     
@@ -1702,12 +1987,15 @@ class MStory(mongo.Document):
         self.share_user_ids = [s['user_id'] for s in shares]
         self.save()
         
-    def fetch_original_text(self, force=False, request=None):
+        if self.share_count >= ROriginalText.PREFETCH_SHARES:
+            ROriginalText.prefetch([self])
+        
+    def fetch_original_text(self, force=False, request=None, timeout=None):
         original_text_z = self.original_text_z
         
         if not original_text_z or force:
-            ti = TextImporter(self, request=request)
-            original_text = ti.fetch()
+            original_text = ROriginalText.fetch_story(self, force=force, request=request,
+                                                      timeout=timeout)
         else:
             logging.user(request, "~FYFetching ~FGoriginal~FY story text, ~SBfound.")
             original_text = zlib.decompress(original_text_z)
@@ -1774,12 +2062,12 @@ class MStarredStory(mongo.Document):
     def feed_guid_hash(self):
         return "%s:%s" % (self.story_feed_id or "0", self.guid_hash)
     
-    def fetch_original_text(self, force=False, request=None):
+    def fetch_original_text(self, force=False, request=None, timeout=None):
         original_text_z = self.original_text_z
         
         if not original_text_z or force:
-            ti = TextImporter(self, request=request)
-            original_text = ti.fetch()
+            original_text = ROriginalText.fetch_story(self, force=force, request=request,
+                                                      timeout=timeout)
         else:
             logging.user(request, "~FYFetching ~FGoriginal~FY story text, ~SBfound.")
             original_text = zlib.decompress(original_text_z)
@@ -1996,7 +2284,7 @@ def merge_feeds(original_feed_id, duplicate_feed_id, force=False):
         logging.debug(" ***> Duplicate feed is the same as original feed. Panic!")
     logging.debug(' ---> Deleted duplicate feed: %s/%s' % (duplicate_feed, duplicate_feed_id))
     original_feed.branch_from_feed = None
-    original_feed.count_subscribers()
+    original_feed.count_subscribers(recount=True)
     original_feed.save()
     logging.debug(' ---> Now original subscribers: %s' %
                   (original_feed.num_subscribers))
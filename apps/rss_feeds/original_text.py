@@ -0,0 +1,167 @@
+import hashlib
+import time
+import zlib
+import redis
+from django.conf import settings
+from utils import log as logging
+
+
+class ROriginalText(object):
+    """
+    Original story text, extracted by the `fetch-original-text` task on its own
+    worker pool instead of inside the web request. Results are cached by permalink,
+    since the same article is often shared or syndicated under several stories:
+    
+        OT:<sha1(permalink)>    zlib(text), or '' when extraction failed
+        OTL:<story_hash>        set while a fetch is queued or running
+    
+    The lock coalesces requests: however many readers open a story at once, only
+    the first queues a fetch and the rest wait on the same cached result. Failed
+    extractions are cached for a shorter time so they're retried eventually but
+    not on every click.
+    """
+    
+    TTL        = 60 * 60 * 24 * 7
+    FAILED_TTL = 60 * 60
+    LOCK_TTL   = 60 * 5
+    WAIT       = 5
+    POLL       = 0.25
+    
+    # Stories worth extracting before anybody asks for them.
+    PREFETCH_SUBSCRIBERS = 100
+    PREFETCH_SHARES      = 3
+    
+    @classmethod
+    def redis(cls):
+        return redis.Redis(connection_pool=settings.REDIS_STORY_CACHE_POOL)
+    
+    @staticmethod
+    def key(permalink):
+        if isinstance(permalink, unicode):
+            permalink = permalink.encode('utf-8')
+        return "OT:%s" % hashlib.sha1(permalink).hexdigest()
+    
+    @staticmethod
+    def lock_key(story_hash):
+        return "OTL:%s" % story_hash
+    
+    @classmethod
+    def get(cls, permalink, r=None):
+        """ Returns (found, text), where text is None for a cached failure. """
+        data = (r or cls.redis()).get(cls.key(permalink))
+        if data is None:
+            return False, None
+        if not data:
+            return True, None
+        return True, zlib.decompress(data).decode('utf-8')
+    
+    @classmethod
+    def set(cls, permalink, text, r=None):
+        r = r or cls.redis()
+        if text:
+            r.setex(cls.key(permalink), zlib.compress(text.encode('utf-8')), cls.TTL)
+        else:
+            r.setex(cls.key(permalink), '', cls.FAILED_TTL)
+    
+    @classmethod
+    def is_fetching(cls, story_hash):
+        return cls.redis().exists(cls.lock_key(story_hash))
+    
+    @classmethod
+    def request(cls, story, force=False):
+        """
+        Queues a fetch of the story's original text, unless one is already queued
+        or running. Returns whether this call queued it.
+        """
+        from apps.rss_feeds.tasks import FetchOriginalText
+        if not story.story_permalink: return False
+        r = cls.redis()
+        if force:
+            r.delete(cls.key(story.story_permalink))
+        if not r.setnx(cls.lock_key(story.story_hash), 1):
+            return False
+        r.expire(cls.lock_key(story.story_hash), cls.LOCK_TTL)
+        FetchOriginalText.apply_async(args=(story.story_hash, story.story_permalink))
+        return True
+    
+    @classmethod
+    def wait(cls, permalink, timeout=None):
+        """ Polls for a fetch to finish, for at most `timeout` seconds. Returns (found, text). """
+        timeout = cls.WAIT if timeout is None else timeout
+        r = cls.redis()
+        give_up = time.time() + timeout
+        while True:
+            found, text = cls.get(permalink, r=r)
+            if found or time.time() >= give_up:
+                return found, text
+            time.sleep(cls.POLL)
+    
+    @classmethod
+    def extract(cls, story_hash, permalink):
+        """ Runs on the original text workers: extracts, caches, and releases the lock. """
+        from apps.rss_feeds.text_importer import TextImporter
+        start = time.time()
+        try:
+            text = TextImporter(story_url=permalink).extract()
+            cls.set(permalink, text)
+        finally:
+            cls.redis().delete(cls.lock_key(story_hash))
+        logging.debug("   ---> ~FYExtracted ~FGoriginal text~FY: %s~SB%s~SN bytes in ~FM%.4ss~FY from %s" % (
+                      '' if text else '~FRfailed, ', len(text or ''), time.time() - start, permalink[:60]))
+        return text
+    
+    @classmethod
+    def fetch_story(cls, story, force=False, request=None, timeout=None):
+        """
+        Returns the story's original text from the cache, or queues a fetch and
+        waits up to `timeout` seconds for it, saving the text on the story. Returns
+        None if extraction failed or hasn't finished yet; `is_fetching` tells which.
+        """
+        found, text = (False, None) if force else cls.get(story.story_permalink)
+        if not found:
+            cls.request(story, force=force)
+            found, text = cls.wait(story.story_permalink, timeout=timeout)
+        
+        if not found:
+            logging.user(request, "~FYFetching ~FGoriginal~FY story text, ~SBstill extracting.")
+        elif text:
+            story.original_text_z = zlib.compress(text.encode('utf-8'))
+            story.save()
+            logging.user(request, "~SN~FYFetched ~FGoriginal text~FY: now ~SB%s bytes~SN vs. was ~SB%s bytes" % (
+                len(text),
+                story.story_content_z and len(zlib.decompress(story.story_content_z))
+            ))
+        else:
+            logging.user(request, "~SN~FRFailed~FY to fetch ~FGoriginal text~FY: was ~SB%s bytes" % (
+                story.story_content_z and len(zlib.decompress(story.story_content_z))
+            ))
+        
+        return text
+    
+    @classmethod
+    def prefetch(cls, stories):
+        """ Queues fetches for stories that haven't been extracted or cached yet. """
+        r = cls.redis()
+        stories = [s for s in stories if s.story_permalink and not s.original_text_z]
+        if not stories: return 0
+        p = r.pipeline()
+        for story in stories:
+            p.exists(cls.key(story.story_permalink))
+        queued = 0
+        for story, cached in zip(stories, p.execute()):
+            if not cached and cls.request(story):
+                queued += 1
+        return queued
+    
+    @classmethod
+    def prefetch_new_stories(cls, feed, story_hashes):
+        """ Extracts new stories ahead of time for feeds with many active readers. """
+        from apps.rss_feeds.models import MStory
+        if not story_hashes or feed.active_subscribers < cls.PREFETCH_SUBSCRIBERS: return 0
+        stories = MStory.objects(story_hash__in=story_hashes).only('story_hash', 'story_permalink',
+                                                                  'original_text_z')
+        queued = cls.prefetch(stories)
+        if queued:
+            logging.debug("   ---> [%-30s] ~FYPrefetching ~FGoriginal text~FY of ~SB%s~SN new stories" % (
+                          feed.title[:30], queued))
+        return queued
@@ -1,11 +1,15 @@
 import requests
 import re
+import os
 import urlparse
 import traceback
 import feedparser
+import hashlib
 import time
 import urllib2
 import httplib
+import redis
+from requests.adapters import HTTPAdapter
 from socket import error as SocketError
 from boto.s3.key import Key
 from django.conf import settings
@@ -34,10 +38,39 @@ BROKEN_PAGE_URLS = [
     'rankexploits',
 ]
 
+HEAD_RE = re.compile(r'<head(\s[^>]*)?>', re.I)
+
+_sessions = {}
+
+def page_session():
+    """
+    A keep-alive requests session shared by every page fetch in this process.
+    Keyed by pid so forked fetcher processes never share sockets.
+    """
+    pid = os.getpid()
+    if pid not in _sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=50, pool_maxsize=4)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sessions[pid] = session
+    return _sessions[pid]
+
+
 class PageImporter(object):
+    """
+    Fetches a feed's original page and stores it on the node page server, S3 or
+    in Mongo. Each page's ETag, Last-Modified and content hash are kept in the
+    `FP:<feed_id>` redis hash, so unchanged pages are asked for conditionally and,
+    if the server sends them anyway, aren't stored again.
+    """
+    
+    CHUNK_SIZE        = 16 * 1024
+    HEAD_SEARCH_BYTES = 64 * 1024
     
     def __init__(self, feed):
         self.feed = feed
+        self.max_bytes = settings.ORIGINAL_PAGE_MAX_BYTES
         
     @property
     def headers(self):
@@ -50,12 +83,24 @@ class PageImporter(object):
                 's' if self.feed.num_subscribers != 1 else '',
                 settings.NEWSBLUR_URL
             ),
-            'Connection': 'close',
         }
     
+    @property
+    def validators_key(self):
+        return "FP:%s" % self.feed.pk
+    
+    def conditional_headers(self, validators):
+        headers = self.headers
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('modified'):
+            headers['If-Modified-Since'] = validators['modified']
+        return headers
+    
     @timelimit(15)
-    def fetch_page(self, urllib_fallback=False, requests_exception=None):
+    def fetch_page(self):
         html = None
+        start = time.time()
         feed_link = self.feed.feed_link
         if not feed_link:
             self.save_no_page()
@@ -71,52 +116,74 @@ class PageImporter(object):
                 self.save_no_page()
                 return
             elif feed_link.startswith('http'):
-                if urllib_fallback:
-                    request = urllib2.Request(feed_link, headers=self.headers)
-                    response = urllib2.urlopen(request)
-                    time.sleep(0.01) # Grrr, GIL.
-                    data = response.read()
+                r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+                validators = r.hgetall(self.validators_key)
+                try:
+                    response = page_session().get(feed_link, stream=True,
+                                                  headers=self.conditional_headers(validators))
+                except requests.exceptions.TooManyRedirects:
+                    response = page_session().get(feed_link, stream=True)
+                except (AttributeError, SocketError), e:
+                    logging.debug('   ***> [%-30s] Page fetch failed using requests: %s' % (self.feed, e))
+                    self.save_no_page()
+                    return
+                
+                if response.status_code == 304:
+                    response.close()
+                    logging.debug('   ---> [%-30s] ~FYPage not modified, ~SB0~SN bytes read in ~FM%.4ss' % (
+                                  self.feed.title[:30], time.time() - start))
+                    self.feed.save_page_history(304, "Not modified")
+                    return
+                if response.status_code >= 400:
+                    response.close()
+                    self.feed.save_page_history(response.status_code, response.reason or "HTTP Error")
+                    return
+                
+                html, bytes_read, truncated = self.stream_page(response)
+                if not html:
+                    self.save_no_page()
+                    return
+                content_hash = hashlib.sha1(html).hexdigest()
+                if content_hash == validators.get('hash'):
+                    logging.debug('   ---> [%-30s] ~FYPage unchanged, ~SB%s~SN bytes not stored in ~FM%.4ss' % (
+                                  self.feed.title[:30], bytes_read, time.time() - start))
                 else:
-                    try:
-                        response = requests.get(feed_link, headers=self.headers)
-                    except requests.exceptions.TooManyRedirects:
-                        response = requests.get(feed_link)
-                    except (AttributeError, SocketError), e:
-                        logging.debug('   ***> [%-30s] Page fetch failed using requests: %s' % (self.feed, e))
-                        self.save_no_page()
-                        return
-                    try:
-                        data = response.text
-                    except (LookupError, TypeError):
-                        data = response.content
+                    self.save_page(html)
+                    logging.debug('   ---> [%-30s] ~FYPage saved, ~SB%s~SN bytes%s in ~FM%.4ss' % (
+                                  self.feed.title[:30], len(html),
+                                  ' (~FRtruncated~FY)' if truncated else '',
+                                  time.time() - start))
+                r.delete(self.validators_key)
+                r.hmset(self.validators_key, {
+                    'etag': response.headers.get('etag') or '',
+                    'modified': response.headers.get('last-modified') or '',
+                    'hash': content_hash,
+                })
             else:
                 try:
                     data = open(feed_link, 'r').read()
                 except IOError:
                     self.feed.feed_link = 'http://' + feed_link
-                    self.fetch_page(urllib_fallback=True)
+                    return self.fetch_page()
+                if data:
+                    html = self.rewrite_page(data)
+                    self.save_page(html)
+                else:
+                    self.save_no_page()
                     return
-            if data:
-                html = self.rewrite_page(data)
-                self.save_page(html)
-            else:
-                self.save_no_page()
-                return
         except (ValueError, urllib2.URLError, httplib.BadStatusLine, httplib.InvalidURL,
                 requests.exceptions.ConnectionError), e:
             self.feed.save_page_history(401, "Bad URL", e)
             fp = feedparser.parse(self.feed.feed_address)
             feed_link = fp.feed.get('link', "")
             self.feed.save()
-        except (urllib2.HTTPError), e:
-            self.feed.save_page_history(e.code, e.msg, e.fp.read())
         except (httplib.IncompleteRead), e:
             self.feed.save_page_history(500, "IncompleteRead", e)
         except (requests.exceptions.RequestException, 
                 requests.packages.urllib3.exceptions.HTTPError), e:
             logging.debug('   ***> [%-30s] Page fetch failed using requests: %s' % (self.feed, e))
+            self.feed.save_page_history(500, "Page fetch failed", e)
             # mail_feed_error_to_admin(self.feed, e, local_vars=locals())
-            return self.fetch_page(urllib_fallback=True, requests_exception=e)
         except Exception, e:
             logging.debug('[%d] ! -------------------------' % (self.feed.id,))
             tb = traceback.format_exc()
@@ -127,12 +194,49 @@ class PageImporter(object):
             if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
                 settings.RAVEN_CLIENT):
                 settings.RAVEN_CLIENT.captureException()
-            if not urllib_fallback:
-                self.fetch_page(urllib_fallback=True)
         else:
             self.feed.save_page_history(200, "OK")
         
         return html
+    
+    def stream_page(self, response):
+        """
+        Reads the response body in chunks, up to `max_bytes`, adding the <base> tag
+        right after <head> as it goes by instead of regex rewriting the whole page.
+        Pages without a <head> in their first HEAD_SEARCH_BYTES get the tag up front,
+        like `rewrite_page`. Returns (html, bytes read, whether it was truncated).
+        """
+        base_code = ('<base href="%s" />' % (self.feed.feed_link,)).encode('utf-8')
+        chunks = []
+        head = ''
+        injected = False
+        truncated = False
+        bytes_read = 0
+        try:
+            for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                if bytes_read + len(chunk) > self.max_bytes:
+                    chunk = chunk[:self.max_bytes - bytes_read]
+                    truncated = True
+                bytes_read += len(chunk)
+                if injected:
+                    chunks.append(chunk)
+                else:
+                    head += chunk
+                    match = HEAD_RE.search(head)
+                    if match:
+                        chunks.append(head[:match.end()] + ' ' + base_code + head[match.end():])
+                        injected = True
+                    elif len(head) > self.HEAD_SEARCH_BYTES:
+                        chunks.append(base_code + ' ' + head)
+                        injected = True
+                if truncated:
+                    break
+        finally:
+            response.close()
+        if not injected and head.strip():
+            chunks.append(base_code + ' ' + head)
+        
+        return ''.join(chunks).strip(), bytes_read, truncated
         
     def save_no_page(self):
         logging.debug('   ---> [%-30s] ~FYNo original page: %s' % (self.feed, self.feed.feed_link))
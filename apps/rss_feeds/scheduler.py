@@ -0,0 +1,261 @@
+import datetime
+import math
+import random
+import time
+import urlparse
+import redis
+from collections import defaultdict
+from django.conf import settings
+from django.db.models import Max
+from utils import log as logging
+
+
+class FeedScheduler(object):
+    """
+    Decides which feeds get fetched next. Feeds move through three redis keys:
+
+        scheduled_updates   zset of feed_id -> timestamp the feed is next due
+        queued_feeds        zset of feed_id -> priority, for feeds that are due
+        tasked_feeds        zset of feed_id -> timestamp it was handed to celery
+
+    A due feed's priority is its due time minus a bonus that grows with its
+    subscribers, so under backlog the feeds read by the most people go first and
+    nothing starves: every minute a feed waits, it overtakes feeds that became
+    due later. Dispatch walks the queue in priority order and skips hosts that
+    already have `max_per_host` fetches in flight, leaving those feeds queued.
+
+    Each feed's host and bonus are kept in the `feed_hosts` and `feed_weights`
+    hashes whenever the feed is rescheduled, so queueing and dispatching never
+    have to load a Feed.
+    """
+
+    MAX_TASKED         = 5000
+    MAX_PER_HOST       = 20
+    BATCH_SIZE         = 12
+    DROPPED_AFTER      = 10 * 60
+    MAX_PRIORITY_BONUS = 3 * 60 * 60
+    REFRESH_FEEDS      = 100
+    OLD_FEEDS          = 500
+
+    def __init__(self, r=None, max_tasked=None, max_per_host=None, batch_size=None):
+        self.r = r or redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        self.max_tasked = max_tasked or self.MAX_TASKED
+        self.max_per_host = max_per_host or self.MAX_PER_HOST
+        self.batch_size = batch_size or self.BATCH_SIZE
+
+    @staticmethod
+    def feed_host(feed_address):
+        if not feed_address: return ''
+        return urlparse.urlparse(feed_address).netloc.lower()
+
+    @classmethod
+    def priority_bonus(cls, active_subscribers, active_premium_subscribers):
+        """
+        Seconds a feed is allowed to jump ahead of the queue: ten minutes for every
+        doubling of subscribers, counting a free subscriber as a tenth of a premium one.
+        """
+        premium = max(0, active_premium_subscribers)
+        subs = premium + max(0, active_subscribers - premium) / 10.0
+        return min(cls.MAX_PRIORITY_BONUS, int(600 * math.log(1 + subs, 2)))
+
+    @staticmethod
+    def select(candidates, in_flight, max_per_host, limit):
+        """
+        Picks up to `limit` feed ids from `candidates`, a list of (feed_id, host) in
+        priority order, without letting any host go over `max_per_host` fetches
+        counting those already `in_flight` (host -> count). Feeds with an unknown
+        host are never held back. Pure, so the simulation can replay it.
+        """
+        in_flight = defaultdict(int, in_flight)
+        selected = []
+        for feed_id, host in candidates:
+            if len(selected) >= limit:
+                break
+            if host:
+                if in_flight[host] >= max_per_host:
+                    continue
+                in_flight[host] += 1
+            selected.append(feed_id)
+        return selected
+
+    @classmethod
+    def remember_feed(cls, r, feed):
+        """ Queues the feed's host and priority bonus on `r`, usually a pipeline. """
+        r.hset('feed_hosts', feed.pk, cls.feed_host(feed.feed_address))
+        r.hset('feed_weights', feed.pk, cls.priority_bonus(feed.active_subscribers,
+                                                           feed.active_premium_subscribers))
+
+    def upgrade_queue(self):
+        # queued_feeds used to be a plain set. Carry its feeds over as due now.
+        if self.r.type('queued_feeds') != 'set':
+            return
+        feed_ids = self.r.smembers('queued_feeds')
+        now = int(time.time())
+        p = self.r.pipeline()
+        p.delete('queued_feeds')
+        for feed_id in feed_ids:
+            p.zadd('queued_feeds', feed_id, now)
+        p.execute()
+
+    def queue(self, due_feeds):
+        """ Adds (feed_id, due_timestamp) pairs to the priority queue. """
+        if not due_feeds: return
+        feed_ids = [feed_id for feed_id, _ in due_feeds]
+        bonuses = self.r.hmget('feed_weights', feed_ids)
+        p = self.r.pipeline()
+        for (feed_id, due), bonus in zip(due_feeds, bonuses):
+            p.zadd('queued_feeds', feed_id, int(due) - int(bonus or 0))
+        p.execute()
+
+    def queue_due_feeds(self, now_timestamp):
+        p = self.r.pipeline()
+        p.zrangebyscore('scheduled_updates', 0, now_timestamp, withscores=True)
+        p.zremrangebyscore('scheduled_updates', 0, now_timestamp)
+        due_feeds = p.execute()[0]
+        self.queue(due_feeds)
+        return len(due_feeds)
+
+    def requeue_dropped_feeds(self, now_timestamp):
+        """
+        Feeds tasked more than ten minutes ago never reported back. Count an error
+        against each of them and reschedule them all at once, backing off by their
+        last fetch interval times their error count.
+        """
+        from apps.rss_feeds.models import Feed
+        cutoff = now_timestamp - self.DROPPED_AFTER
+        p = self.r.pipeline()
+        p.zrangebyscore('tasked_feeds', 0, cutoff)
+        p.zremrangebyscore('tasked_feeds', 0, cutoff)
+        dropped_feed_ids = p.execute()[0]
+        if not dropped_feed_ids: return 0
+
+        p = self.r.pipeline()
+        for feed_id in dropped_feed_ids:
+            p.zincrby('error_feeds', feed_id, 1)
+        fetch_errors = dict(zip([int(feed_id) for feed_id in dropped_feed_ids], p.execute()))
+
+        feeds = Feed.objects.filter(pk__in=fetch_errors.keys(), active_subscribers__gte=1)\
+                            .values_list('pk', 'min_to_decay', 'errors_since_good')
+        p = self.r.pipeline()
+        for feed_id, min_to_decay, errors_since_good in feeds:
+            total = (min_to_decay or 60) * (int(fetch_errors[feed_id]) + errors_since_good)
+            total += random.randint(0, total) / 4
+            p.zadd('scheduled_updates', feed_id, now_timestamp + total * 60)
+        p.execute()
+
+        return len(dropped_feed_ids)
+
+    def random_window(self, queryset, count):
+        """
+        Up to `count` rows of `queryset`, starting from a random primary key and
+        walking the pk index. Spreads picks across the table like ORDER BY RANDOM()
+        without sorting the whole table to get them.
+        """
+        max_pk = queryset.aggregate(max_pk=Max('pk'))['max_pk']
+        if not max_pk: return []
+        start = random.randint(0, max_pk)
+        rows = list(queryset.filter(pk__gte=start).order_by('pk')[:count])
+        if len(rows) < count:
+            rows.extend(queryset.filter(pk__lt=start).order_by('pk')[:count-len(rows)])
+        return rows
+
+    def queue_stale_feeds(self, now):
+        """
+        Queues active feeds that were never fetched and feeds whose next update is a
+        day late, which usually means they fell out of scheduled_updates. Feeds that
+        were never fetched go to the front of the queue.
+        """
+        from apps.rss_feeds.models import Feed
+        now_timestamp = int(now.strftime('%s'))
+        fields = ('pk', 'feed_address', 'active_subscribers', 'active_premium_subscribers')
+        refresh_feeds = self.random_window(Feed.objects.filter(
+            active=True,
+            fetched_once=False,
+            active_subscribers__gte=1
+        ).values_list(*fields), self.REFRESH_FEEDS)
+        old_feeds = self.random_window(Feed.objects.filter(
+            next_scheduled_update__lte=now - datetime.timedelta(days=1),
+            active_subscribers__gte=1
+        ).values_list(*fields), self.OLD_FEEDS)
+
+        p = self.r.pipeline()
+        for feeds, due in ((refresh_feeds, now_timestamp - self.MAX_PRIORITY_BONUS),
+                           (old_feeds, now_timestamp)):
+            for feed_id, feed_address, active_subscribers, active_premium_subscribers in feeds:
+                bonus = self.priority_bonus(active_subscribers, active_premium_subscribers)
+                p.hset('feed_hosts', feed_id, self.feed_host(feed_address))
+                p.hset('feed_weights', feed_id, bonus)
+                p.zadd('queued_feeds', feed_id, due - bonus)
+        p.execute()
+
+        return len(refresh_feeds), len(old_feeds)
+
+    def dispatch(self):
+        """ Tasks the highest priority queued feeds that fit under the host limits. """
+        from apps.rss_feeds.models import Feed
+        tasked_feed_ids = self.r.zrange('tasked_feeds', 0, -1)
+        room = self.max_tasked - len(tasked_feed_ids)
+        if room <= 0:
+            logging.debug(" ---> ~SN~FBToo many tasked feeds. ~SB%s~SN tasked." % len(tasked_feed_ids))
+            return 0
+
+        # Over-read so a few busy hosts at the front of the queue can't stall dispatch.
+        candidate_ids = self.r.zrange('queued_feeds', 0, room * 2 - 1)
+        if not candidate_ids: return 0
+        hosts = self.r.hmget('feed_hosts', tasked_feed_ids + candidate_ids)
+        in_flight = defaultdict(int)
+        for host in hosts[:len(tasked_feed_ids)]:
+            if host: in_flight[host] += 1
+        candidates = zip(candidate_ids, hosts[len(tasked_feed_ids):])
+
+        feed_ids = self.select(candidates, in_flight, self.max_per_host, room)
+        Feed.task_feeds(feed_ids, queue_size=self.batch_size, verbose=True)
+
+        return len(feed_ids)
+
+    def run(self):
+        now = datetime.datetime.utcnow()
+        now_timestamp = int(now.strftime('%s'))
+        start = time.time()
+
+        hour_ago = now - datetime.timedelta(hours=1)
+        self.r.zremrangebyscore('fetched_feeds_last_hour', 0, int(hour_ago.strftime('%s')))
+        self.upgrade_queue()
+
+        due_count = self.queue_due_feeds(now_timestamp)
+        logging.debug(" ---> ~SN~FBQueuing ~SB%s~SN stale feeds (~SB%s~SN/~FG%s~FB~SN/%s tasked/queued/scheduled)" % (
+                        due_count,
+                        self.r.zcard('tasked_feeds'),
+                        self.r.zcard('queued_feeds'),
+                        self.r.zcard('scheduled_updates')))
+        cp1 = time.time()
+
+        inactive_count = self.requeue_dropped_feeds(now_timestamp)
+        if inactive_count:
+            logging.debug(" ---> ~SN~FBRe-queuing ~SB%s~SN dropped feeds (~SB%s/%s~SN queued/tasked)" % (
+                            inactive_count,
+                            self.r.zcard('queued_feeds'),
+                            self.r.zcard('tasked_feeds')))
+        cp2 = time.time()
+
+        refresh_count, old_count = self.queue_stale_feeds(now)
+        cp3 = time.time()
+
+        active_count = self.dispatch()
+        cp4 = time.time()
+
+        logging.debug(" ---> ~FBTasking ~SB~FC%s~SN~FB/~FC%s~FB (~FC%s~FB/~FC%s~SN~FB) feeds... (%.4s/%.4s/%.4s/%.4s)" % (
+            active_count,
+            refresh_count,
+            inactive_count,
+            old_count,
+            cp1 - start,
+            cp2 - cp1,
+            cp3 - cp2,
+            cp4 - cp3
+        ))
+        logging.debug(" ---> ~SN~FBTasking took ~SB%s~SN seconds (~SB%s~SN/~FG%s~FB~SN/%s tasked/queued/scheduled)" % (
+                        int((time.time() - start)),
+                        self.r.zcard('tasked_feeds'),
+                        self.r.zcard('queued_feeds'),
+                        self.r.zcard('scheduled_updates')))
@@ -0,0 +1,112 @@
+import datetime
+import time
+import zlib
+import redis
+import msgpack
+from django.conf import settings
+from apps.statistics.rstats import RStats
+
+
+class RStoryCache(object):
+    """
+    Formatted stories, as returned by `Feed.format_story`, cached by story hash in
+    their own redis db so they can be fetched with a single MGET instead of a mongo
+    query and a zlib decompress per story. Values are msgpack, compressed:
+
+        SC:<story_hash>     zlib(msgpack(story)), expiring after a day
+
+    Stories are invalidated whenever the MStory is saved or deleted, which also
+    covers new comment and share counts, so a cached story is never staler than the
+    document it came from.
+    """
+
+    TTL = 60 * 60 * 24
+    DATETIME = '__dt__'
+
+    @staticmethod
+    def key(story_hash):
+        return "SC:%s" % story_hash
+
+    @classmethod
+    def redis(cls):
+        return redis.Redis(connection_pool=settings.REDIS_STORY_CACHE_POOL)
+
+    @classmethod
+    def pack(cls, story):
+        def encode(obj):
+            if isinstance(obj, datetime.datetime):
+                return {cls.DATETIME: [obj.year, obj.month, obj.day, obj.hour,
+                                       obj.minute, obj.second, obj.microsecond]}
+            return obj
+        return zlib.compress(msgpack.packb(story, default=encode))
+
+    @classmethod
+    def unpack(cls, data):
+        def decode(obj):
+            if cls.DATETIME in obj:
+                return datetime.datetime(*obj[cls.DATETIME])
+            return obj
+        return msgpack.unpackb(zlib.decompress(data), object_hook=decode,
+                               encoding='utf-8', unicode_errors='replace')
+
+    @classmethod
+    def get(cls, story_hashes):
+        """ Returns a dict of story_hash -> story for the hashes that are cached. """
+        if not story_hashes: return {}
+        stories = {}
+        for story_hash, data in zip(story_hashes, cls.redis().mget([cls.key(h) for h in story_hashes])):
+            if not data: continue
+            try:
+                stories[story_hash] = cls.unpack(data)
+            except (zlib.error, ValueError, TypeError):
+                continue
+        return stories
+
+    @classmethod
+    def set(cls, stories):
+        stories = [story for story in stories if story.get('story_hash')]
+        if not stories: return
+        p = cls.redis().pipeline()
+        for story in stories:
+            p.setex(cls.key(story['story_hash']), cls.pack(story), cls.TTL)
+        p.execute()
+
+    @classmethod
+    def invalidate(cls, story_hashes):
+        story_hashes = [h for h in story_hashes if h]
+        if not story_hashes: return
+        cls.redis().delete(*[cls.key(h) for h in story_hashes])
+
+    @classmethod
+    def format_stories(cls, story_hashes, order='newest', feed_id=None):
+        """
+        Read-through replacement for formatting `MStory.objects(story_hash__in=...)`
+        sorted by story date. Only the stories missing from the cache are loaded
+        from mongo, and those are cached on the way out.
+        """
+        from apps.rss_feeds.models import Feed, MStory
+        if not story_hashes: return []
+        start = time.time()
+        story_hashes = list(story_hashes)
+        stories = cls.get(story_hashes)
+        hits = len(stories)
+
+        missing = [h for h in story_hashes if h not in stories]
+        if missing:
+            stories_db = MStory.objects(story_hash__in=missing)
+            formatted = Feed.format_stories(stories_db)
+            cls.set(formatted)
+            for story in formatted:
+                stories[story['story_hash']] = story
+
+        stories = sorted(stories.values(), key=lambda story: story['story_date'],
+                         reverse=(order != 'oldest'))
+        if feed_id:
+            for story in stories:
+                story['story_feed_id'] = feed_id
+
+        RStats.add('story_cache', duration=time.time() - start)
+        RStats.add('story_cache_hit', count=hits)
+        RStats.add('story_cache_miss', count=len(story_hashes) - hits)
+
+        return stories
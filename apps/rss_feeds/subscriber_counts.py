@@ -0,0 +1,166 @@
+import datetime
+import redis
+from django.conf import settings
+from django.db import connection
+from utils import log as logging
+
+
+class RFeedSubscriberCounts(object):
+    """
+    Subscriber counts for feeds, computed for many feeds at once with a single
+    grouped query and kept in redis so that fetching a feed never has to recount:
+
+        FSC:<feed_id>   hash of the four counts below, expiring after TTL
+
+    Counts are stored under the feed that branches were split from, so every
+    branch of a feed shares one hash. Creating or deleting a subscription adjusts
+    the counts in place. Changes that touch all of a user's subscriptions at once,
+    like going premium or coming back after SUBSCRIBER_EXPIRE days, recount that
+    user's feeds instead. Anything missed is corrected when the hash expires.
+    """
+
+    TTL = 60 * 60 * 6
+    FIELDS = ('num_subscribers', 'active_subscribers',
+              'premium_subscribers', 'active_premium_subscribers')
+
+    @classmethod
+    def redis(cls):
+        return redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+
+    @staticmethod
+    def key(feed_id):
+        return "FSC:%s" % feed_id
+
+    @staticmethod
+    def expire_date():
+        return datetime.datetime.now() - datetime.timedelta(days=settings.SUBSCRIBER_EXPIRE)
+
+    @staticmethod
+    def roots(feed_ids):
+        """ Maps each feed id to the id of the feed it was branched from, or itself. """
+        from apps.rss_feeds.models import Feed
+        feeds = Feed.objects.filter(pk__in=feed_ids).values_list('pk', 'branch_from_feed')
+        return dict((feed_id, branch_from_feed_id or feed_id) for feed_id, branch_from_feed_id in feeds)
+
+    @classmethod
+    def count(cls, root_ids):
+        """ Counts subscribers of each root feed and all of its branches in one query. """
+        from apps.rss_feeds.models import Feed
+        from apps.reader.models import UserSubscription
+        from apps.profile.models import Profile
+        root_ids = list(set(root_ids))
+        if not root_ids: return {}
+
+        root_of = dict((root_id, root_id) for root_id in root_ids)
+        root_of.update(Feed.objects.filter(branch_from_feed__in=root_ids).values_list('pk', 'branch_from_feed'))
+        expire = cls.expire_date()
+        cursor = connection.cursor()
+        cursor.execute("""SELECT us.feed_id, COUNT(*),
+                              SUM(CASE WHEN us.active AND p.last_seen_on >= %%s THEN 1 ELSE 0 END),
+                              SUM(CASE WHEN us.active AND p.is_premium THEN 1 ELSE 0 END),
+                              SUM(CASE WHEN us.active AND p.is_premium AND p.last_seen_on >= %%s THEN 1 ELSE 0 END)
+                          FROM %s us
+                          LEFT OUTER JOIN %s p ON p.user_id = us.user_id
+                          WHERE us.feed_id IN (%s)
+                          GROUP BY us.feed_id""" % (
+                              UserSubscription._meta.db_table,
+                              Profile._meta.db_table,
+                              ', '.join(['%s'] * len(root_of))),
+                       [expire, expire] + root_of.keys())
+
+        counts = dict((root_id, [0] * len(cls.FIELDS)) for root_id in root_ids)
+        for row in cursor.fetchall():
+            totals = counts[root_of[row[0]]]
+            for i, value in enumerate(row[1:]):
+                totals[i] += int(value or 0)
+
+        return dict((root_id, dict(zip(cls.FIELDS, totals))) for root_id, totals in counts.items())
+
+    @classmethod
+    def recount(cls, feed_ids, roots=None):
+        """ Recounts and stores the counts for `feed_ids`. Returns feed_id -> counts. """
+        roots = roots or cls.roots(feed_ids)
+        counts = cls.count(roots.values())
+        p = cls.redis().pipeline()
+        for root_id, root_counts in counts.items():
+            p.delete(cls.key(root_id))
+            p.hmset(cls.key(root_id), root_counts)
+            p.expire(cls.key(root_id), cls.TTL)
+        p.execute()
+
+        return dict((feed_id, counts[root_id]) for feed_id, root_id in roots.items())
+
+    @classmethod
+    def get(cls, feed_ids, roots=None):
+        """
+        Returns feed_id -> counts, counting only the feeds that aren't already in
+        redis. A hash missing any field was recreated by an adjustment racing its
+        expiry, so it is recounted too.
+        """
+        roots = roots or cls.roots(feed_ids)
+        root_ids = list(set(roots.values()))
+        if not root_ids: return {}
+        p = cls.redis().pipeline()
+        for root_id in root_ids:
+            p.hgetall(cls.key(root_id))
+        counts = {}
+        for root_id, stored in zip(root_ids, p.execute()):
+            if stored and all(field in stored for field in cls.FIELDS):
+                counts[root_id] = dict((field, int(stored[field])) for field in cls.FIELDS)
+
+        missing = dict((feed_id, root_id) for feed_id, root_id in roots.items() if root_id not in counts)
+        if missing:
+            for feed_id, feed_counts in cls.recount(missing.keys(), roots=missing).items():
+                counts[missing[feed_id]] = feed_counts
+
+        return dict((feed_id, counts[root_id]) for feed_id, root_id in roots.items())
+
+    @classmethod
+    def adjust(cls, feed_id, deltas):
+        """ Adds `deltas` (field -> change) to a feed's counts, if they are stored. """
+        deltas = dict((field, delta) for field, delta in deltas.items() if delta)
+        if not deltas: return
+        root_id = cls.roots([feed_id]).get(feed_id)
+        if not root_id: return
+        r = cls.redis()
+        if not r.exists(cls.key(root_id)): return
+        p = r.pipeline()
+        for field, delta in deltas.items():
+            p.hincrby(cls.key(root_id), field, delta)
+        p.execute()
+
+    @classmethod
+    def subscription_deltas(cls, usersub, sign):
+        """ What adding (sign=1) or removing (sign=-1) `usersub` does to its feed's counts. """
+        from apps.profile.models import Profile
+        profile = Profile.objects.filter(user=usersub.user_id).values_list('is_premium', 'last_seen_on')
+        is_premium, last_seen_on = profile[0] if profile else (False, None)
+        seen = bool(last_seen_on and last_seen_on >= cls.expire_date())
+        active = bool(usersub.active)
+        return {
+            'num_subscribers': sign,
+            'active_subscribers': sign if active and seen else 0,
+            'premium_subscribers': sign if active and is_premium else 0,
+            'active_premium_subscribers': sign if active and is_premium and seen else 0,
+        }
+
+    @classmethod
+    def recount_users(cls, user_ids):
+        """ Recounts every feed the users subscribe to, for changes that touch all of them. """
+        from apps.reader.models import UserSubscription
+        if not user_ids: return 0
+        feed_ids = list(set(UserSubscription.objects.filter(user__in=user_ids)
+                                                    .values_list('feed', flat=True)))
+        for i in xrange(0, len(feed_ids), 1000):
+            cls.recount(feed_ids[i:i+1000])
+        logging.debug(" ---> ~SN~FBRecounted subscribers of ~SB%s~SN feeds for ~SB%s~SN users" % (
+                      len(feed_ids), len(user_ids)))
+        return len(feed_ids)
+
+
+def subscription_created(sender, instance, created, **kwargs):
+    if created:
+        RFeedSubscriberCounts.adjust(instance.feed_id, RFeedSubscriberCounts.subscription_deltas(instance, 1))
+
+def subscription_deleted(sender, instance, **kwargs):
+    RFeedSubscriberCounts.adjust(instance.feed_id, RFeedSubscriberCounts.subscription_deltas(instance, -1))
@@ -12,89 +12,9 @@ class TaskFeeds(Task):
     name = 'task-feeds'
 
     def run(self, **kwargs):
-        from apps.rss_feeds.models import Feed        
+        from apps.rss_feeds.scheduler import FeedScheduler
         settings.LOG_TO_STREAM = True
-        now = datetime.datetime.utcnow()
-        start = time.time()
-        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
-        tasked_feeds_size = r.zcard('tasked_feeds')
-        
-        hour_ago = now - datetime.timedelta(hours=1)
-        r.zremrangebyscore('fetched_feeds_last_hour', 0, int(hour_ago.strftime('%s')))
-        
-        now_timestamp = int(now.strftime("%s"))
-        queued_feeds = r.zrangebyscore('scheduled_updates', 0, now_timestamp)
-        r.zremrangebyscore('scheduled_updates', 0, now_timestamp)
-        r.sadd('queued_feeds', *queued_feeds)
-        logging.debug(" ---> ~SN~FBQueuing ~SB%s~SN stale feeds (~SB%s~SN/~FG%s~FB~SN/%s tasked/queued/scheduled)" % (
-                        len(queued_feeds),
-                        r.zcard('tasked_feeds'),
-                        r.scard('queued_feeds'),
-                        r.zcard('scheduled_updates')))
-        
-        # Regular feeds
-        if tasked_feeds_size < 5000:
-            feeds = r.srandmember('queued_feeds', 5000)
-            Feed.task_feeds(feeds, verbose=True)
-            active_count = len(feeds)
-        else:
-            logging.debug(" ---> ~SN~FBToo many tasked feeds. ~SB%s~SN tasked." % tasked_feeds_size)
-            active_count = 0
-        cp1 = time.time()
-        
-        # Force refresh feeds
-        refresh_feeds = Feed.objects.filter(
-            active=True,
-            fetched_once=False,
-            active_subscribers__gte=1
-        ).order_by('?')[:100]
-        refresh_count = refresh_feeds.count()
-        cp2 = time.time()
-        
-        # Mistakenly inactive feeds
-        hours_ago = (now - datetime.timedelta(minutes=10)).strftime('%s')
-        old_tasked_feeds = r.zrangebyscore('tasked_feeds', 0, hours_ago)
-        inactive_count = len(old_tasked_feeds)
-        if inactive_count:
-            r.zremrangebyscore('tasked_feeds', 0, hours_ago)
-            # r.sadd('queued_feeds', *old_tasked_feeds)
-            for feed_id in old_tasked_feeds:
-                r.zincrby('error_feeds', feed_id, 1)
-                feed = Feed.get_by_id(feed_id)
-                feed.set_next_scheduled_update()
-            logging.debug(" ---> ~SN~FBRe-queuing ~SB%s~SN dropped feeds (~SB%s/%s~SN queued/tasked)" % (
-                            inactive_count,
-                            r.scard('queued_feeds'),
-                            r.zcard('tasked_feeds')))
-        cp3 = time.time()
-        
-        old = now - datetime.timedelta(days=1)
-        old_feeds = Feed.objects.filter(
-            next_scheduled_update__lte=old, 
-            active_subscribers__gte=1
-        ).order_by('?')[:500]
-        old_count = old_feeds.count()
-        cp4 = time.time()
-        
-        logging.debug(" ---> ~FBTasking ~SB~FC%s~SN~FB/~FC%s~FB (~FC%s~FB/~FC%s~SN~FB) feeds... (%.4s/%.4s/%.4s/%.4s)" % (
-            active_count,
-            refresh_count,
-            inactive_count,
-            old_count,
-            cp1 - start,
-            cp2 - cp1,
-            cp3 - cp2,
-            cp4 - cp3
-        ))
-        
-        Feed.task_feeds(refresh_feeds, verbose=False)
-        Feed.task_feeds(old_feeds, verbose=False)
-
-        logging.debug(" ---> ~SN~FBTasking took ~SB%s~SN seconds (~SB%s~SN/~FG%s~FB~SN/%s tasked/queued/scheduled)" % (
-                        int((time.time() - start)),
-                        r.zcard('tasked_feeds'),
-                        r.scard('queued_feeds'),
-                        r.zcard('scheduled_updates')))
+        FeedScheduler().run()
 
         
 class UpdateFeeds(Task):
@@ -105,6 +25,7 @@ class UpdateFeeds(Task):
     def run(self, feed_pks, **kwargs):
         from apps.rss_feeds.models import Feed
         from apps.statistics.models import MStatistics
+        from apps.statistics.fetch_telemetry import FetchTelemetry
         r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
 
         mongodb_replication_lag = int(MStatistics.get('mongodb_replication_lag', 0))
@@ -126,6 +47,8 @@ class UpdateFeeds(Task):
                 r.zrem('tasked_feeds', feed_pk)
             if feed:
                 feed.update(**options)
+        
+        FetchTelemetry.flush()
 
 class NewFeeds(Task):
     name = 'new-feeds'
@@ -134,6 +57,7 @@ class NewFeeds(Task):
 
     def run(self, feed_pks, **kwargs):
         from apps.rss_feeds.models import Feed
+        from apps.statistics.fetch_telemetry import FetchTelemetry
         if not isinstance(feed_pks, list):
             feed_pks = [feed_pks]
         
@@ -142,6 +66,8 @@ class NewFeeds(Task):
             feed = Feed.get_by_id(feed_pk)
             if not feed: continue
             feed.update(options=options)
+        
+        FetchTelemetry.flush()
 
 class PushFeeds(Task):
     name = 'push-feeds'
@@ -216,3 +142,72 @@ class SchedulePremiumSetup(Task):
         
         Feed.setup_feeds_for_premium_subscribers(feed_ids)
         
+
+
+class RecountSubscribers(Task):
+    name = 'recount-subscribers'
+    max_retries = 0
+    ignore_result = True
+    
+    def run(self, user_ids, **kwargs):
+        from apps.rss_feeds.subscriber_counts import RFeedSubscriberCounts
+        
+        if not isinstance(user_ids, list):
+            user_ids = [user_ids]
+        
+        RFeedSubscriberCounts.recount_users(user_ids)
+
+
+class RecountExpiredSubscribers(Task):
+    name = 'recount-expired-subscribers'
+    max_retries = 0
+    ignore_result = True
+    
+    def run(self, **kwargs):
+        from apps.profile.models import Profile
+        from apps.rss_feeds.subscriber_counts import RFeedSubscriberCounts
+        
+        # Users who stopped counting as active since the last run. Runs hourly over
+        # a two hour window, so a late run doesn't miss anyone.
+        expire = RFeedSubscriberCounts.expire_date()
+        user_ids = list(Profile.objects.filter(last_seen_on__lt=expire,
+                                               last_seen_on__gte=expire - datetime.timedelta(hours=2))
+                                       .values_list('user', flat=True))
+        RFeedSubscriberCounts.recount_users(user_ids)
+
+
+class TrimFeeds(Task):
+    name = 'trim-feeds'
+    max_retries = 0
+    ignore_result = True
+    
+    def run(self, **kwargs):
+        from apps.rss_feeds.models import Feed
+        
+        Feed.sweep_trim_feeds()
+
+
+class FetchIcons(Task):
+    name = 'fetch-icons'
+    max_retries = 0
+    ignore_result = True
+    
+    def run(self, **kwargs):
+        from apps.rss_feeds.icon_importer import IconPipeline
+        
+        # Celery's pool processes can't fork, so icons are processed in-process here.
+        # The process_icons command runs the same pipeline on a process pool.
+        feed_ids = IconPipeline.pop(200)
+        if feed_ids:
+            IconPipeline().run(feed_ids)
+
+
+class FetchOriginalText(Task):
+    name = 'fetch-original-text'
+    max_retries = 0
+    ignore_result = True
+    
+    def run(self, story_hash, story_permalink, **kwargs):
+        from apps.rss_feeds.original_text import ROriginalText
+        
+        ROriginalText.extract(story_hash, story_permalink)
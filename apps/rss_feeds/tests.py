@@ -1,10 +1,17 @@
+import datetime
 from utils import json_functions as json
 from django.test.client import Client
 from django.test import TestCase
 from django.core import management
 from django.core.urlresolvers import reverse
 from django.conf import settings
-from apps.rss_feeds.models import Feed, MStory
+from apps.rss_feeds.models import Feed, MStory, MFeedPublishProfile
+from apps.rss_feeds.scheduler import FeedScheduler
+from apps.rss_feeds.story_cache import RStoryCache
+from apps.rss_feeds.original_text import ROriginalText
+from apps.rss_feeds.subscriber_counts import RFeedSubscriberCounts
+from apps.rss_feeds.feed_statistics import RFeedStatistics
+from apps.rss_feeds.icon_importer import IconImporter
 from mongoengine.connection import connect, disconnect
 
 class FeedTest(TestCase):
@@ -18,6 +25,17 @@ class FeedTest(TestCase):
     def tearDown(self):
         settings.MONGODB.drop_database('test_newsblur')
         
+    def test_bulk_insert_skips_invalid_stories(self):
+        now = datetime.datetime.utcnow()
+        stories = [
+            MStory(story_feed_id=1, story_guid='valid', story_date=now, story_title='Valid'),
+            MStory(story_feed_id=1, story_guid='invalid', story_date=now, story_title='Invalid',
+                   story_tags=['x' * 300]),
+        ]
+        inserted = MStory.bulk_insert(stories)
+        self.assertEquals([story.story_guid for story in inserted], ['valid'])
+        self.assertEquals(MStory.objects(story_feed_id=1).count(), 1)
+        
     def test_load_feeds__gawker(self):
         self.client.login(username='conesus', password='test')
         
@@ -181,4 +199,191 @@ class FeedTest(TestCase):
         self.assertEquals(len(feed['stories']), 6)
         
     def test_all_feeds(self):
-        pass
\ No newline at end of file
+        pass
+
+class FeedSchedulerTest(TestCase):
+    
+    def test_select_respects_host_limits(self):
+        candidates = [(1, 'a.com'), (2, 'a.com'), (3, 'b.com'), (4, ''), (5, 'a.com'), (6, 'b.com')]
+        
+        selected = FeedScheduler.select(candidates, {'a.com': 1}, 2, 10)
+        self.assertEquals(selected, [1, 3, 4, 6])
+        
+        selected = FeedScheduler.select(candidates, {}, 2, 3)
+        self.assertEquals(selected, [1, 2, 3])
+        
+    def test_priority_bonus(self):
+        self.assertEquals(FeedScheduler.priority_bonus(0, 0), 0)
+        self.assertEquals(FeedScheduler.priority_bonus(-1, -1), 0)
+        self.assertTrue(FeedScheduler.priority_bonus(10, 1) > FeedScheduler.priority_bonus(10, 0))
+        self.assertEquals(FeedScheduler.priority_bonus(10**9, 10**9), FeedScheduler.MAX_PRIORITY_BONUS)
+
+
+class FeedPublishProfileTest(TestCase):
+    
+    def test_polls_more_during_bursts(self):
+        now = datetime.datetime(2013, 5, 6, 3, 0)
+        story_dates = [now - datetime.timedelta(days=7*week+day, hours=-11, minutes=-minute)
+                       for week in range(1, 8) for day in range(5) for minute in (5, 40)]
+        hours = MFeedPublishProfile.shape_from_dates(story_dates, now)
+        self.assertAlmostEquals(sum(hours), 1.0)
+        
+        overnight = MFeedPublishProfile.next_fetch_minutes(hours, now, 60)
+        afternoon = MFeedPublishProfile.next_fetch_minutes(hours, now.replace(hour=14), 60)
+        self.assertTrue(afternoon < 60 < overnight)
+        self.assertTrue(overnight <= 60 * 4)
+        
+    def test_needs_enough_stories(self):
+        now = datetime.datetime(2013, 5, 6, 3, 0)
+        self.assertEquals(MFeedPublishProfile.shape_from_dates([now], now), None)
+
+
+class StoryCacheTest(TestCase):
+    
+    def test_pack_round_trip(self):
+        story = {
+            'story_hash': '42:deadbeef',
+            'story_date': datetime.datetime(2013, 5, 6, 3, 0, 12, 500),
+            'story_title': u'Caf\xe9',
+            'story_content': 'Caf\xc3\xa9 <b>bold</b>',
+            'story_tags': ['one', 'two'],
+            'share_count': 3,
+            'id': datetime.datetime(2013, 5, 6),
+        }
+        unpacked = RStoryCache.unpack(RStoryCache.pack(story))
+        self.assertEquals(unpacked['story_date'], story['story_date'])
+        self.assertEquals(unpacked['id'], story['id'])
+        self.assertEquals(unpacked['story_title'], u'Caf\xe9')
+        self.assertEquals(unpacked['story_content'], u'Caf\xe9 <b>bold</b>')
+        self.assertEquals(unpacked['story_tags'], ['one', 'two'])
+        self.assertEquals(unpacked['share_count'], 3)
+
+
+class OriginalTextTest(TestCase):
+    
+    permalink = u'http://example.com/caf\xe9'
+    
+    def tearDown(self):
+        ROriginalText.redis().delete(ROriginalText.key(self.permalink))
+    
+    def test_cached_text(self):
+        self.assertEquals(ROriginalText.get(self.permalink), (False, None))
+        ROriginalText.set(self.permalink, u'<p>Caf\xe9</p>')
+        self.assertEquals(ROriginalText.get(self.permalink), (True, u'<p>Caf\xe9</p>'))
+    
+    def test_cached_failure(self):
+        ROriginalText.set(self.permalink, None)
+        self.assertEquals(ROriginalText.get(self.permalink), (True, None))
+        self.assertTrue(ROriginalText.redis().ttl(ROriginalText.key(self.permalink)) <= ROriginalText.FAILED_TTL)
+    
+    def test_wait_times_out(self):
+        self.assertEquals(ROriginalText.wait(self.permalink, timeout=0), (False, None))
+
+
+class FeedSubscriberCountsTest(TestCase):
+    fixtures = ['rss_feeds.json', 'gawker1.json']
+    
+    def setUp(self):
+        disconnect()
+        settings.MONGODB = connect('test_newsblur')
+        RFeedSubscriberCounts.redis().delete(RFeedSubscriberCounts.key(1))
+    
+    def tearDown(self):
+        RFeedSubscriberCounts.redis().delete(RFeedSubscriberCounts.key(1))
+        settings.MONGODB.drop_database('test_newsblur')
+    
+    def full_recount(self, feed_id):
+        from apps.reader.models import UserSubscription
+        expire = RFeedSubscriberCounts.expire_date()
+        counts = dict((field, 0) for field in RFeedSubscriberCounts.FIELDS)
+        for usersub in UserSubscription.objects.filter(feed=feed_id).select_related('user__profile'):
+            profile = usersub.user.profile
+            seen = profile.last_seen_on >= expire
+            counts['num_subscribers'] += 1
+            if usersub.active and seen:
+                counts['active_subscribers'] += 1
+            if usersub.active and profile.is_premium:
+                counts['premium_subscribers'] += 1
+            if usersub.active and profile.is_premium and seen:
+                counts['active_premium_subscribers'] += 1
+        return counts
+    
+    def assertCountsMatch(self, feed_id):
+        expected = self.full_recount(feed_id)
+        self.assertEquals(RFeedSubscriberCounts.get([feed_id])[feed_id], expected)
+        feed = Feed.objects.get(pk=feed_id)
+        feed.count_subscribers()
+        feed = Feed.objects.get(pk=feed_id)
+        self.assertEquals(dict((field, getattr(feed, field)) for field in RFeedSubscriberCounts.FIELDS),
+                          expected)
+        self.assertEquals(RFeedSubscriberCounts.recount([feed_id])[feed_id], expected)
+    
+    def test_subscribe_and_unsubscribe(self):
+        from django.contrib.auth.models import User
+        from apps.profile.models import Profile
+        from apps.reader.models import UserSubscription
+        premium = User.objects.create_user('premium', 'premium@newsblur.com', 'test')
+        lapsed = User.objects.create_user('lapsed', 'lapsed@newsblur.com', 'test')
+        Profile.objects.filter(user=premium).update(is_premium=True, last_seen_on=datetime.datetime.now())
+        Profile.objects.filter(user=lapsed).update(last_seen_on=datetime.datetime(2000, 1, 1))
+        
+        # Seeds the FSC: hash from the grouped query.
+        self.assertCountsMatch(1)
+        self.assertTrue(RFeedSubscriberCounts.redis().exists(RFeedSubscriberCounts.key(1)))
+        
+        # The signals adjust the stored counts in place, without a recount.
+        usersubs = [UserSubscription.objects.create(user=user, feed_id=1, active=True)
+                    for user in (premium, lapsed)]
+        stored = RFeedSubscriberCounts.redis().hgetall(RFeedSubscriberCounts.key(1))
+        self.assertEquals(dict((field, int(count)) for field, count in stored.items()),
+                          self.full_recount(1))
+        self.assertEquals(self.full_recount(1)['premium_subscribers'], 1)
+        self.assertCountsMatch(1)
+        
+        usersubs[0].delete()
+        stored = RFeedSubscriberCounts.redis().hgetall(RFeedSubscriberCounts.key(1))
+        self.assertEquals(dict((field, int(count)) for field, count in stored.items()),
+                          self.full_recount(1))
+        self.assertCountsMatch(1)
+        
+    def test_subscription_deltas_without_profile(self):
+        class Sub(object):
+            user_id = -1
+            active = True
+        
+        deltas = RFeedSubscriberCounts.subscription_deltas(Sub(), -1)
+        self.assertEquals(deltas['num_subscribers'], -1)
+        self.assertEquals(deltas['active_subscribers'], 0)
+        self.assertEquals(deltas['premium_subscribers'], 0)
+        self.assertEquals(deltas['active_premium_subscribers'], 0)
+
+
+class FeedStatisticsTest(TestCase):
+    
+    def test_count_stories(self):
+        stories = [
+            MStory(story_date=datetime.datetime(2013, 4, 30), story_tags=['a', 'b', 'a'], story_author_name='sam'),
+            MStory(story_date=datetime.datetime(2013, 5, 1), story_tags=['a'], story_author_name=None),
+        ]
+        deltas = RFeedStatistics.count_stories(stories)
+        self.assertEquals(dict(deltas[RFeedStatistics.MONTHS]), {'2013-4': 1, '2013-5': 1})
+        self.assertEquals(dict(deltas[RFeedStatistics.TAGS]), {'a': 2, 'b': 1})
+        self.assertEquals(dict(deltas[RFeedStatistics.AUTHORS]), {'sam': 1})
+        
+        deltas = RFeedStatistics.count_stories(stories[:1], deltas, sign=-1, months=False)
+        self.assertEquals(dict(deltas[RFeedStatistics.MONTHS]), {'2013-4': 1, '2013-5': 1})
+        self.assertEquals(dict(deltas[RFeedStatistics.TAGS]), {'a': 1, 'b': 0})
+        self.assertEquals(dict(deltas[RFeedStatistics.AUTHORS]), {'sam': 0})
+
+
+class IconColorTest(TestCase):
+    
+    def test_dominant_color_skips_white_and_transparent(self):
+        from PIL import Image
+        image = Image.new('RGBA', (32, 32), (255, 255, 255, 255))
+        image.paste((0, 0, 255, 0), (0, 0, 32, 20))
+        image.paste((255, 0, 0, 255), (4, 20, 28, 30))
+        self.assertEquals(IconImporter.determine_dominant_color_in_image(image), 'ff0000')
+        
+        image = Image.new('RGBA', (16, 16), (255, 255, 255, 255))
+        self.assertEquals(IconImporter.determine_dominant_color_in_image(image), 'ffffff')
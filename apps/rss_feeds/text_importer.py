@@ -3,13 +3,18 @@ import zlib
 from django.conf import settings
 from vendor.readability import readability
 from utils import log as logging
+from utils.feed_functions import timelimit, TimeoutError
 
 
 class TextImporter:
     
-    def __init__(self, story, request=None):
+    # Seconds any one document gets to download and extract.
+    TIME_BUDGET = 10
+    
+    def __init__(self, story=None, request=None, story_url=None):
         self.story = story
         self.request = request
+        self.story_url = story_url or (story and story.story_permalink)
     
     @property
     def headers(self):
@@ -24,16 +29,11 @@ class TextImporter:
         }
     
     def fetch(self, skip_save=False):
-        try:
-            html = requests.get(self.story.story_permalink, headers=self.headers)
-            original_text_doc = readability.Document(html.text, url=html.url, debug=settings.DEBUG)
-            content = original_text_doc.summary(html_partial=True)
-        except:
-            content = None
+        content = self.extract()
         
         if content:
             if not skip_save:
-                self.story.original_text_z = zlib.compress(content)
+                self.story.original_text_z = zlib.compress(content.encode('utf-8'))
                 self.story.save()
             logging.user(self.request, "~SN~FYFetched ~FGoriginal text~FY: now ~SB%s bytes~SN vs. was ~SB%s bytes" % (
                 len(unicode(content)),
@@ -41,7 +41,24 @@ class TextImporter:
             ))
         else:
             logging.user(self.request, "~SN~FRFailed~FY to fetch ~FGoriginal text~FY: was ~SB%s bytes" % (
-                len(zlib.decompress(self.story.story_content_z))
+                self.story.story_content_z and len(zlib.decompress(self.story.story_content_z))
             ))
         
-        return content
\ No newline at end of file
+        return content
+    
+    def extract(self):
+        """ Downloads and extracts the story's text, giving up after TIME_BUDGET seconds. """
+        try:
+            return self._extract()
+        except TimeoutError:
+            logging.debug("   ***> ~FRTimed out extracting original text: %s" % self.story_url)
+            return None
+    
+    @timelimit(TIME_BUDGET)
+    def _extract(self):
+        try:
+            html = requests.get(self.story_url, headers=self.headers, timeout=self.TIME_BUDGET)
+            original_text_doc = readability.Document(html.text, url=html.url, debug=settings.DEBUG)
+            return original_text_doc.summary(html_partial=True)
+        except:
+            return None
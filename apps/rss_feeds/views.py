@@ -14,6 +14,7 @@ from apps.rss_feeds.models import MFeedIcon
 from apps.analyzer.models import get_classifiers_for_user
 from apps.reader.models import UserSubscription
 from apps.rss_feeds.models import MStory
+from apps.rss_feeds.original_text import ROriginalText
 from utils.user_functions import ajax_login_required
 from utils import json_functions as json, feedfinder
 from utils.feed_functions import relative_timeuntil, relative_timesince
@@ -427,10 +428,12 @@ def original_text(request):
         return {'code': -1, 'message': 'Story not found.', 'original_text': None, 'failed': True}
     
     original_text = story.fetch_original_text(force=force, request=request)
-
+    pending = not original_text and ROriginalText.is_fetching(story.story_hash)
+    
     return {
         'feed_id': feed_id,
         'story_id': story_id,
         'original_text': original_text,
-        'failed': not original_text or len(original_text) < 100,
+        'pending': pending,
+        'failed': not pending and (not original_text or len(original_text) < 100),
     }
\ No newline at end of file
@@ -0,0 +1,60 @@
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from apps.social.models import MSocialSubscription
+from utils.benchmark_functions import RoundTripCounter
+from optparse import make_option
+
+
+def legacy_feed_stories(user_id, social_user_ids, read_filter):
+    """ Page 1 of MSocialSubscription.feed_stories before batching, kept as the baseline. """
+    r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+    ranked_stories_keys = 'zU:%s:social:benchmark' % (user_id)
+    read_ranked_stories_keys = 'zhU:%s:social:benchmark' % (user_id)
+    r.delete(ranked_stories_keys)
+    r.delete(read_ranked_stories_keys)
+    for social_user_id in social_user_ids:
+        us = MSocialSubscription.objects.get(user_id=user_id, subscription_user_id=social_user_id)
+        story_hashes = us.get_stories(offset=0, limit=100, read_filter=read_filter,
+                                      withscores=True)
+        if story_hashes:
+            r.zadd(ranked_stories_keys, **dict(story_hashes))
+    r.zinterstore(read_ranked_stories_keys, [ranked_stories_keys, "RS:%s" % user_id])
+    r.zrevrange(ranked_stories_keys, 0, 6, withscores=True)
+    r.zrevrange(read_ranked_stories_keys, 0, 6)
+    r.delete(ranked_stories_keys, read_ranked_stories_keys)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-u", "--username", dest="username"),
+        make_option("-s", "--sizes", dest="sizes", default="10,50,100,200,500",
+                    help="Comma-separated counts of followed users to benchmark."),
+        make_option("-r", "--read_filter", dest="read_filter", default="unread"),
+    )
+
+    def handle(self, *args, **options):
+        user = User.objects.get(username=options['username'])
+        social_user_ids = [s.subscription_user_id for s in
+                           MSocialSubscription.objects.filter(user_id=user.pk).only('subscription_user_id')]
+        sizes = [int(s) for s in options['sizes'].split(',') if int(s) <= len(social_user_ids)]
+        read_filter = options['read_filter']
+
+        print " ---> %s follows %s blurblogs" % (user.username, len(social_user_ids))
+        print "%8s  %24s  %24s" % ("follows", "per-user (redis/mongo/s)", "batched (redis/mongo/s)")
+        for size in sizes:
+            ids = social_user_ids[:size]
+
+            with RoundTripCounter() as legacy:
+                legacy_feed_stories(user.pk, ids, read_filter)
+
+            with RoundTripCounter() as batched:
+                MSocialSubscription.feed_stories(user.pk, ids, offset=0, limit=6,
+                                                 read_filter=read_filter, cache=False)
+
+            print "%8s  %24s  %24s" % (
+                size,
+                "%s/%s/%.3f" % (legacy.redis, legacy.mongo, legacy.elapsed),
+                "%s/%s/%.3f" % (batched.redis, batched.mongo, batched.elapsed),
+            )
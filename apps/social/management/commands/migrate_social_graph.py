@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from apps.social.models import MSocialProfile
+from apps.social.social_graph import RSocialGraph
+from optparse import make_option
+
+LEGACY_FIELDS = ('following_user_ids', 'follower_user_ids',
+                 'unfollowed_user_ids', 'requested_follow_user_ids')
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-k", "--keep", dest="keep", action="store_true", default=False,
+            help="Copy the follow lists into redis but leave them on the profiles."),
+        make_option('-V', '--verbose', action='store_true', dest='verbose', default=False),
+    )
+
+    def handle(self, *args, **options):
+        collection = MSocialProfile._get_collection()
+        has_lists = {'$or': [{field: {'$exists': True}} for field in LEGACY_FIELDS]}
+
+        # Every profile's lists go in before anything is counted, since a follow
+        # is only complete once both sides of it have been imported.
+        user_ids = []
+        for profile in collection.find(has_lists, fields=('user_id',) + LEGACY_FIELDS):
+            RSocialGraph.import_lists(profile['user_id'],
+                                      following=profile.get('following_user_ids'),
+                                      followers=profile.get('follower_user_ids'),
+                                      unfollowed=profile.get('unfollowed_user_ids'),
+                                      requested=profile.get('requested_follow_user_ids'))
+            user_ids.append(profile['user_id'])
+            if options['verbose'] or not len(user_ids) % 1000:
+                print " ---> Imported follows for %s profiles" % len(user_ids)
+
+        for i, user_id in enumerate(user_ids):
+            following_count, follower_count = RSocialGraph.counts(user_id)
+            update = {'$set': {'following_count': following_count, 'follower_count': follower_count}}
+            if not options['keep']:
+                update['$unset'] = dict((field, 1) for field in LEGACY_FIELDS)
+            collection.update({'user_id': user_id}, update)
+            MSocialProfile.expire_compact_profile(user_id)
+            if options['verbose'] or not (i+1) % 1000:
+                print " ---> Recounted %s/%s profiles" % (i+1, len(user_ids))
+
+        if not options['keep']:
+            for name, index in collection.index_information().items():
+                if any(key in LEGACY_FIELDS for key, _ in index['key']):
+                    collection.drop_index(name)
+                    print " ---> Dropped index %s" % name
+
+        print " ---> Moved follows for %s profiles into the social graph" % len(user_ids)
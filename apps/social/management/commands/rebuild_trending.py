@@ -0,0 +1,31 @@
+import datetime
+from django.core.management.base import BaseCommand
+from apps.social.models import MSharedStory
+from apps.social.trending import RTrendingStories
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-l", "--half_life", dest="half_life", type="int", default=None,
+            help="Half-life in seconds, defaults to settings.TRENDING_HALF_LIFE."),
+        make_option("-d", "--days", dest="days", type="float", default=None,
+            help="Days of shares to replay, defaults to ten half-lives."),
+        make_option('-V', '--verbose', action='store_true', dest='verbose', default=False),
+    )
+
+    def handle(self, *args, **options):
+        half_life = options['half_life'] or RTrendingStories.HALF_LIFE
+        days = options['days'] or half_life * 10 / (60 * 60 * 24.)
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        shares = MSharedStory.objects(shared_date__gte=since).only('story_hash', 'shared_date')
+
+        print " ---> Replaying %s shares since %s (%s hour half-life)" % (
+            shares.count(), since, half_life / 3600.)
+        count = RTrendingStories.rebuild(((s.story_hash, s.shared_date) for s in shares),
+                                         half_life=half_life)
+        print " ---> Rebuilt trending scores for %s stories" % count
+
+        if options['verbose']:
+            for story_hash, score in RTrendingStories.top(limit=20, cutoff=0, half_life=half_life):
+                print "%10.2f  %s" % (score, story_hash)
@@ -16,12 +16,14 @@ from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
 from django.template.defaultfilters import slugify
 from django.core.mail import EmailMultiAlternatives
-from apps.reader.models import UserSubscription, RUserStory
+from apps.reader.models import UserSubscription, RUserStory, RUserUnreadCount
 from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTag, MClassifierTitle
 from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds, apply_classifier_authors, apply_classifier_tags
 from apps.rss_feeds.models import Feed, MStory
-from apps.rss_feeds.text_importer import TextImporter
+from apps.rss_feeds.original_text import ROriginalText
 from apps.profile.models import Profile, MSentEmail
+from apps.social.social_graph import RSocialGraph
+from apps.social.trending import RTrendingStories
 from vendor import facebook
 from vendor import tweepy
 from vendor import appdotnet
@@ -114,10 +116,12 @@ class MSocialProfile(mongo.Document):
     shared_stories_count = mongo.IntField(default=0)
     following_count      = mongo.IntField(default=0)
     follower_count       = mongo.IntField(default=0)
-    following_user_ids   = mongo.ListField(mongo.IntField())
-    follower_user_ids    = mongo.ListField(mongo.IntField())
-    unfollowed_user_ids  = mongo.ListField(mongo.IntField())
-    requested_follow_user_ids = mongo.ListField(mongo.IntField())
+    # Follows live in RSocialGraph. These only hold lists not yet moved over by
+    # `migrate_social_graph`, which then unsets them.
+    legacy_following_user_ids  = mongo.ListField(mongo.IntField(), db_field='following_user_ids')
+    legacy_follower_user_ids   = mongo.ListField(mongo.IntField(), db_field='follower_user_ids')
+    legacy_unfollowed_user_ids = mongo.ListField(mongo.IntField(), db_field='unfollowed_user_ids')
+    legacy_requested_follow_user_ids = mongo.ListField(mongo.IntField(), db_field='requested_follow_user_ids')
     popular_publishers   = mongo.StringField()
     stories_last_month   = mongo.IntField(default=0)
     average_stories_per_month = mongo.IntField(default=0)
@@ -127,9 +131,11 @@ class MSocialProfile(mongo.Document):
     protected            = mongo.BooleanField()
     private              = mongo.BooleanField()
     
+    COMPACT_PROFILE_TTL  = 60 * 60 * 24
+    
     meta = {
         'collection': 'social_profile',
-        'indexes': ['user_id', 'following_user_ids', 'follower_user_ids', 'unfollowed_user_ids', 'requested_follow_user_ids'],
+        'indexes': ['user_id'],
         'allow_inheritance': False,
         'index_drop_dups': True,
     }
@@ -145,6 +151,34 @@ class MSocialProfile(mongo.Document):
             profile.save()
         return profile
         
+    @classmethod
+    def compact_profiles(cls, user_ids):
+        """
+        Compact to_json for each of `user_ids`, read from the SPC:<user_id> cache
+        where possible, so a page of stories costs one redis round trip and at most
+        one mongo query for the profiles that aren't cached yet.
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return []
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        cached = r.mget(["SPC:%s" % user_id for user_id in user_ids])
+        profiles = [json.decode(profile) for profile in cached if profile]
+        missing = [user_id for user_id, profile in zip(user_ids, cached) if not profile]
+        if missing:
+            p = r.pipeline()
+            for profile in cls.objects.filter(user_id__in=missing):
+                profile = profile.to_json(compact=True)
+                profiles.append(profile)
+                p.setex("SPC:%s" % profile['user_id'], json.encode(profile), cls.COMPACT_PROFILE_TTL)
+            p.execute()
+        return profiles
+    
+    @staticmethod
+    def expire_compact_profile(user_id):
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        r.delete("SPC:%s" % user_id)
+        
     def save(self, *args, **kwargs):
         if not self.username:
             self.import_user_fields()
@@ -162,9 +196,9 @@ class MSocialProfile(mongo.Document):
             self.custom_css = strip_tags(self.custom_css)
             
         super(MSocialProfile, self).save(*args, **kwargs)
-        if self.user_id not in self.following_user_ids:
+        self.expire_compact_profile(self.user_id)
+        if not self.is_following_user(self.user_id):
             self.follow_user(self.user_id, force=True)
-            self.count_follows()
         
         return self
             
@@ -271,13 +305,13 @@ class MSocialProfile(mongo.Document):
             profile.sync_redis(force=True)
     
     def sync_redis(self, force=False):
-        self.following_user_ids = list(set(self.following_user_ids))
-        self.save()
-        
-        for user_id in self.following_user_ids:
-            self.follow_user(user_id, force=force)
-        
-        self.follow_user(self.user_id)
+        RSocialGraph.import_lists(self.user_id,
+                                  following=self.legacy_following_user_ids,
+                                  followers=self.legacy_follower_user_ids,
+                                  unfollowed=self.legacy_unfollowed_user_ids,
+                                  requested=self.legacy_requested_follow_user_ids)
+        self.follow_user(self.user_id, force=force)
+        self.count_follows()
     
     @property
     def title(self):
@@ -376,7 +410,7 @@ class MSocialProfile(mongo.Document):
             params['followers_everybody'] = followers_everybody[:FOLLOWERS_LIMIT]
             params['following_youknow'] = following_youknow[:FOLLOWERS_LIMIT]
             params['following_everybody'] = following_everybody[:FOLLOWERS_LIMIT]
-            params['requested_follow'] = common_follows_with_user in self.requested_follow_user_ids
+            params['requested_follow'] = self.is_requested_by_user(common_follows_with_user)
         if include_following_user or common_follows_with_user:
             if not include_following_user:
                 include_following_user = common_follows_with_user
@@ -386,17 +420,47 @@ class MSocialProfile(mongo.Document):
 
         return params
     
+    @classmethod
+    def profiles_to_json(cls, profiles, following_user_id):
+        """
+        to_json(include_following_user=following_user_id) for a list of profiles,
+        with every profile's follows checked in one round trip.
+        """
+        profiles = list(profiles)
+        relationships = RSocialGraph.relationships(following_user_id, [p.user_id for p in profiles])
+        profiles_json = []
+        for profile in profiles:
+            params = profile.to_json()
+            if profile.user_id != following_user_id:
+                followed_by_you, following_you = relationships[profile.user_id]
+                params['followed_by_you'] = followed_by_you
+                params['following_you'] = following_you
+            profiles_json.append(params)
+        return profiles_json
+    
+    @property
+    def following_user_ids(self):
+        return RSocialGraph.following(self.user_id)
+    
+    @property
+    def follower_user_ids(self):
+        return RSocialGraph.followers(self.user_id)
+    
+    @property
+    def unfollowed_user_ids(self):
+        return RSocialGraph.unfollowed(self.user_id)
+    
+    @property
+    def requested_follow_user_ids(self):
+        return RSocialGraph.requested(self.user_id)
+    
     @property
     def following_user_ids_without_self(self):
-        if self.user_id in self.following_user_ids:
-            return [u for u in self.following_user_ids if u != self.user_id]
-        return self.following_user_ids
+        return [u for u in self.following_user_ids if u != self.user_id]
         
     @property
     def follower_user_ids_without_self(self):
-        if self.user_id in self.follower_user_ids:
-            return [u for u in self.follower_user_ids if u != self.user_id]
-        return self.follower_user_ids
+        return [u for u in self.follower_user_ids if u != self.user_id]
         
     def import_user_fields(self, skip_save=False):
         user = User.objects.get(pk=self.user_id)
@@ -406,15 +470,22 @@ class MSocialProfile(mongo.Document):
     def count_follows(self, skip_save=False):
         self.subscription_count = UserSubscription.objects.filter(user__pk=self.user_id).count()
         self.shared_stories_count = MSharedStory.objects.filter(user_id=self.user_id).count()
-        self.following_count = len(self.following_user_ids_without_self)
-        self.follower_count = len(self.follower_user_ids_without_self)
+        self.following_count, self.follower_count = RSocialGraph.counts(self.user_id)
         if not skip_save:
             self.save()
+    
+    def count_follows_only(self):
+        """
+        Refreshes just the follow counts, from the graph's set sizes, without
+        recounting subscriptions and shares or saving the whole profile.
+        """
+        self.following_count, self.follower_count = RSocialGraph.counts(self.user_id)
+        MSocialProfile.objects(user_id=self.user_id).update_one(set__following_count=self.following_count,
+                                                                set__follower_count=self.follower_count)
+        self.expire_compact_profile(self.user_id)
         
     def follow_user(self, user_id, check_unfollowed=False, force=False):
-        r = redis.Redis(connection_pool=settings.REDIS_POOL)
-        
-        if check_unfollowed and user_id in self.unfollowed_user_ids:
+        if check_unfollowed and RSocialGraph.has_unfollowed(self.user_id, user_id):
             return
             
         if self.user_id == user_id:
@@ -424,37 +495,26 @@ class MSocialProfile(mongo.Document):
         
         logging.debug(" ---> ~FB~SB%s~SN (%s) following %s" % (self.username, self.user_id, user_id))
         
-        if not followee.protected or force:
-            if user_id not in self.following_user_ids:
-                self.following_user_ids.append(user_id)
-            elif not force:
-                return
-            
-        if user_id in self.unfollowed_user_ids:
-            self.unfollowed_user_ids.remove(user_id)
-        self.count_follows()
-        self.save()
+        requesting = followee.protected and user_id != self.user_id and not force
+        if not requesting and not force and self.is_following_user(user_id):
+            return
         
-        if followee.protected and user_id != self.user_id and not force:
-            if self.user_id not in followee.requested_follow_user_ids:
-                followee.requested_follow_user_ids.append(self.user_id)
+        if requesting:
+            if not followee.is_requested_by_user(self.user_id):
+                RSocialGraph.request(self.user_id, user_id)
                 MFollowRequest.add(self.user_id, user_id)
-        elif self.user_id not in followee.follower_user_ids:
-            followee.follower_user_ids.append(self.user_id)
-        followee.count_follows()
-        followee.save()
+        else:
+            RSocialGraph.follow(self.user_id, user_id)
+        self.count_follows_only()
+        if followee is not self:
+            followee.count_follows_only()
 
-        if followee.protected and user_id != self.user_id and not force:
+        if requesting:
             from apps.social.tasks import EmailFollowRequest
             EmailFollowRequest.apply_async(kwargs=dict(follower_user_id=self.user_id,
                                                        followee_user_id=user_id),
                                            countdown=settings.SECONDS_TO_DELAY_CELERY_EMAILS)
             return
-            
-        following_key = "F:%s:F" % (self.user_id)
-        r.sadd(following_key, user_id)
-        follower_key = "F:%s:f" % (user_id)
-        r.sadd(follower_key, self.user_id)
 
         if user_id != self.user_id:
             MInteraction.new_follow(follower_user_id=self.user_id, followee_user_id=user_id)
@@ -476,16 +536,15 @@ class MSocialProfile(mongo.Document):
         return socialsub
     
     def is_following_user(self, user_id):
-        # XXX TODO: Outsource to redis
-        return user_id in self.following_user_ids
+        return RSocialGraph.is_following(self.user_id, user_id)
     
     def is_followed_by_user(self, user_id):
-        # XXX TODO: Outsource to redis
-        return user_id in self.follower_user_ids
+        return RSocialGraph.is_followed_by(self.user_id, user_id)
+    
+    def is_requested_by_user(self, user_id):
+        return RSocialGraph.has_requested(self.user_id, user_id)
         
     def unfollow_user(self, user_id):
-        r = redis.Redis(connection_pool=settings.REDIS_POOL)
-        
         if not isinstance(user_id, int):
             user_id = int(user_id)
         
@@ -493,29 +552,14 @@ class MSocialProfile(mongo.Document):
             # Only unfollow other people, not yourself.
             return
 
-        if user_id in self.following_user_ids:
-            self.following_user_ids.remove(user_id)
-        if user_id not in self.unfollowed_user_ids:
-            self.unfollowed_user_ids.append(user_id)
-        self.count_follows()
-        self.save()
-        
         followee = MSocialProfile.get_user(user_id)
-        if self.user_id in followee.follower_user_ids:
-            followee.follower_user_ids.remove(self.user_id)
-            followee.count_follows()
-            followee.save()
-        if self.user_id in followee.requested_follow_user_ids:
-            followee.requested_follow_user_ids.remove(self.user_id)
-            followee.count_follows()
-            followee.save()
+        requested = followee.is_requested_by_user(self.user_id)
+        RSocialGraph.unfollow(self.user_id, user_id)
+        self.count_follows_only()
+        followee.count_follows_only()
+        if requested:
             MFollowRequest.remove(self.user_id, user_id)
         
-        following_key = "F:%s:F" % (self.user_id)
-        r.srem(following_key, user_id)
-        follower_key = "F:%s:f" % (user_id)
-        r.srem(follower_key, self.user_id)
-        
         try:
             MSocialSubscription.objects.get(user_id=self.user_id, subscription_user_id=user_id).delete()
         except MSocialSubscription.DoesNotExist:
@@ -540,7 +584,7 @@ class MSocialProfile(mongo.Document):
     
     def send_email_for_new_follower(self, follower_user_id):
         user = User.objects.get(pk=self.user_id)
-        if follower_user_id not in self.follower_user_ids:
+        if not self.is_followed_by_user(follower_user_id):
             logging.user(user, "~FMNo longer being followed by %s" % follower_user_id)
             return
         if not user.email:
@@ -594,7 +638,7 @@ class MSocialProfile(mongo.Document):
 
     def send_email_for_follow_request(self, follower_user_id):
         user = User.objects.get(pk=self.user_id)
-        if follower_user_id not in self.requested_follow_user_ids:
+        if not self.is_requested_by_user(follower_user_id):
             logging.user(user, "~FMNo longer being followed by %s" % follower_user_id)
             return
         if not user.email:
@@ -924,23 +968,30 @@ class MSocialSubscription(mongo.Document):
                 return story_hashes, story_dates, read_story_hashes
             else:
                 return [], [], []
-        else:
-            r.delete(ranked_stories_keys)
-            r.delete(read_ranked_stories_keys)
-        
-        for social_user_id in social_user_ids:
-            us = cls.objects.get(user_id=relative_user_id, subscription_user_id=social_user_id)
-            story_hashes = us.get_stories(offset=0, limit=100,
-                                          order=order, read_filter=read_filter, 
-                                          withscores=True)
-            if story_hashes:
-                r.zadd(ranked_stories_keys, **dict(story_hashes))
         
-        r.zinterstore(read_ranked_stories_keys, [ranked_stories_keys, "RS:%s" % user_id])
-        story_hashes = range_func(ranked_stories_keys, offset, limit, withscores=True)
-        read_story_hashes = range_func(read_ranked_stories_keys, offset, limit)
-        r.expire(ranked_stories_keys, 24*60*60)
-        r.expire(read_ranked_stories_keys, 24*60*60)
+        socialsubs = cls.objects.filter(user_id=relative_user_id,
+                                        subscription_user_id__in=social_user_ids)\
+                                .only('user_id', 'subscription_user_id', 'mark_read_date')
+        social_story_hashes = cls.batch_feed_stories(socialsubs, order=order,
+                                                     read_filter=read_filter, r=r)
+        
+        ranked_story_hashes = {}
+        for story_hashes in social_story_hashes.values():
+            ranked_story_hashes.update(story_hashes)
+        p = r.pipeline()
+        p.delete(ranked_stories_keys, read_ranked_stories_keys)
+        if ranked_story_hashes:
+            p.zadd(ranked_stories_keys, **ranked_story_hashes)
+        p.zinterstore(read_ranked_stories_keys, [ranked_stories_keys, "RS:%s" % user_id])
+        if order == 'oldest':
+            p.zrange(ranked_stories_keys, offset, limit, withscores=True)
+            p.zrange(read_ranked_stories_keys, offset, limit)
+        else:
+            p.zrevrange(ranked_stories_keys, offset, limit, withscores=True)
+            p.zrevrange(read_ranked_stories_keys, offset, limit)
+        p.expire(ranked_stories_keys, 24*60*60)
+        p.expire(read_ranked_stories_keys, 24*60*60)
+        story_hashes, read_story_hashes = p.execute()[-4:-2]
 
         if story_hashes:
             story_hashes, story_dates = zip(*story_hashes)
@@ -948,17 +999,113 @@ class MSocialSubscription(mongo.Document):
         else:
             return [], [], []
         
+    @classmethod
+    def batch_feed_stories(cls, socialsubs, order='newest', read_filter='all', limit=100, r=None):
+        """
+        Computes the ranked story hashes for many social subscriptions at once.
+        
+        Does the same work as calling `get_stories` with scores for each followed
+        user, but queues every blurblog's SDIFFSTORE/ZINTERSTORE/ZRANGEBYSCORE into
+        a single pipeline, so the number of round trips no longer grows with the
+        number of users followed.
+        
+        Returns {subscription_user_id: [(story_hash, score), ...]}.
+        """
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline()
+        
+        current_time  = int(time.time() + 60*60*24)
+        two_weeks_ago = datetime.datetime.now() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
+        all_min_score = int(time.mktime(two_weeks_ago.timetuple()))-1000
+        
+        social_user_ids = []
+        for socialsub in socialsubs:
+            social_user_ids.append(socialsub.subscription_user_id)
+            stories_key                = 'B:%s' % (socialsub.subscription_user_id)
+            sorted_stories_key         = 'zB:%s' % (socialsub.subscription_user_id)
+            read_stories_key           = 'RS:%s' % (socialsub.user_id)
+            unread_stories_key         = 'UB:%s:%s' % (socialsub.user_id, socialsub.subscription_user_id)
+            unread_ranked_stories_key  = 'zUB:%s:%s' % (socialsub.user_id, socialsub.subscription_user_id)
+            
+            # A missing RS key diffs to the whole blurblog, same as get_stories' fallback,
+            # and diffing against nothing copies it, so the scores pick up the same +1.
+            if read_filter == 'unread':
+                p.sdiffstore(unread_stories_key, stories_key, read_stories_key)
+            else:
+                p.sdiffstore(unread_stories_key, stories_key)
+            p.zinterstore(unread_ranked_stories_key, [sorted_stories_key, unread_stories_key])
+            
+            if order == 'oldest':
+                mark_read_time = int(time.mktime(socialsub.mark_read_date.timetuple())) + 1
+                p.zrangebyscore(unread_ranked_stories_key, mark_read_time, current_time,
+                                start=0, num=limit, withscores=True)
+            else:
+                p.zrevrangebyscore(unread_ranked_stories_key, current_time, all_min_score,
+                                   start=0, num=limit, withscores=True)
+            p.delete(unread_stories_key, unread_ranked_stories_key)
+        
+        results = p.execute() if social_user_ids else []
+        
+        social_story_hashes = {}
+        for i, social_user_id in enumerate(social_user_ids):
+            # Four commands per blurblog: sdiffstore, zinterstore, ranked, delete.
+            story_hashes = results[i*4+2]
+            if story_hashes:
+                social_story_hashes[social_user_id] = story_hashes
+        
+        return social_story_hashes
+        
+    @classmethod
+    def mark_stories_as_read(cls, user_id, stories, social_user_ids=None, mark_all_read=False):
+        """
+        Marks many (feed_id, story_hash) pairs read for `user_id` at once. The read
+        sets go out in one pipeline and the blurblogs of friends who shared any of
+        the stories are found with one more, then all of them, along with
+        `social_user_ids`, are flagged needs_unread_recalc in a single update.
+        Feed subscriptions keep their own unread counts current as stories are
+        marked, so only those without live counters are flagged, in one more.
+        """
+        stories = set((int(feed_id), RUserStory.story_hash(story_hash, story_feed_id=feed_id))
+                      for feed_id, story_hash in stories if feed_id)
+        stories = set((feed_id, story_hash) for feed_id, story_hash in stories if story_hash)
+        if not stories:
+            return set()
+        RUserStory.mark_stories_read(user_id, stories)
+        
+        usersubs = list(UserSubscription.objects.filter(user=user_id, needs_unread_recalc=False,
+                                                        feed__in=set(feed_id for feed_id, _ in stories)))
+        live_feed_ids = set(us.feed_id for us in RUserUnreadCount.live_subscriptions(usersubs))
+        non_live_ids = [us.feed_id for us in usersubs if us.feed_id not in live_feed_ids]
+        if non_live_ids:
+            UserSubscription.objects.filter(user=user_id, feed__in=non_live_ids).update(needs_unread_recalc=True)
+        
+        if mark_all_read:
+            return set()
+        
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        friend_key = "F:%s:F" % (user_id)
+        p = r.pipeline()
+        for story_hash in set(story_hash for _, story_hash in stories):
+            p.sinter("S:%s" % story_hash, friend_key)
+        recalc_user_ids = set()
+        for friends_with_shares in p.execute():
+            recalc_user_ids.update(int(f) for f in friends_with_shares)
+        recalc_user_ids.discard(user_id)
+        recalc_user_ids.update(social_user_ids or [])
+        
+        if recalc_user_ids:
+            cls.objects(user_id=user_id, subscription_user_id__in=list(recalc_user_ids),
+                        needs_unread_recalc=False).update(set__needs_unread_recalc=True)
+        
+        return recalc_user_ids
+        
     def mark_story_ids_as_read(self, story_hashes, feed_id=None, mark_all_read=False, request=None):
         data = dict(code=0, payload=story_hashes)
-        r = redis.Redis(connection_pool=settings.REDIS_POOL)
         
         if not request:
             request = User.objects.get(pk=self.user_id)
     
-        if not self.needs_unread_recalc and not mark_all_read:
-            self.needs_unread_recalc = True
-            self.save()
-    
         sub_username = MSocialProfile.get_user(self.subscription_user_id).username
         
         if len(story_hashes) > 1:
@@ -966,33 +1113,13 @@ class MSocialSubscription(mongo.Document):
         else:
             logging.user(request, "~FYRead story in social subscription: %s" % (sub_username))
         
-        for story_hash in set(story_hashes):
-            if not feed_id:
-                feed_id, _ = RUserStory.split_story_hash(story_hash)
-            RUserStory.mark_read(self.user_id, feed_id, story_hash)
-            
-            # Find other social feeds with this story to update their counts
-            friend_key = "F:%s:F" % (self.user_id)
-            share_key = "S:%s" % (story_hash)
-            friends_with_shares = [int(f) for f in r.sinter(share_key, friend_key)]
-            if self.user_id in friends_with_shares:
-                friends_with_shares.remove(self.user_id)
-            if friends_with_shares:
-                socialsubs = MSocialSubscription.objects.filter(
-                                user_id=self.user_id,
-                                subscription_user_id__in=friends_with_shares)
-                for socialsub in socialsubs:
-                    if not socialsub.needs_unread_recalc and not mark_all_read:
-                        socialsub.needs_unread_recalc = True
-                        socialsub.save()
-            
-            # Also count on original subscription
-            usersubs = UserSubscription.objects.filter(user=self.user_id, feed=feed_id)
-            if usersubs:
-                usersub = usersubs[0]
-                if not usersub.needs_unread_recalc:
-                    usersub.needs_unread_recalc = True
-                    usersub.save()
+        stories = [(feed_id or RUserStory.split_story_hash(story_hash)[0], story_hash)
+                   for story_hash in story_hashes]
+        self.mark_stories_as_read(self.user_id, stories, 
+                                  social_user_ids=[self.subscription_user_id],
+                                  mark_all_read=mark_all_read)
+        if not mark_all_read:
+            self.needs_unread_recalc = True
         
         return data
         
@@ -1009,23 +1136,13 @@ class MSocialSubscription(mongo.Document):
         else:
             logging.user(request, "~FYRead social story from global")
         
-        for story_id in set(story_ids):
-            try:
-                story = MSharedStory.objects.get(user_id=social_user_id,
-                                                 story_guid=story_id)
-            except MSharedStory.DoesNotExist:
-                continue
-                
-            RUserStory.mark_read(user_id, story.story_feed_id, story.story_hash)
-            
-            # Also count on original subscription
-            usersubs = UserSubscription.objects.filter(user=user_id, feed=story.story_feed_id)
-            if usersubs:
-                usersub = usersubs[0]
-                if not usersub.needs_unread_recalc:
-                    usersub.needs_unread_recalc = True
-                    usersub.save()
-                # XXX TODO: Real-time notification, just for this user
+        shared_stories = MSharedStory.objects(user_id=social_user_id,
+                                              story_guid__in=list(set(story_ids))
+                                              ).only('story_feed_id', 'story_hash')
+        cls.mark_stories_as_read(user_id, [(story.story_feed_id, story.story_hash)
+                                           for story in shared_stories])
+        # XXX TODO: Real-time notification, just for this user
+        
         return data
     
     def mark_feed_read(self):
@@ -1290,6 +1407,7 @@ class MSharedStory(mongo.Document):
 
         self.shared_date = self.shared_date or datetime.datetime.utcnow()
         self.has_replies = bool(len(self.replies))
+        new_share = not self.id
 
         super(MSharedStory, self).save(*args, **kwargs)
         
@@ -1297,6 +1415,8 @@ class MSharedStory(mongo.Document):
         author.count_follows()
         
         self.sync_redis()
+        if new_share:
+            RTrendingStories.add(self.story_hash, self.shared_date)
         
         MActivity.new_shared_story(user_id=self.user_id, source_user_id=self.source_user_id, 
                                    story_title=self.story_title, 
@@ -1309,6 +1429,7 @@ class MSharedStory(mongo.Document):
                                       story_id=self.story_guid)
 
         self.remove_from_redis()
+        RTrendingStories.remove(self.story_hash, self.shared_date)
 
         super(MSharedStory, self).delete(*args, **kwargs)
     
@@ -1411,62 +1532,33 @@ class MSharedStory(mongo.Document):
             story.save()
         
     @classmethod
-    def collect_popular_stories(cls, cutoff=None, days=None):
-        if not days: days = 1
-        # shared_stories_count = sum(json.decode(MStatistics.get('stories_shared')))
-        # cutoff = cutoff or max(math.floor(.025 * shared_stories_count), 3)
-        cutoff = cutoff or 10
-        today = datetime.datetime.now() - datetime.timedelta(days=days)
-        
-        map_f = """
-            function() {
-                emit(this.story_guid, {
-                    'guid': this.story_guid, 
-                    'feed_id': this.story_feed_id, 
-                    'title': this.story_title,
-                    'count': 1
-                });
-            }
-        """
-        reduce_f = """
-            function(key, values) {
-                var r = {'guid': key, 'count': 0};
-                for (var i=0; i < values.length; i++) {
-                    r.feed_id = values[i].feed_id;
-                    r.title = values[i].title;
-                    r.count += 1;
-                }
-                return r;
-            }
-        """
-        finalize_f = """
-            function(key, value) {
-                if (value.count >= %(cutoff)s) {
-                    var english_title = value.title.replace(/[^\\062-\\177]/g, "");
-                    if (english_title.length < 5) return;
-                    
-                    return value;
-                }
-            }
-        """ % {'cutoff': cutoff}
-        res = cls.objects(shared_date__gte=today).map_reduce(map_f, reduce_f, 
-                                                             finalize_f=finalize_f, 
-                                                             output='inline')
-        stories = dict([(r.key, r.value) for r in res if r.value])
-        return stories, cutoff
-        
-    @classmethod
-    def share_popular_stories(cls, cutoff=None, days=None, interactive=True):
+    def share_popular_stories(cls, cutoff=None, limit=50, interactive=True):
         publish_new_stories = False
         popular_profile = MSocialProfile.objects.get(username='popular')
         popular_user = User.objects.get(pk=popular_profile.user_id)
-        shared_stories_today, cutoff = cls.collect_popular_stories(cutoff=cutoff, days=days)
+        cutoff = cutoff or RTrendingStories.CUTOFF
+        trending = RTrendingStories.top(limit=limit, cutoff=cutoff)
+        story_hashes = [story_hash for story_hash, _ in trending]
+        if not story_hashes:
+            return 0
+        
+        already_shared = set(s.story_hash for s in cls.objects(user_id=popular_profile.user_id,
+                                                               story_hash__in=story_hashes)
+                                                      .only('story_hash'))
+        stories = dict((s.story_hash, s) for s in 
+                       MStory.objects(story_hash__in=[h for h in story_hashes 
+                                                      if h not in already_shared]))
         shared = 0
         
-        for guid, story_info in shared_stories_today.items():
-            story, _ = MStory.find_story(story_info['feed_id'], story_info['guid'])
+        for story_hash, shares in trending:
+            if story_hash in already_shared:
+                continue
+            story = stories.get(story_hash)
             if not story:
-                logging.user(popular_user, "~FRPopular stories, story not found: %s" % story_info)
+                logging.user(popular_user, "~FRPopular stories, story not found: %s" % story_hash)
+                continue
+            english_title = re.sub(r'[^\x32-\x7f]', '', story.story_title or '')
+            if len(english_title) < 5:
                 continue
             
             if interactive:
@@ -1491,16 +1583,14 @@ class MSharedStory(mongo.Document):
             if created:
                 shared += 1
                 publish_new_stories = True
-                logging.user(popular_user, "~FCSharing: ~SB~FM%s (%s shares, %s min)" % (
+                logging.user(popular_user, "~FCSharing: ~SB~FM%s (%.1f shares, %s min)" % (
                     story.story_title[:50],
-                    story_info['count'],
+                    shares,
                     cutoff))
 
         if publish_new_stories:
-            socialsubs = MSocialSubscription.objects.filter(subscription_user_id=popular_user.pk)
-            for socialsub in socialsubs:
-                socialsub.needs_unread_recalc = True
-                socialsub.save()
+            MSocialSubscription.objects(subscription_user_id=popular_user.pk,
+                                        needs_unread_recalc=False).update(set__needs_unread_recalc=True)
             shared_story.publish_update_to_subscribers()
         
         return shared
@@ -1592,33 +1682,68 @@ class MSharedStory(mongo.Document):
         profile_user_ids = profile_user_ids.union(comment['liking_users'])
         if comment['source_user_id']:
             profile_user_ids.add(comment['source_user_id'])
-        profiles = MSocialProfile.objects.filter(user_id__in=list(profile_user_ids))
-        profiles = [profile.to_json(compact=True) for profile in profiles]
+        profiles = MSocialProfile.compact_profiles(profile_user_ids)
 
         return comment, profiles
         
     @classmethod
     def stories_with_comments_and_profiles(cls, stories, user_id, check_all=False):
+        """
+        Hydrates a page of stories with their comments, shares and the profiles
+        they mention. Every story's set operations go out in one redis pipeline
+        and every story's comments come back from one mongo query, so a page costs
+        the same number of round trips no matter how many stories it has.
+        """
         r = redis.Redis(connection_pool=settings.REDIS_POOL)
         friend_key = "F:%s:F" % (user_id)
         profile_user_ids = set()
+        
+        p = r.pipeline()
         for story in stories: 
             story['friend_comments'] = []
             story['public_comments'] = []
             story['reply_count'] = 0
-            if check_all or story['comment_count']:
+            story['_check_comments'] = check_all or story['comment_count']
+            story['_check_shares'] = check_all or story['share_count']
+            if story['_check_comments']:
                 comment_key = "C:%s:%s" % (story['story_feed_id'], story['guid_hash'])
-                story['comment_count'] = r.scard(comment_key)
-                friends_with_comments = [int(f) for f in r.sinter(comment_key, friend_key)]
-                sharer_user_ids = [int(f) for f in r.smembers(comment_key)]
-                shared_stories = []
-                if sharer_user_ids:
-                    params = {
-                        'story_hash': story['story_hash'],
-                        'user_id__in': sharer_user_ids,
-                    }
-                    shared_stories = cls.objects.filter(**params)
-                for shared_story in shared_stories:
+                p.scard(comment_key)
+                p.sinter(comment_key, friend_key)
+                p.smembers(comment_key)
+            if story['_check_shares']:
+                share_key = "S:%s:%s" % (story['story_feed_id'], story['guid_hash'])
+                p.scard(share_key)
+                p.sinter(share_key, friend_key)
+                p.sdiff(share_key, friend_key)
+        results = iter(p.execute())
+        
+        sharers = {}
+        shares = {}
+        for story in stories:
+            if story['_check_comments']:
+                story['comment_count'] = results.next()
+                story['_friends_with_comments'] = [int(f) for f in results.next()]
+                sharers[story['story_hash']] = set(int(f) for f in results.next())
+            if story['_check_shares']:
+                story['share_count'] = results.next()
+                story['_friends_with_shares'] = [int(f) for f in results.next()]
+                story['_nonfriend_user_ids'] = [int(f) for f in results.next()]
+        
+        story_hashes = [story_hash for story_hash, user_ids in sharers.items() if user_ids]
+        if story_hashes:
+            sharer_user_ids = set.union(*[sharers[story_hash] for story_hash in story_hashes])
+            shared_stories = cls.objects.filter(story_hash__in=story_hashes,
+                                                user_id__in=list(sharer_user_ids))
+            for shared_story in shared_stories:
+                if shared_story.user_id in sharers[shared_story.story_hash]:
+                    shares.setdefault(shared_story.story_hash, []).append(shared_story)
+        
+        for story in stories:
+            check_comments = story.pop('_check_comments')
+            check_shares = story.pop('_check_shares')
+            if check_comments:
+                friends_with_comments = story.pop('_friends_with_comments')
+                for shared_story in shares.get(story['story_hash'], []):
                     comments = shared_story.comments_with_author()
                     story['reply_count'] += len(comments['replies'])
                     if shared_story.user_id in friends_with_comments:
@@ -1638,11 +1763,9 @@ class MSharedStory(mongo.Document):
                 story['comment_count_friends'] = len(friends_with_comments)
                 story['comment_count_public'] = story['comment_count'] - len(friends_with_comments)
                 
-            if check_all or story['share_count']:
-                share_key = "S:%s:%s" % (story['story_feed_id'], story['guid_hash'])
-                story['share_count'] = r.scard(share_key)
-                friends_with_shares = [int(f) for f in r.sinter(share_key, friend_key)]
-                nonfriend_user_ids = [int(f) for f in r.sdiff(share_key, friend_key)]
+            if check_shares:
+                friends_with_shares = story.pop('_friends_with_shares')
+                nonfriend_user_ids = story.pop('_nonfriend_user_ids')
                 profile_user_ids.update(nonfriend_user_ids)
                 profile_user_ids.update(friends_with_shares)
                 story['commented_by_public']  = [c['user_id'] for c in story['public_comments']]
@@ -1660,8 +1783,7 @@ class MSharedStory(mongo.Document):
                 if story.get('source_user_id'):
                     profile_user_ids.add(story['source_user_id'])
             
-        profiles = MSocialProfile.objects.filter(user_id__in=list(profile_user_ids))
-        profiles = [profile.to_json(compact=True) for profile in profiles]
+        profiles = MSocialProfile.compact_profiles(profile_user_ids)
         
         # Toss public comments by private profiles
         profiles_dict = dict((profile['user_id'], profile) for profile in profiles)
@@ -1949,12 +2071,12 @@ class MSharedStory(mongo.Document):
         
         return image_sizes
     
-    def fetch_original_text(self, force=False, request=None):
+    def fetch_original_text(self, force=False, request=None, timeout=None):
         original_text_z = self.original_text_z
         
         if not original_text_z or force:
-            ti = TextImporter(self, request=request)
-            original_text = ti.fetch()
+            original_text = ROriginalText.fetch_story(self, force=force, request=request,
+                                                      timeout=timeout)
         else:
             logging.user(request, "~FYFetching ~FGoriginal~FY story text, ~SBfound.")
             original_text = zlib.decompress(original_text_z)
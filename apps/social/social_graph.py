@@ -0,0 +1,144 @@
+import redis
+from django.conf import settings
+
+
+class RSocialGraph(object):
+    """
+    Who follows whom, as redis sets instead of arrays on MSocialProfile, so a
+    popular profile's document doesn't grow and get rewritten with every follower:
+
+        F:<user_id>:F   users <user_id> follows
+        F:<user_id>:f   users following <user_id>
+        F:<user_id>:U   users <user_id> has unfollowed
+        F:<user_id>:R   users waiting on <user_id> to approve their follow request
+
+    Everyone follows themselves, which the counts leave out.
+    """
+
+    FOLLOWING  = 'F'
+    FOLLOWERS  = 'f'
+    UNFOLLOWED = 'U'
+    REQUESTED  = 'R'
+
+    @classmethod
+    def redis(cls):
+        return redis.Redis(connection_pool=settings.REDIS_POOL)
+
+    @staticmethod
+    def key(user_id, kind):
+        return "F:%s:%s" % (user_id, kind)
+
+    @classmethod
+    def members(cls, user_id, kind):
+        return [int(u) for u in cls.redis().smembers(cls.key(user_id, kind))]
+
+    @classmethod
+    def following(cls, user_id):
+        return cls.members(user_id, cls.FOLLOWING)
+
+    @classmethod
+    def followers(cls, user_id):
+        return cls.members(user_id, cls.FOLLOWERS)
+
+    @classmethod
+    def unfollowed(cls, user_id):
+        return cls.members(user_id, cls.UNFOLLOWED)
+
+    @classmethod
+    def requested(cls, user_id):
+        return cls.members(user_id, cls.REQUESTED)
+
+    @classmethod
+    def is_following(cls, user_id, followee_user_id):
+        return cls.redis().sismember(cls.key(user_id, cls.FOLLOWING), followee_user_id)
+
+    @classmethod
+    def is_followed_by(cls, user_id, follower_user_id):
+        return cls.redis().sismember(cls.key(user_id, cls.FOLLOWERS), follower_user_id)
+
+    @classmethod
+    def has_unfollowed(cls, user_id, followee_user_id):
+        return cls.redis().sismember(cls.key(user_id, cls.UNFOLLOWED), followee_user_id)
+
+    @classmethod
+    def has_requested(cls, user_id, follower_user_id):
+        """ Whether `follower_user_id` is waiting on `user_id` to approve them. """
+        return cls.redis().sismember(cls.key(user_id, cls.REQUESTED), follower_user_id)
+
+    @classmethod
+    def counts(cls, user_id):
+        """ (following, followers) for `user_id`, not counting themselves. """
+        following_key = cls.key(user_id, cls.FOLLOWING)
+        followers_key = cls.key(user_id, cls.FOLLOWERS)
+        p = cls.redis().pipeline()
+        p.scard(following_key)
+        p.sismember(following_key, user_id)
+        p.scard(followers_key)
+        p.sismember(followers_key, user_id)
+        following, following_self, followers, followed_by_self = p.execute()
+        return following - int(bool(following_self)), followers - int(bool(followed_by_self))
+
+    @classmethod
+    def relationships(cls, user_id, user_ids):
+        """
+        Who of `user_ids` does `user_id` follow, and who follows them back, in one
+        round trip: {other_user_id: (user_id follows them, they follow user_id)}.
+        """
+        user_ids = list(user_ids)
+        p = cls.redis().pipeline()
+        for other_user_id in user_ids:
+            p.sismember(cls.key(user_id, cls.FOLLOWING), other_user_id)
+            p.sismember(cls.key(user_id, cls.FOLLOWERS), other_user_id)
+        results = p.execute()
+        return dict((other_user_id, (bool(results[i*2]), bool(results[i*2+1])))
+                    for i, other_user_id in enumerate(user_ids))
+
+    @classmethod
+    def follow(cls, user_id, followee_user_id):
+        p = cls.redis().pipeline()
+        p.sadd(cls.key(user_id, cls.FOLLOWING), followee_user_id)
+        p.sadd(cls.key(followee_user_id, cls.FOLLOWERS), user_id)
+        p.srem(cls.key(user_id, cls.UNFOLLOWED), followee_user_id)
+        p.srem(cls.key(followee_user_id, cls.REQUESTED), user_id)
+        p.execute()
+
+    @classmethod
+    def request(cls, user_id, followee_user_id):
+        p = cls.redis().pipeline()
+        p.sadd(cls.key(followee_user_id, cls.REQUESTED), user_id)
+        p.srem(cls.key(user_id, cls.UNFOLLOWED), followee_user_id)
+        p.execute()
+
+    @classmethod
+    def unfollow(cls, user_id, followee_user_id):
+        p = cls.redis().pipeline()
+        p.srem(cls.key(user_id, cls.FOLLOWING), followee_user_id)
+        p.srem(cls.key(followee_user_id, cls.FOLLOWERS), user_id)
+        p.sadd(cls.key(user_id, cls.UNFOLLOWED), followee_user_id)
+        p.srem(cls.key(followee_user_id, cls.REQUESTED), user_id)
+        p.execute()
+
+    @classmethod
+    def import_lists(cls, user_id, following=None, followers=None, unfollowed=None, requested=None):
+        """
+        Adds a profile's follow lists, as once stored on MSocialProfile, to its
+        sets. Follows are added to both sides, so each pair ends up consistent
+        whichever of the two profiles is imported first.
+        """
+        p = cls.redis().pipeline()
+        for followee_user_id in following or []:
+            p.sadd(cls.key(user_id, cls.FOLLOWING), followee_user_id)
+            p.sadd(cls.key(followee_user_id, cls.FOLLOWERS), user_id)
+        for follower_user_id in followers or []:
+            p.sadd(cls.key(user_id, cls.FOLLOWERS), follower_user_id)
+            p.sadd(cls.key(follower_user_id, cls.FOLLOWING), user_id)
+        if unfollowed:
+            p.sadd(cls.key(user_id, cls.UNFOLLOWED), *unfollowed)
+        if requested:
+            p.sadd(cls.key(user_id, cls.REQUESTED), *requested)
+        p.execute()
+
+    @classmethod
+    def delete(cls, user_id):
+        cls.redis().delete(*[cls.key(user_id, kind) for kind in
+                             (cls.FOLLOWING, cls.FOLLOWERS, cls.UNFOLLOWED, cls.REQUESTED)])
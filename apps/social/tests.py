@@ -5,7 +5,14 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import datetime
 from django.test import TestCase
+from django.conf import settings
+from django.contrib.auth.models import User
+from mongoengine.connection import connect, disconnect
+from apps.social.models import MSocialProfile
+from apps.social.social_graph import RSocialGraph
+from apps.social.trending import RTrendingStories
 
 
 class SimpleTest(TestCase):
@@ -14,3 +21,123 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class TrendingTest(TestCase):
+    HALF_LIFE = 60 * 60
+    
+    def tearDown(self):
+        key = RTrendingStories.key(self.HALF_LIFE)
+        RTrendingStories.redis().delete(key, "%s:epoch" % key)
+        
+    def test_decayed_shares(self):
+        now = datetime.datetime.utcnow()
+        half_life_ago = now - datetime.timedelta(seconds=self.HALF_LIFE)
+        for shared_date in [now, now, half_life_ago, half_life_ago]:
+            RTrendingStories.add('1:aaaaaa', shared_date, half_life=self.HALF_LIFE)
+        RTrendingStories.add('1:bbbbbb', now, half_life=self.HALF_LIFE)
+        
+        trending = RTrendingStories.top(cutoff=2, half_life=self.HALF_LIFE)
+        self.assertEqual([story_hash for story_hash, _ in trending], ['1:aaaaaa'])
+        self.assertTrue(abs(trending[0][1] - 3) < .01)
+        
+        RTrendingStories.add('1:aaaaaa', now, sign=-1, half_life=self.HALF_LIFE)
+        RTrendingStories.add('1:bbbbbb', now, sign=-1, half_life=self.HALF_LIFE)
+        trending = RTrendingStories.top(cutoff=0, half_life=self.HALF_LIFE)
+        self.assertEqual([story_hash for story_hash, _ in trending], ['1:aaaaaa'])
+        self.assertTrue(abs(trending[0][1] - 2) < .01)
+
+class SocialGraphTest(TestCase):
+    fixtures = ['../../reader/fixtures/subscriptions.json']
+    
+    def setUp(self):
+        disconnect()
+        settings.MONGODB = connect('test_newsblur')
+        self.user_ids = [User.objects.get(username='conesus').pk]
+        for username in ['graph_public', 'graph_protected']:
+            self.user_ids.append(User.objects.create_user(username, '%s@newsblur.com' % username, 'test').pk)
+        for user_id in self.user_ids:
+            RSocialGraph.delete(user_id)
+        self.follower, self.public, self.protected = [MSocialProfile.get_user(user_id)
+                                                      for user_id in self.user_ids]
+        self.protected.protected = True
+        self.protected.save()
+        
+    def tearDown(self):
+        for user_id in self.user_ids:
+            RSocialGraph.delete(user_id)
+        settings.MONGODB.drop_database('test_newsblur')
+        
+    def test_follow_public_profile(self):
+        self.follower.follow_user(self.public.user_id)
+        
+        self.assertTrue(RSocialGraph.is_following(self.follower.user_id, self.public.user_id))
+        self.assertTrue(RSocialGraph.is_followed_by(self.public.user_id, self.follower.user_id))
+        self.assertEqual(RSocialGraph.requested(self.public.user_id), [])
+        self.assertEqual(MSocialProfile.get_user(self.follower.user_id).following_count, 1)
+        self.assertEqual(MSocialProfile.get_user(self.public.user_id).follower_count, 1)
+        
+    def test_follow_protected_profile(self):
+        self.follower.follow_user(self.protected.user_id)
+        
+        self.assertFalse(RSocialGraph.is_following(self.follower.user_id, self.protected.user_id))
+        self.assertEqual(RSocialGraph.requested(self.protected.user_id), [self.follower.user_id])
+        self.assertTrue(self.protected.is_requested_by_user(self.follower.user_id))
+        
+        # What approve_follower does once the protected user accepts.
+        self.follower.follow_user(self.protected.user_id, force=True)
+        
+        self.assertTrue(RSocialGraph.is_following(self.follower.user_id, self.protected.user_id))
+        self.assertTrue(RSocialGraph.is_followed_by(self.protected.user_id, self.follower.user_id))
+        self.assertEqual(RSocialGraph.requested(self.protected.user_id), [])
+        
+    def test_unfollow(self):
+        self.follower.follow_user(self.public.user_id)
+        self.follower.unfollow_user(self.public.user_id)
+        
+        self.assertFalse(RSocialGraph.is_following(self.follower.user_id, self.public.user_id))
+        self.assertFalse(RSocialGraph.is_followed_by(self.public.user_id, self.follower.user_id))
+        self.assertTrue(RSocialGraph.has_unfollowed(self.follower.user_id, self.public.user_id))
+        self.assertEqual(MSocialProfile.get_user(self.public.user_id).follower_count, 0)
+        
+        self.follower.follow_user(self.public.user_id, check_unfollowed=True)
+        self.assertFalse(RSocialGraph.is_following(self.follower.user_id, self.public.user_id))
+        
+    def test_counts_leave_out_self_follow(self):
+        self.assertTrue(RSocialGraph.is_following(self.follower.user_id, self.follower.user_id))
+        self.assertEqual(RSocialGraph.counts(self.follower.user_id), (0, 0))
+        
+        self.follower.follow_user(self.public.user_id)
+        self.assertEqual(RSocialGraph.counts(self.follower.user_id), (1, 0))
+        self.assertEqual(RSocialGraph.counts(self.public.user_id), (0, 1))
+        
+    def test_import_lists_either_order(self):
+        follower_id, followee_id = self.follower.user_id, self.public.user_id
+        imports = [
+            lambda: RSocialGraph.import_lists(follower_id, following=[follower_id, followee_id],
+                                              unfollowed=[self.protected.user_id]),
+            lambda: RSocialGraph.import_lists(followee_id, following=[followee_id],
+                                              followers=[followee_id, follower_id]),
+        ]
+        for ordered in [imports, list(reversed(imports))]:
+            for user_id in self.user_ids:
+                RSocialGraph.delete(user_id)
+            for import_lists in ordered:
+                import_lists()
+            
+            self.assertEqual(sorted(RSocialGraph.following(follower_id)), sorted([follower_id, followee_id]))
+            self.assertEqual(RSocialGraph.followers(follower_id), [follower_id])
+            self.assertEqual(RSocialGraph.following(followee_id), [followee_id])
+            self.assertEqual(sorted(RSocialGraph.followers(followee_id)), sorted([followee_id, follower_id]))
+            self.assertEqual(RSocialGraph.unfollowed(follower_id), [self.protected.user_id])
+            self.assertEqual(RSocialGraph.counts(follower_id), (1, 0))
+            self.assertEqual(RSocialGraph.counts(followee_id), (0, 1))
+        
+    def test_profiles_to_json(self):
+        self.follower.follow_user(self.public.user_id)
+        self.public.follow_user(self.follower.user_id)
+        self.follower.follow_user(self.protected.user_id)
+        
+        profiles = [MSocialProfile.get_user(user_id) for user_id in self.user_ids]
+        expected = [profile.to_json(include_following_user=self.follower.user_id)
+                    for profile in profiles]
+        self.assertEqual(MSocialProfile.profiles_to_json(profiles, self.follower.user_id), expected)
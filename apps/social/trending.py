@@ -0,0 +1,150 @@
+import calendar
+import datetime
+import time
+import redis
+from django.conf import settings
+
+# Adds one share to a story's score. Scores use forward decay: a share made at
+# `shared_at` is worth 2^((shared_at - epoch) / half_life), so older shares are
+# worth less without any score ever being rewritten, and the true decayed score
+# is the stored one divided by 2^((now - epoch) / half_life). Once the epoch is
+# REBASE half-lives old, every score is scaled back down and the epoch moves up,
+# before they grow too large for a double. Stories that decay under `prune`
+# shares are dropped along the way.
+TRENDING_ADD = """
+local key, epoch_key = KEYS[1], KEYS[2]
+local member, shared_at, half_life = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local now, sign, prune, rebase = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7])
+
+local epoch = tonumber(redis.call('GET', epoch_key))
+if not epoch then
+    epoch = now
+    redis.call('SET', epoch_key, epoch)
+elseif now - epoch > half_life * rebase then
+    redis.call('ZUNIONSTORE', key, 1, key, 'WEIGHTS', math.pow(2, (epoch - now) / half_life))
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', prune)
+    epoch = now
+    redis.call('SET', epoch_key, epoch)
+end
+
+local score = redis.call('ZINCRBY', key, sign * math.pow(2, (shared_at - epoch) / half_life), member)
+if tonumber(score) < prune * math.pow(2, (now - epoch) / half_life) then
+    redis.call('ZREM', key, member)
+end
+return score
+"""
+
+
+class RTrendingStories(object):
+    """
+    Trending stories as a time-decayed count of shares, kept current as stories
+    are shared and unshared instead of recounted from every recent share:
+
+        zTS:<half_life>         zset of story_hash -> forward-decayed share count
+        zTS:<half_life>:epoch   timestamp the zset's scores are relative to
+
+    A share counts as 1 when it's made and loses half its weight every
+    `half_life` seconds. The half-life is part of the key, so a new one in
+    settings.TRENDING_HALF_LIFE starts an empty zset, to be filled by
+    `manage.py rebuild_trending`.
+    """
+
+    HALF_LIFE = getattr(settings, 'TRENDING_HALF_LIFE', 60 * 60 * 12)
+    CUTOFF    = getattr(settings, 'TRENDING_CUTOFF', 10)
+    PRUNE     = .01
+    REBASE    = 32
+
+    _script = None
+
+    @classmethod
+    def redis(cls):
+        return redis.Redis(connection_pool=settings.REDIS_POOL)
+
+    @classmethod
+    def script(cls):
+        if not cls._script:
+            cls._script = cls.redis().register_script(TRENDING_ADD)
+        return cls._script
+
+    @classmethod
+    def key(cls, half_life=None):
+        return "zTS:%s" % (half_life or cls.HALF_LIFE)
+
+    @staticmethod
+    def timestamp(date):
+        return calendar.timegm(date.utctimetuple())
+
+    @classmethod
+    def add(cls, story_hash, shared_date=None, sign=1, half_life=None):
+        """ Counts a share of `story_hash`, or takes one away with sign=-1. """
+        if not story_hash: return
+        half_life = half_life or cls.HALF_LIFE
+        shared_date = shared_date or datetime.datetime.utcnow()
+        key = cls.key(half_life)
+        try:
+            cls.script()(keys=[key, "%s:epoch" % key],
+                         args=[story_hash, cls.timestamp(shared_date), half_life,
+                               int(time.time()), sign, cls.PRUNE, cls.REBASE],
+                         client=cls.redis())
+        except redis.RedisError:
+            # Trending is best-effort; a share shouldn't fail because of it.
+            pass
+
+    @classmethod
+    def remove(cls, story_hash, shared_date):
+        cls.add(story_hash, shared_date, sign=-1)
+
+    @classmethod
+    def top(cls, limit=50, cutoff=None, half_life=None):
+        """
+        The `limit` most shared stories with at least `cutoff` decayed shares, as
+        [(story_hash, shares), ...], most shared first.
+        """
+        half_life = half_life or cls.HALF_LIFE
+        cutoff = cls.CUTOFF if cutoff is None else cutoff
+        key = cls.key(half_life)
+        r = cls.redis()
+        epoch = r.get("%s:epoch" % key)
+        if not epoch:
+            return []
+        scale = 2 ** ((time.time() - float(epoch)) / half_life)
+        stories = r.zrevrangebyscore(key, '+inf', cutoff * scale, start=0, num=limit,
+                                     withscores=True)
+        return [(story_hash, score / scale) for story_hash, score in stories]
+
+    @classmethod
+    def rebuild(cls, shares, half_life=None):
+        """
+        Replaces the scores with ones counted from `shares`, an iterable of
+        (story_hash, shared_date). They're counted into a scratch key and
+        swapped in at the end, so readers never see a half-built zset.
+        """
+        half_life = half_life or cls.HALF_LIFE
+        key = cls.key(half_life)
+        scratch_key = "%s:rebuild" % key
+        now = int(time.time())
+        r = cls.redis()
+        r.delete(scratch_key)
+
+        scores = {}
+        for story_hash, shared_date in shares:
+            if not story_hash: continue
+            weight = 2 ** ((cls.timestamp(shared_date) - now) / float(half_life))
+            scores[story_hash] = scores.get(story_hash, 0) + weight
+
+        scores = [(story_hash, score) for story_hash, score in scores.items() if score >= cls.PRUNE]
+        for i in range(0, len(scores), 1000):
+            p = r.pipeline()
+            for story_hash, score in scores[i:i+1000]:
+                p.zadd(scratch_key, story_hash, score)
+            p.execute()
+
+        p = r.pipeline()
+        if scores:
+            p.rename(scratch_key, key)
+        else:
+            p.delete(key)
+        p.set("%s:epoch" % key, now)
+        p.execute()
+
+        return len(scores)
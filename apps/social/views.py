@@ -934,7 +934,7 @@ def load_follow_requests(request):
     follow_request_users = MFollowRequest.objects.filter(followee_user_id=user.pk)
     follow_request_user_ids = [f.follower_user_id for f in follow_request_users]
     request_profiles = MSocialProfile.profiles(follow_request_user_ids)
-    request_profiles = [p.to_json(include_following_user=user.pk) for p in request_profiles]
+    request_profiles = MSocialProfile.profiles_to_json(request_profiles, user.pk)
 
     if len(request_profiles):
         logging.user(request, "~BB~FRLoading Follow Requests (%s requests)" % (
@@ -954,8 +954,8 @@ def load_user_friends(request):
     follower_profiles  = MSocialProfile.profiles(social_profile.follower_user_ids)
     recommended_users  = social_profile.recommended_users()
     
-    following_profiles = [p.to_json(include_following_user=user.pk) for p in following_profiles]
-    follower_profiles  = [p.to_json(include_following_user=user.pk) for p in follower_profiles]
+    following_profiles = MSocialProfile.profiles_to_json(following_profiles, user.pk)
+    follower_profiles  = MSocialProfile.profiles_to_json(follower_profiles, user.pk)
     
     logging.user(request, "~BB~FRLoading Friends (%s following, %s followers)" % (
         social_profile.following_count,
@@ -1052,7 +1052,7 @@ def approve_follower(request):
     
     logging.user(request, "~BB~FRApproving follow: ~SB%s" % follower_profile.username)
     
-    if user_id in profile.requested_follow_user_ids:
+    if profile.is_requested_by_user(user_id):
         follower_profile.follow_user(request.user.pk, force=True)
         code = 1
         
@@ -1068,7 +1068,7 @@ def ignore_follower(request):
     
     logging.user(request, "~BB~FR~SK~SBNOT~SN approving follow: ~SB%s" % follower_profile.username)
     
-    if user_id in profile.requested_follow_user_ids:
+    if profile.is_requested_by_user(user_id):
         follower_profile.unfollow_user(request.user.pk)
         code = 1
         
@@ -1088,7 +1088,7 @@ def find_friends(request):
     if not profiles:
         profiles = MSocialProfile.objects.filter(location__icontains=query)[:limit]
     
-    profiles = [p.to_json(include_following_user=request.user.pk) for p in profiles]
+    profiles = MSocialProfile.profiles_to_json(profiles, request.user.pk)
     profiles = sorted(profiles, key=lambda p: -1 * p['shared_stories_count'])
 
     return dict(profiles=profiles)
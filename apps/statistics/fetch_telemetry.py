@@ -0,0 +1,233 @@
+import calendar
+import datetime
+import math
+import os
+import time
+import redis
+from collections import defaultdict
+from multiprocessing.util import Finalize
+from django.conf import settings
+from utils import log as logging
+
+
+class RFetchStats(object):
+    """
+    Feed fetch timings pre-aggregated per server and minute, so dashboards can read
+    percentiles without touching the raw fetches:
+
+        FT:<server>:<minute>    hash of '<stage>:<bucket>' -> fetches in that bucket,
+                                '<stage>:sum' -> total seconds, 'count' -> fetches,
+                                and 'code:<feed_code>' -> fetches with that code
+        FT:servers              zset of server -> last minute it reported
+
+    Durations fall into log-scale buckets, BUCKET_BASE apart, so histograms from
+    every process and minute simply add up, and any percentile read back from them
+    is within about 10% of the real one.
+    """
+
+    STAGES      = ('feed_fetch', 'feed_process', 'page', 'icon', 'total')
+    BUCKET_BASE = 1.2
+    TTL         = 60 * 60 * 24 * 2
+
+    @classmethod
+    def redis(cls):
+        return redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+
+    @staticmethod
+    def key(server, minute):
+        return "FT:%s:%s" % (server, minute)
+
+    @staticmethod
+    def minute(timestamp=None):
+        return int(timestamp or time.time()) / 60 * 60
+
+    @classmethod
+    def bucket(cls, duration):
+        milliseconds = duration * 1000
+        if milliseconds < 1:
+            return 0
+        return int(math.log(milliseconds) / math.log(cls.BUCKET_BASE))
+
+    @classmethod
+    def bucket_duration(cls, bucket):
+        """ The middle of a bucket, in seconds. """
+        return cls.BUCKET_BASE ** (bucket + .5) / 1000
+
+    @classmethod
+    def add(cls, server, fetches):
+        """ Adds a batch of fetches, dicts of stage durations plus date and feed_code. """
+        counts = defaultdict(lambda: defaultdict(int))
+        sums = defaultdict(lambda: defaultdict(float))
+        for fetch in fetches:
+            minute = cls.minute(calendar.timegm(fetch['date'].utctimetuple()))
+            counts[minute]['count'] += 1
+            if fetch.get('feed_code'):
+                counts[minute]['code:%s' % fetch['feed_code']] += 1
+            for stage in cls.STAGES:
+                duration = fetch.get(stage)
+                if duration is None: continue
+                counts[minute]['%s:%s' % (stage, cls.bucket(duration))] += 1
+                sums[minute]['%s:sum' % stage] += duration
+
+        p = cls.redis().pipeline()
+        for minute, fields in counts.items():
+            key = cls.key(server, minute)
+            for field, count in fields.items():
+                p.hincrby(key, field, count)
+            for field, total in sums[minute].items():
+                p.hincrbyfloat(key, field, total)
+            p.expireat(key, minute + cls.TTL)
+        if counts:
+            p.zadd('FT:servers', server, max(counts.keys()))
+        p.execute()
+
+    @classmethod
+    def servers(cls, minutes=60):
+        since = cls.minute() - minutes * 60
+        return cls.redis().zrangebyscore('FT:servers', since, '+inf')
+
+    @classmethod
+    def histograms(cls, servers=None, minutes=60):
+        """ Sums each server's last `minutes` of minutes into one hash per server. """
+        servers = servers or cls.servers(minutes=minutes)
+        now = cls.minute()
+        minutes = [now - m * 60 for m in range(minutes)]
+        p = cls.redis().pipeline()
+        for server in servers:
+            for minute in minutes:
+                p.hgetall(cls.key(server, minute))
+        results = p.execute()
+
+        histograms = {}
+        for i, server in enumerate(servers):
+            totals = defaultdict(float)
+            for fields in results[i*len(minutes):(i+1)*len(minutes)]:
+                for field, value in fields.items():
+                    totals[field] += float(value)
+            histograms[server] = totals
+        return histograms
+
+    @classmethod
+    def percentiles(cls, histogram, stage, percentiles=(50, 90, 99)):
+        prefix = '%s:' % stage
+        buckets = sorted((int(field[len(prefix):]), count) for field, count in histogram.items()
+                         if field.startswith(prefix) and field[len(prefix):].isdigit())
+        total = sum(count for _, count in buckets)
+        results = {}
+        for percentile in percentiles:
+            if not total:
+                results[percentile] = None
+                continue
+            rank = total * percentile / 100.0
+            seen = 0
+            for bucket, count in buckets:
+                seen += count
+                if seen >= rank:
+                    results[percentile] = cls.bucket_duration(bucket)
+                    break
+        return results
+
+    @classmethod
+    def summary(cls, minutes=5, percentiles=(50, 90, 99), by_server=True):
+        """
+        For each server, or for 'all' of them unless `by_server`: fetches, counts
+        by feed_code, and the count, average and percentiles of every stage over
+        the last `minutes`.
+        """
+        histograms = cls.histograms(minutes=minutes)
+        if not by_server:
+            merged = defaultdict(float)
+            for histogram in histograms.values():
+                for field, value in histogram.items():
+                    merged[field] += value
+            histograms = {'all': merged}
+        
+        summary = {}
+        for server, histogram in histograms.items():
+            count = histogram.get('count', 0)
+            stages = {}
+            for stage in cls.STAGES:
+                stage_count = sum(c for f, c in histogram.items()
+                                  if f.startswith('%s:' % stage) and not f.endswith(':sum'))
+                stages[stage] = dict(cls.percentiles(histogram, stage, percentiles),
+                                     count=int(stage_count),
+                                     avg=stage_count and histogram.get('%s:sum' % stage, 0) / stage_count)
+            summary[server] = {
+                'count': int(count),
+                'codes': dict((f[5:], int(c)) for f, c in histogram.items() if f.startswith('code:')),
+                'stages': stages,
+            }
+        return summary
+
+
+class FetchTelemetry(object):
+    """
+    Buffers fetch timings in each fetching process, instead of inserting every
+    fetch into mongo as it finishes. A buffer is flushed once it holds FLUSH_SIZE
+    fetches or FLUSH_INTERVAL seconds have passed, as one bulk insert into the
+    feed_fetches collection plus one redis pipeline into RFetchStats, and again when
+    the process exits.
+    """
+
+    FLUSH_SIZE     = 200
+    FLUSH_INTERVAL = 30
+
+    _buffers = {}
+
+    def __init__(self):
+        self.server = settings.SERVER_NAME
+        self.fetches = []
+        self.last_flush = time.time()
+
+    @classmethod
+    def buffer(cls):
+        # Keyed by pid, since forked fetchers inherit their parent's buffer.
+        pid = os.getpid()
+        if pid not in cls._buffers:
+            cls._buffers[pid] = cls()
+            Finalize(None, cls.flush, exitpriority=10)
+        return cls._buffers[pid]
+
+    @classmethod
+    def add(cls, feed_id, feed_fetch, feed_process, page, icon, total, feed_code):
+        """ Records a fetch. Stage times are cumulative, so they're turned into durations. """
+        if 'app' in settings.SERVER_NAME: return
+
+        if icon and page:
+            icon -= page
+        if page and feed_process:
+            page -= feed_process
+        elif page and feed_fetch:
+            page -= feed_fetch
+        if feed_process and feed_fetch:
+            feed_process -= feed_fetch
+
+        buffer = cls.buffer()
+        buffer.fetches.append({
+            'date': datetime.datetime.utcnow(),
+            'feed_id': feed_id,
+            'feed_fetch': feed_fetch,
+            'feed_process': feed_process,
+            'page': page,
+            'icon': icon,
+            'total': total,
+            'server': buffer.server,
+            'feed_code': feed_code,
+        })
+        if (len(buffer.fetches) >= cls.FLUSH_SIZE or
+            time.time() - buffer.last_flush >= cls.FLUSH_INTERVAL):
+            cls.flush()
+
+    @classmethod
+    def flush(cls):
+        from apps.statistics.models import MAnalyticsFetcher
+        buffer = cls._buffers.get(os.getpid())
+        if not buffer or not buffer.fetches: return
+        fetches, buffer.fetches = buffer.fetches, []
+        buffer.last_flush = time.time()
+
+        try:
+            MAnalyticsFetcher.bulk_add(fetches)
+            RFetchStats.add(buffer.server, fetches)
+        except Exception, e:
+            logging.debug(" ***> ~FRFailed to flush ~SB%s~SN fetch timings: %s" % (len(fetches), e))
@@ -216,7 +216,7 @@ class MFeedback(mongo.Document):
 
 
 class MAnalyticsFetcher(mongo.Document):
-    date = mongo.DateTimeField(default=datetime.datetime.now)
+    date = mongo.DateTimeField(default=datetime.datetime.utcnow)
     feed_id = mongo.IntField()
     feed_fetch = mongo.FloatField()
     feed_process = mongo.FloatField()
@@ -226,11 +226,14 @@ class MAnalyticsFetcher(mongo.Document):
     server = mongo.StringField()
     feed_code = mongo.IntField()
     
+    # Fetches are expired by a TTL index on date, see `ensure_ttl_index`.
+    TTL = 60 * 60 * 24
+    
     meta = {
         'db_alias': 'nbanalytics',
         'collection': 'feed_fetches',
         'allow_inheritance': False,
-        'indexes': ['date', 'feed_id', 'server', 'feed_code'],
+        'indexes': ['feed_id', 'server', 'feed_code'],
         'ordering': ['date'],
     }
     
@@ -242,24 +245,20 @@ class MAnalyticsFetcher(mongo.Document):
                                                     self.total)
         
     @classmethod
-    def add(cls, feed_id, feed_fetch, feed_process, 
-            page, icon, total, feed_code):
-        server_name = settings.SERVER_NAME
-        if 'app' in server_name: return
-        
-        if icon and page:
-            icon -= page
-        if page and feed_process:
-            page -= feed_process
-        elif page and feed_fetch:
-            page -= feed_fetch
-        if feed_process and feed_fetch:
-            feed_process -= feed_fetch
-        
-        cls.objects.create(feed_id=feed_id, feed_fetch=feed_fetch,
-                           feed_process=feed_process, 
-                           page=page, icon=icon, total=total,
-                           server=server_name, feed_code=feed_code)
+    def bulk_add(cls, fetches):
+        """ Inserts a batch of fetches, as buffered by FetchTelemetry, in one insert. """
+        if not fetches: return
+        cls._get_collection().insert([dict(fetch) for fetch in fetches])
+    
+    @classmethod
+    def ensure_ttl_index(cls):
+        """ Replaces the plain date index with one that expires fetches after TTL. """
+        collection = cls._get_collection()
+        for name, index in collection.index_information().items():
+            if (index['key'] == [('date', 1)] and
+                index.get('expireAfterSeconds') != cls.TTL):
+                collection.drop_index(name)
+        collection.create_index('date', expireAfterSeconds=cls.TTL)
     
     @classmethod
     def calculate_stats(cls, stats):
@@ -8,6 +8,10 @@ class RStats:
     STATS_TYPE = {
         'page_load': 'PLT',
         'feed_fetch': 'FFH',
+        'story_cache': 'SCL',
+        'story_cache_hit': 'SCH',
+        'story_cache_miss': 'SCM',
+        'story_trim': 'STR',
     }
     
     @classmethod
@@ -15,12 +19,14 @@ class RStats:
         return cls.STATS_TYPE[name]
         
     @classmethod
-    def add(cls, name, duration=None):
+    def add(cls, name, duration=None, count=1):
+        if not count:
+            return
         r = redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
         pipe = r.pipeline()
         minute = round_time(round_to=60)
         key = "%s:%s" % (cls.stats_type(name), minute.strftime('%s'))
-        pipe.incr("%s:s" % key)
+        pipe.incr("%s:s" % key, count)
         if duration:
             pipe.incrbyfloat("%s:a" % key, duration)
             pipe.expireat("%s:a" % key, (minute + datetime.timedelta(days=2)).strftime("%s"))
@@ -5,7 +5,9 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+from collections import defaultdict
 from django.test import TestCase
+from apps.statistics.fetch_telemetry import RFetchStats
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +16,18 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class FetchStatsTest(TestCase):
+    def test_percentiles(self):
+        histogram = defaultdict(float)
+        for duration in [i / 100.0 for i in range(1, 101)]:
+            histogram['total:%s' % RFetchStats.bucket(duration)] += 1
+        histogram['total:sum'] = 50.5
+        
+        percentiles = RFetchStats.percentiles(histogram, 'total', (50, 90))
+        self.assertTrue(abs(percentiles[50] - .5) < .05)
+        self.assertTrue(abs(percentiles[90] - .9) < .09)
+        self.assertEquals(RFetchStats.percentiles(histogram, 'page', (50,)), {50: None})
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
@@ -1444,15 +1444,28 @@ NEWSBLUR.AssetModel = Backbone.Router.extend({
         this.make_request('/oauth/unfollow_twitter_account', {'username': username}, callback);
     },
     
-    fetch_original_text: function(story_id, feed_id, callback, error_callback) {
+    fetch_original_text: function(story_id, feed_id, callback, error_callback, attempt) {
         var story = this.get_story(story_id);
+        attempt = attempt || 0;
         this.make_request('/rss_feeds/original_text', {
             story_id: story_id,
             feed_id: feed_id
-        }, function(data) {
+        }, _.bind(function(data) {
+            if (data.pending) {
+                // Back off from 250ms up to 2s between tries, giving up after about
+                // 10s, which is as long as the server spends fetching the text.
+                if (attempt >= 8) {
+                    if (error_callback) error_callback(data);
+                    return;
+                }
+                _.delay(_.bind(function() {
+                    this.fetch_original_text(story_id, feed_id, callback, error_callback, attempt+1);
+                }, this), Math.min(250 * Math.pow(2, attempt), 2000));
+                return;
+            }
             story.set('original_text', data.original_text);
             callback(data);
-        }, error_callback, {
+        }, this), error_callback, {
             request_type: 'GET',
             ajax_group: 'statistics'
         });
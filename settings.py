@@ -201,6 +201,12 @@ SESSION_COOKIE_NAME     = 'newsblur_sessionid'
 SESSION_COOKIE_AGE      = 60*60*24*365*2 # 2 years
 SESSION_COOKIE_DOMAIN   = '.newsblur.com'
 SENTRY_DSN              = 'https://XXXNEWSBLURXXX@app.getsentry.com/99999999'
+# Per-endpoint and per-user ('endpoint:user_id') overrides for utils.ratelimit.
+RATELIMITS              = {}
+# Trending stories for the popular blurblog: a share's weight halves every
+# TRENDING_HALF_LIFE seconds, and stories need TRENDING_CUTOFF decayed shares.
+TRENDING_HALF_LIFE      = 60 * 60 * 12
+TRENDING_CUTOFF         = 10
 
 # ==============
 # = Subdomains =
@@ -289,6 +295,10 @@ CELERY_ROUTES = {
         "queue": "beat_tasks",
         "binding_key": "beat_tasks"
     },
+    "fetch-original-text": {
+        "queue": "original_text",
+        "binding_key": "original_text"
+    },
 }
 CELERY_QUEUES = {
     "work_queue": {
@@ -321,6 +331,11 @@ CELERY_QUEUES = {
         "exchange_type": "direct",
         "binding_key": "beat_feeds_task"
     },
+    "original_text": {
+        "exchange": "original_text",
+        "exchange_type": "direct",
+        "binding_key": "original_text"
+    },
 }
 CELERY_DEFAULT_QUEUE = "work_queue"
 
@@ -364,6 +379,26 @@ CELERYBEAT_SCHEDULE = {
         'schedule': datetime.timedelta(hours=1),
         'options': {'queue': 'beat_tasks'},
     },
+    'fetch-icons': {
+        'task': 'fetch-icons',
+        'schedule': datetime.timedelta(minutes=1),
+        'options': {'queue': 'beat_tasks'},
+    },
+    'trim-feeds': {
+        'task': 'trim-feeds',
+        'schedule': datetime.timedelta(minutes=5),
+        'options': {'queue': 'beat_tasks'},
+    },
+    'recount-expired-subscribers': {
+        'task': 'recount-expired-subscribers',
+        'schedule': datetime.timedelta(hours=1),
+        'options': {'queue': 'beat_tasks'},
+    },
+    'reconcile-unread-counts': {
+        'task': 'reconcile-unread-counts',
+        'schedule': datetime.timedelta(hours=1),
+        'options': {'queue': 'beat_tasks'},
+    },
     'clean-analytics': {
         'task': 'clean-analytics',
         'schedule': datetime.timedelta(hours=12),
@@ -450,6 +485,7 @@ TWITTER_CONSUMER_SECRET = 'XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX'
 # ===============
 
 ORIGINAL_PAGE_SERVER = "db01:3060"
+ORIGINAL_PAGE_MAX_BYTES = 2 * 1024 * 1024
 
 BACKED_BY_AWS = {
     'pages_on_s3': False,
@@ -563,6 +599,7 @@ REDIS_FEED_POOL = redis.ConnectionPool(host=REDIS['host'], port=6379, db=4)
 REDIS_SESSION_POOL = redis.ConnectionPool(host=REDIS['host'], port=6379, db=5)
 # REDIS_CACHE_POOL = redis.ConnectionPool(host=REDIS['host'], port=6379, db=6) # Duped in CACHES
 REDIS_STORY_HASH_POOL = redis.ConnectionPool(host=REDIS['host'], port=6379, db=8)
+REDIS_STORY_CACHE_POOL = redis.ConnectionPool(host=REDIS['host'], port=6379, db=9)
 
 JAMMIT = jammit.JammitAssets(NEWSBLUR_DIR)
 
@@ -0,0 +1,63 @@
+import time
+from django.db import connection
+from redis.connection import Connection
+from pymongo.connection import Connection as MongoConnection
+from pymongo.replica_set_connection import ReplicaSetConnection
+
+MONGO_SEND_METHODS = ('_send_message', '_send_message_with_response')
+
+
+class RoundTripCounter(object):
+    """
+    Counts Redis, SQL, and Mongo round trips made inside a `with` block. Redis is
+    counted per packed send, so a pipeline with hundreds of commands counts as one
+    trip, and Mongo per message sent, so each getmore of a long cursor counts too.
+
+        with RoundTripCounter() as counter:
+            UserSubscription.feed_stories(user_id, feed_ids)
+        print counter.redis, counter.sql, counter.mongo, counter.elapsed
+    """
+
+    def __init__(self):
+        self.redis = 0
+        self.sql = 0
+        self.mongo = 0
+        self.elapsed = 0
+
+    def __enter__(self):
+        self.orig_send_packed_command = Connection.send_packed_command
+        counter = self
+        orig_send_packed_command = self.orig_send_packed_command
+        def send_packed_command(conn, command):
+            counter.redis += 1
+            return orig_send_packed_command(conn, command)
+        Connection.send_packed_command = send_packed_command
+
+        self.orig_mongo_methods = []
+        for cls in (MongoConnection, ReplicaSetConnection):
+            for name in MONGO_SEND_METHODS:
+                orig_method = cls.__dict__[name]
+                self.orig_mongo_methods.append((cls, name, orig_method))
+                setattr(cls, name, self.counted_mongo_method(orig_method))
+
+        self.orig_use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.sql_start = len(connection.queries)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.time() - self.start
+        self.sql = len(connection.queries) - self.sql_start
+        Connection.send_packed_command = self.orig_send_packed_command
+        for cls, name, orig_method in self.orig_mongo_methods:
+            setattr(cls, name, orig_method)
+        connection.use_debug_cursor = self.orig_use_debug_cursor
+        return False
+
+    def counted_mongo_method(self, orig_method):
+        counter = self
+        def send(conn, *args, **kwargs):
+            counter.mongo += 1
+            return orig_method(conn, *args, **kwargs)
+        return send
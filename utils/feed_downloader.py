@@ -0,0 +1,127 @@
+import Queue
+import threading
+import time
+import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from utils import feedparser
+from utils import log as logging
+
+
+class FeedDownloader:
+    """
+    Downloads many feeds at once. A pool of I/O threads shares one requests
+    session, so connections to the same host are kept alive and reused, and a
+    semaphore per host keeps us from hammering any one publisher. Only the raw
+    response is returned; parsing is left to `parse_download`, which is meant to
+    run in a CPU-bound worker process.
+    """
+
+    def __init__(self, concurrency=100, per_host=4, timeout=20):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.host_semaphores = {}
+        self.host_semaphores_lock = threading.Lock()
+
+    def host_semaphore(self, address):
+        host = urlparse.urlparse(address).netloc.lower()
+        with self.host_semaphores_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.Semaphore(self.per_host)
+            return self.host_semaphores[host]
+
+    def download(self, jobs):
+        """
+        `jobs` is a list of dicts with feed_id, address, etag, modified and agent,
+        as built by `FetchFeed.fetch_params`. Yields (feed_id, download) pairs in
+        the order the downloads finish.
+        """
+        job_queue = Queue.Queue()
+        results = Queue.Queue()
+        for job in jobs:
+            job_queue.put(job)
+
+        def worker():
+            while True:
+                try:
+                    job = job_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                results.put((job['feed_id'], self.fetch(job)))
+
+        threads = []
+        for _ in range(min(self.concurrency, len(jobs))):
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        for _ in range(len(jobs)):
+            yield results.get()
+
+        for thread in threads:
+            thread.join()
+
+    def fetch(self, job):
+        start = time.time()
+        headers = {'User-Agent': job['agent'], 'Accept-Encoding': 'gzip, deflate'}
+        if job.get('etag'):
+            headers['If-None-Match'] = job['etag']
+        if job.get('modified'):
+            headers['If-Modified-Since'] = job['modified']
+
+        semaphore = self.host_semaphore(job['address'])
+        semaphore.acquire()
+        try:
+            response = self.session.get(job['address'], headers=headers, timeout=self.timeout)
+            download = dict(status=response.status_code,
+                            content=response.content,
+                            headers=dict(response.headers),
+                            url=response.url,
+                            permanent_redirect=any(r.status_code == 301 for r in response.history))
+        except requests.exceptions.Timeout, e:
+            download = dict(error='timeout', message=str(e))
+        except Exception, e:
+            download = dict(error='exception', message=str(e))
+        finally:
+            semaphore.release()
+
+        download['duration'] = time.time() - start
+        return download
+
+
+def parse_download(download):
+    """
+    Turns a raw download from `FeedDownloader` into the same parsed result that
+    `feedparser.parse(address)` would have returned, including status and href,
+    so that `ProcessFeed` can't tell the difference.
+    """
+    if download.get('error'):
+        fpf = feedparser.FeedParserDict(bozo=1, entries=[], feed=feedparser.FeedParserDict())
+        fpf['bozo_exception'] = Exception(download.get('message'))
+        return fpf
+
+    status = download['status']
+    if download.get('permanent_redirect') and status < 300:
+        status = 301
+    if status == 304:
+        fpf = feedparser.FeedParserDict(bozo=0, entries=[], feed=feedparser.FeedParserDict())
+    else:
+        # requests has already decompressed the body.
+        headers = dict((k, v) for k, v in download['headers'].items()
+                       if k.lower() != 'content-encoding')
+        try:
+            fpf = feedparser.parse(download['content'], response_headers=headers)
+        except (TypeError, ValueError), e:
+            logging.debug(u'   ***> [%-30s] ~FR%s, turning off microformats.' % (download['url'][:30], e))
+            feedparser.PARSE_MICROFORMATS = False
+            fpf = feedparser.parse(download['content'], response_headers=headers)
+            feedparser.PARSE_MICROFORMATS = True
+    fpf['status'] = status
+    fpf['href'] = download['url']
+    return fpf
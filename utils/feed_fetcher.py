@@ -7,16 +7,19 @@ import xml.sax
 import redis
 import random
 import pymongo
+import django
 from django.conf import settings
 from django.db import IntegrityError
 from django.core.cache import cache
-from apps.reader.models import UserSubscription
+from apps.reader.models import UserSubscription, RUserUnreadCount
 from apps.rss_feeds.models import Feed, MStory
 from apps.rss_feeds.page_importer import PageImporter
-from apps.rss_feeds.icon_importer import IconImporter
+from apps.rss_feeds.original_text import ROriginalText
+from apps.rss_feeds.icon_importer import IconImporter, IconPipeline
 from apps.push.models import PushSubscription
-from apps.statistics.models import MAnalyticsFetcher
+from apps.statistics.fetch_telemetry import FetchTelemetry
 from utils import feedparser
+from utils.feed_downloader import FeedDownloader, parse_download
 from utils.story_functions import pre_process_story
 from utils import log as logging
 from utils.feed_functions import timelimit, TimeoutError, utf8encode, cache_bust_url
@@ -40,19 +43,7 @@ class FetchFeed:
         self.options = options
         self.fpf = None
     
-    @timelimit(20)
-    def fetch(self):
-        """ 
-        Uses feedparser to download the feed. Will be parsed later.
-        """
-        start = time.time()
-        identity = self.get_identity()
-        log_msg = u'%2s ---> [%-30s] ~FYFetching feed (~FB%d~FY), last update: %s' % (identity,
-                                                            self.feed.title[:30],
-                                                            self.feed.id,
-                                                            datetime.datetime.now() - self.feed.last_update)
-        logging.debug(log_msg)
-                                                 
+    def fetch_params(self):
         etag=self.feed.etag
         modified = self.feed.last_modified.utctimetuple()[:7] if self.feed.last_modified else None
         address = self.feed.feed_address
@@ -72,6 +63,33 @@ class FetchFeed:
             's' if self.feed.num_subscribers != 1 else '',
             settings.NEWSBLUR_URL
         )
+        
+        return address, etag, modified, USER_AGENT
+    
+    def download_job(self):
+        """ 
+        The same request `fetch` would make, for the threaded FeedDownloader.
+        """
+        address, etag, modified, agent = self.fetch_params()
+        if modified:
+            modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', 
+                                     self.feed.last_modified.utctimetuple())
+        return dict(feed_id=self.feed.pk, address=address, etag=etag, 
+                    modified=modified, agent=agent)
+        
+    @timelimit(20)
+    def fetch(self):
+        """ 
+        Uses feedparser to download the feed. Will be parsed later.
+        """
+        start = time.time()
+        identity = self.get_identity()
+        log_msg = u'%2s ---> [%-30s] ~FYFetching feed (~FB%d~FY), last update: %s' % (identity,
+                                                            self.feed.title[:30],
+                                                            self.feed.id,
+                                                            datetime.datetime.now() - self.feed.last_update)
+        logging.debug(log_msg)
+        
         if self.options.get('feed_xml'):
             logging.debug(u'   ---> [%-30s] ~FM~BKFeed has been fat pinged. Ignoring fat: %s' % (
                           self.feed.title[:30], len(self.options.get('feed_xml'))))
@@ -81,6 +99,17 @@ class FetchFeed:
             logging.debug(u'   ---> [%-30s] ~FM~BKFeed fetched in real-time with fat ping.' % (
                           self.feed.title[:30]))
             return FEED_OK, self.fpf
+        
+        download = self.options.get('downloads', {}).get(self.feed.pk)
+        if download:
+            if download.get('error') == 'timeout':
+                raise TimeoutError, download.get('message')
+            self.fpf = parse_download(download)
+            logging.debug(u'   ---> [%-30s] ~FYFeed downloaded in ~FM%.4ss~FY, parsed in ~FM%.4ss' % (
+                          self.feed.title[:30], download['duration'], time.time() - start))
+            return FEED_OK, self.fpf
+        
+        address, etag, modified, USER_AGENT = self.fetch_params()
 
         try:
             self.fpf = feedparser.parse(address,
@@ -242,6 +271,7 @@ class ProcessFeed:
         
         ret_values = self.feed.add_update_stories(stories, existing_stories,
                                                   verbose=self.options['verbose'])
+        ROriginalText.prefetch_new_stories(self.feed, ret_values['new_story_hashes'])
 
         if (hasattr(self.fpf, 'feed') and 
             hasattr(self.fpf.feed, 'links') and self.fpf.feed.links):
@@ -288,6 +318,10 @@ class ProcessFeed:
 
         
 class Dispatcher:
+    # Feeds with more active subscribers than this have their unread counts
+    # recalculated by CalculateFeedScores tasks, one per shard of subscribers.
+    UNREAD_RECALC_SHARD_SIZE = 1000
+    
     def __init__(self, options, num_threads):
         self.options = options
         self.feed_stats = {
@@ -377,7 +411,7 @@ class Dispatcher:
                             feed.sync_redis()
                             logging.debug('   ---> [%-30s] ~FBDone with feed cleanup. Took ~SB%.4s~SN sec.' % (feed.title[:30], time.time() - start_cleanup))
                         try:
-                            self.count_unreads_for_subscribers(feed)
+                            self.count_unreads_for_subscribers(feed, ret_entries.get('new_story_hashes'))
                         except TimeoutError:
                             logging.debug('   ---> [%-30s] Unread count took too long...' % (feed.title[:30],))
                         if self.options['verbose']:
@@ -460,24 +494,28 @@ class Dispatcher:
                         settings.RAVEN_CLIENT.captureException()
 
                 feed = self.refresh_feed(feed.pk)
-                logging.debug(u'   ---> [%-30s] ~FYFetching icon: %s' % (feed.title[:30], feed.feed_link))
-                icon_importer = IconImporter(feed, page_data=page_data, force=self.options['force'])
-                try:
-                    icon_importer.save()
-                    icon_duration = time.time() - start_duration
-                except TimeoutError, e:
-                    logging.debug('   ---> [%-30s] ~FRIcon fetch timed out...' % (feed.title[:30]))
-                    feed.save_page_history(556, 'Timeout', '')
-                except Exception, e:
-                    logging.debug('[%d] ! -------------------------' % (feed_id,))
-                    tb = traceback.format_exc()
-                    logging.error(tb)
-                    logging.debug('[%d] ! -------------------------' % (feed_id,))
-                    # feed.save_feed_history(560, "Icon Error", tb)
-                    # mail_feed_error_to_admin(feed, e, local_vars=locals())
-                    if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
-                        settings.RAVEN_CLIENT):
-                        settings.RAVEN_CLIENT.captureException()
+                if not self.options['force']:
+                    # Icons are fetched in batches by IconPipeline, off the fetch path.
+                    IconPipeline.queue([feed.pk])
+                else:
+                    logging.debug(u'   ---> [%-30s] ~FYFetching icon: %s' % (feed.title[:30], feed.feed_link))
+                    icon_importer = IconImporter(feed, page_data=page_data, force=self.options['force'])
+                    try:
+                        icon_importer.save()
+                        icon_duration = time.time() - start_duration
+                    except TimeoutError, e:
+                        logging.debug('   ---> [%-30s] ~FRIcon fetch timed out...' % (feed.title[:30]))
+                        feed.save_page_history(556, 'Timeout', '')
+                    except Exception, e:
+                        logging.debug('[%d] ! -------------------------' % (feed_id,))
+                        tb = traceback.format_exc()
+                        logging.error(tb)
+                        logging.debug('[%d] ! -------------------------' % (feed_id,))
+                        # feed.save_feed_history(560, "Icon Error", tb)
+                        # mail_feed_error_to_admin(feed, e, local_vars=locals())
+                        if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
+                            settings.RAVEN_CLIENT):
+                            settings.RAVEN_CLIENT.captureException()
             else:
                 logging.debug(u'   ---> [%-30s] ~FBSkipping page fetch: (%s on %s stories) %s' % (feed.title[:30], self.feed_trans[ret_feed], feed.stories_last_month, '' if feed.has_page else ' [HAS NO PAGE]'))
             
@@ -499,10 +537,10 @@ class Dispatcher:
                 feed.pk, self.feed_trans[ret_feed],))
             logging.debug(done_msg)
             total_duration = time.time() - start_duration
-            MAnalyticsFetcher.add(feed_id=feed.pk, feed_fetch=feed_fetch_duration,
-                                  feed_process=feed_process_duration, 
-                                  page=page_duration, icon=icon_duration,
-                                  total=total_duration, feed_code=feed_code)
+            FetchTelemetry.add(feed_id=feed.pk, feed_fetch=feed_fetch_duration,
+                               feed_process=feed_process_duration, 
+                               page=page_duration, icon=icon_duration,
+                               total=total_duration, feed_code=feed_code)
             
             self.feed_stats[ret_feed] += 1
                 
@@ -520,20 +558,29 @@ class Dispatcher:
         except redis.ConnectionError:
             logging.debug("   ***> [%-30s] ~BMRedis is unavailable for real-time." % (feed.title[:30],))
         
-    def count_unreads_for_subscribers(self, feed):
+    def count_unreads_for_subscribers(self, feed, new_story_hashes=None):
         UNREAD_CUTOFF = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
         user_subs = UserSubscription.objects.filter(feed=feed, 
                                                     active=True,
                                                     user__profile__last_seen_on__gte=UNREAD_CUTOFF)\
                                             .order_by('-last_read_date')
+        user_subs = list(user_subs)
         
-        if not user_subs.count():
+        if not user_subs:
             return
-            
-        for sub in user_subs:
-            if not sub.needs_unread_recalc:
-                sub.needs_unread_recalc = True
-                sub.save()
+        
+        # Subscribers with live unread counters only need this fetch's new stories
+        # added. Everybody else is recounted from scratch.
+        live_subs = []
+        if new_story_hashes and self.options['compute_scores']:
+            live_subs = RUserUnreadCount.live_subscriptions(user_subs)
+            live_sub_ids = set(sub.pk for sub in live_subs)
+            user_subs = [sub for sub in user_subs if sub.pk not in live_sub_ids]
+        
+        if user_subs:
+            UserSubscription.objects.filter(pk__in=[sub.pk for sub in user_subs],
+                                            needs_unread_recalc=False)\
+                                    .update(needs_unread_recalc=True)
 
         if self.options['compute_scores']:
             stories = MStory.objects(story_feed_id=feed.pk,
@@ -541,19 +588,36 @@ class Dispatcher:
                             .read_preference(pymongo.ReadPreference.PRIMARY)
             stories = Feed.format_stories(stories, feed.pk)
             cache.set("S:%s" % feed.pk, stories, 60)
+            if live_subs:
+                new_story_hashes = set(new_story_hashes)
+                new_stories = [story for story in stories if story['story_hash'] in new_story_hashes]
+                UserSubscription.bulk_add_unread_stories(feed.pk, live_subs, new_stories)
+            if not user_subs:
+                return
             logging.debug(u'   ---> [%-30s] ~FYComputing scores: ~SB%s stories~SN with ~SB%s subscribers ~SN(%s/%s/%s)' % (
-                          feed.title[:30], len(stories), user_subs.count(),
+                          feed.title[:30], len(stories), len(user_subs),
                           feed.num_subscribers, feed.active_subscribers, feed.premium_subscribers))        
-            self.calculate_feed_scores_with_stories(user_subs, stories)
+            if len(user_subs) > self.UNREAD_RECALC_SHARD_SIZE:
+                self.shard_feed_scores(feed, user_subs)
+            else:
+                self.calculate_feed_scores_with_stories(feed, user_subs, stories)
         elif self.options.get('mongodb_replication_lag'):
             logging.debug(u'   ---> [%-30s] ~BR~FYSkipping computing scores: ~SB%s seconds~SN of mongodb lag' % (
               feed.title[:30], self.options.get('mongodb_replication_lag')))
     
     @timelimit(10)
-    def calculate_feed_scores_with_stories(self, user_subs, stories):
-        for sub in user_subs:
-            silent = False if self.options['verbose'] >= 2 else True
-            sub.calculate_feed_scores(silent=silent, stories=stories)
+    def calculate_feed_scores_with_stories(self, feed, user_subs, stories):
+        UserSubscription.bulk_calculate_feed_scores(feed.pk, user_subs, stories=stories)
+    
+    def shard_feed_scores(self, feed, user_subs):
+        from apps.reader.tasks import CalculateFeedScores
+        shard_size = self.UNREAD_RECALC_SHARD_SIZE
+        for i in range(0, len(user_subs), shard_size):
+            user_sub_ids = [sub.pk for sub in user_subs[i:i+shard_size]]
+            CalculateFeedScores.apply_async(kwargs=dict(feed_id=feed.pk, user_sub_ids=user_sub_ids),
+                                            queue='work_queue')
+        logging.debug(u'   ---> [%-30s] ~FYSharded scores for ~SB%s subscribers~SN across %s tasks' % (
+                      feed.title[:30], len(user_subs), (len(user_subs) + shard_size - 1) / shard_size))
             
     def add_jobs(self, feeds_queue, feeds_count=1):
         """ adds a feed processing job to the pool
@@ -564,6 +628,8 @@ class Dispatcher:
     def run_jobs(self):
         if self.options['single_threaded']:
             return self.process_feed_wrapper(self.feeds_queue[0])
+        elif self.options.get('async_fetch'):
+            return self.run_async_jobs()
         else:
             for i in range(self.num_threads):
                 feed_queue = self.feeds_queue[i]
@@ -572,4 +638,48 @@ class Dispatcher:
             for i in range(self.num_threads):
                 self.workers[i].start()
 
-                
\ No newline at end of file
+                
+
+    def run_async_jobs(self):
+        """ downloads every queued feed at once on a thread pool, and parses and
+            processes the downloads on a pool of worker processes as they arrive
+        """
+        feed_ids = [feed_id for feed_queue in self.feeds_queue for feed_id in feed_queue]
+        jobs = []
+        for feed_id in feed_ids:
+            ffeed = FetchFeed(feed_id, self.options)
+            if ffeed.feed:
+                jobs.append(ffeed.download_job())
+        django.db.connection.close()
+        
+        # Fork the process pool before starting any download threads.
+        pool = multiprocessing.Pool(self.num_threads)
+        downloader = FeedDownloader(concurrency=self.options.get('concurrency', 100),
+                                    per_host=self.options.get('per_host', 4),
+                                    timeout=self.options.get('timeout', 20))
+        start = time.time()
+        results = []
+        for feed_id, download in downloader.download(jobs):
+            results.append(pool.apply_async(process_downloaded_feed,
+                                            (self.options, feed_id, download)))
+        download_duration = time.time() - start
+        pool.close()
+        pool.join()
+        
+        for result in results:
+            for ret_feed, count in result.get().items():
+                self.feed_stats[ret_feed] += count
+        logging.debug(u' ---> ~FYDownloaded ~SB%s feeds~SN in ~FM%.4ss~FY, processed in ~FM%.4ss' % (
+                      len(jobs), download_duration, time.time() - start))
+
+
+def process_downloaded_feed(options, feed_id, download):
+    """ runs in a worker process: processes one feed that FeedDownloader has
+        already fetched, exactly as if the worker had fetched it itself
+    """
+    options = dict(options, downloads={feed_id: download})
+    disp = Dispatcher(options, 1)
+    disp.process_feed_wrapper([feed_id])
+    django.db.connection.close()
+    
+    return disp.feed_stats
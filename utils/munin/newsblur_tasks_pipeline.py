@@ -15,6 +15,8 @@ class NBMuninGraph(MuninGraph):
             'page.label': 'page',
             'icon.label': 'icon',
             'total.label': 'total',
+            'total_p90.label': 'total (90th percentile)',
+            'total_p99.label': 'total (99th percentile)',
         }
         return graph
 
@@ -23,27 +25,17 @@ class NBMuninGraph(MuninGraph):
     
     @property
     def stats(self):
-        import datetime
-        from django.conf import settings
+        from apps.statistics.fetch_telemetry import RFetchStats
         
-        stats = settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.aggregate([{
-            "$match": {
-                "date": {
-                    "$gt": datetime.datetime.now() - datetime.timedelta(minutes=5),
-                },
-            },
-        }, {
-            "$group": {
-                "_id":          1,
-                "feed_fetch":   {"$avg": "$feed_fetch"},
-                "feed_process": {"$avg": "$feed_process"},
-                "page":         {"$avg": "$page"},
-                "icon":         {"$avg": "$icon"},
-                "total":        {"$avg": "$total"},
-            },
-        }])
+        summary = RFetchStats.summary(minutes=5, percentiles=(90, 99), by_server=False)
+        if not summary:
+            return {}
+        stages = summary['all']['stages']
+        stats = dict((stage, stages[stage]['avg']) for stage in RFetchStats.STAGES)
+        stats['total_p90'] = stages['total'][90]
+        stats['total_p99'] = stages['total'][99]
         
-        return stats['result'][0]
+        return stats
         
 
 if __name__ == '__main__':
@@ -1,7 +1,5 @@
 #!/usr/bin/env python 
 from utils.munin.base import MuninGraph
-import datetime
-from django.conf import settings
 
 
 class NBMuninGraph(MuninGraph):
@@ -17,52 +15,22 @@ class NBMuninGraph(MuninGraph):
             'total.draw'     : 'LINE1',
         }
         stats = self.stats
-        graph.update(dict((("%s.label" % s['_id'].replace('-', ''), s['_id']) for s in stats)))
-        graph.update(dict((("%s.draw" % s['_id'].replace('-', ''), "AREASTACK") for s in stats)))
-        graph['graph_order'] = ' '.join(sorted(s['_id'].replace('-', '') for s in stats))
+        graph.update(dict((("%s.label" % s.replace('-', ''), s) for s in stats)))
+        graph.update(dict((("%s.draw" % s.replace('-', ''), "AREASTACK") for s in stats)))
+        graph['graph_order'] = ' '.join(sorted(s.replace('-', '') for s in stats))
         return graph
 
     def calculate_metrics(self):
-        servers = dict((("%s" % s['_id'].replace('-', ''), s['feeds']) for s in self.stats))
-        servers['total'] = self.total[0]['feeds']
+        stats = self.stats
+        servers = dict((("%s" % server.replace('-', ''), s['count']) for server, s in stats.items()))
+        servers['total'] = sum(s['count'] for s in stats.values())
         return servers
     
     @property
     def stats(self):
-        stats = settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.aggregate([{
-            "$match": {
-                "date": {
-                    "$gte": datetime.datetime.now() - datetime.timedelta(minutes=5),
-                },
-            },
-        }, {
-            "$group": {
-                "_id"   : "$server",
-                "feeds" : {"$sum": 1},
-            },
-        }])
-        
-        return stats['result']
-        
-    @property
-    def total(self):
-        import datetime
-        from django.conf import settings
-        
-        stats = settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.aggregate([{
-            "$match": {
-                "date": {
-                    "$gt": datetime.datetime.now() - datetime.timedelta(minutes=5),
-                },
-            },
-        }, {
-            "$group": {
-                "_id"   : 1,
-                "feeds" : {"$sum": 1},
-            },
-        }])
+        from apps.statistics.fetch_telemetry import RFetchStats
         
-        return stats['result']
+        return RFetchStats.summary(minutes=5)
         
 
 if __name__ == '__main__':
@@ -13,36 +13,22 @@ class NBMuninGraph(MuninGraph):
         }
 
         stats = self.stats
-        graph['graph_order'] = ' '.join(sorted(s['_id'] for s in stats))
-        graph.update(dict((("%s.label" % s['_id'], s['_id']) for s in stats)))
-        graph.update(dict((("%s.draw" % s['_id'], 'LINE1') for s in stats)))
+        graph['graph_order'] = ' '.join(sorted(stats.keys()))
+        graph.update(dict((("%s.label" % s, s) for s in stats)))
+        graph.update(dict((("%s.draw" % s, 'LINE1') for s in stats)))
 
         return graph
 
     def calculate_metrics(self):
-        servers = dict((("%s" % s['_id'], s['total']) for s in self.stats))
+        servers = dict((("%s" % server, s['stages']['total']['avg']) for server, s in self.stats.items()))
 
         return servers
     
     @property
     def stats(self):
-        import datetime
-        from django.conf import settings
+        from apps.statistics.fetch_telemetry import RFetchStats
         
-        stats = settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.aggregate([{
-            "$match": {
-                "date": {
-                    "$gt": datetime.datetime.now() - datetime.timedelta(minutes=5),
-                },
-            },
-        }, {
-            "$group": {
-                "_id"   : "$server",
-                "total" : {"$avg": "$total"},
-            },
-        }])
-        
-        return stats['result']
+        return RFetchStats.summary(minutes=5)
         
 
 if __name__ == '__main__':
@@ -28,7 +28,7 @@ class NBMuninGraph(MuninGraph):
         r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
 
         return {
-            'update_queue': r.scard("queued_feeds"),
+            'update_queue': r.zcard("queued_feeds"),
             'feeds_fetched': r.zcard("fetched_feeds_last_hour"),
             'tasked_feeds': r.zcard("tasked_feeds"),
             'error_feeds': r.zcard("error_feeds"),
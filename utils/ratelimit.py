@@ -1,22 +1,66 @@
 from django.http import HttpResponse
-from django.core.cache import cache
-from datetime import datetime, timedelta
+from django.conf import settings
 import functools
 import hashlib
+import random
+import time
+import redis
+
+# Sliding-window log: drops hits older than the window, counts what's left, and
+# records this hit unless it's over the limit, all in one atomic round trip.
+# Also counts the outcome into a per-minute hash for monitoring.
+SLIDING_WINDOW = """
+local key, stats = KEYS[1], KEYS[2]
+local now, window, limit = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local shadow, name, member = ARGV[4] == '1', ARGV[5], ARGV[6]
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+local count = redis.call('ZCARD', key)
+local outcome = 'allowed'
+if count >= limit then
+    if shadow then outcome = 'shadowed' else outcome = 'limited' end
+end
+if outcome ~= 'limited' then
+    redis.call('ZADD', key, now, member)
+end
+redis.call('EXPIRE', key, math.ceil(window))
+redis.call('HINCRBY', stats, name .. ':' .. outcome, 1)
+redis.call('EXPIRE', stats, 60 * 60 * 24 * 2)
+return {outcome, count}
+"""
 
 class ratelimit(object):
-    "Instances of this class can be used as decorators"
+    """
+    Instances of this class can be used as decorators. Each request is one call
+    to the SLIDING_WINDOW script, keyed by endpoint and user.
+
+    Limits can be overridden without a deploy in settings.RATELIMITS, by endpoint
+    name or by 'name:user_id' for a single user:
+
+        RATELIMITS = {
+            'load_feeds': {'requests': 24, 'minutes': 1},
+            'load_feeds:42': {'shadow': True},
+        }
+
+    In shadow mode requests over the limit are counted but still allowed through.
+    """
     # This class is designed to be sub-classed
     minutes = 1 # The time period
     requests = 4 # Number of allowed requests in that time period
+    shadow = False # Only count requests over the limit, don't refuse them
+    name = None # Endpoint name for policies and counters, defaults to the view's name
+    
+    prefix = 'rl:' # Prefix for redis keys
     
-    prefix = 'rl-' # Prefix for memcache key
+    _script = None
     
     def __init__(self, **options):
         for key, value in options.items():
             setattr(self, key, value)
     
     def __call__(self, fn):
+        if not self.name:
+            self.name = fn.__name__
         def wrapper(request, *args, **kwargs):
             return self.view_wrapper(request, fn, *args, **kwargs)
         functools.update_wrapper(wrapper, fn)
@@ -26,70 +70,89 @@ class ratelimit(object):
         if not self.should_ratelimit(request):
             return fn(request, *args, **kwargs)
         
-        counts = self.get_counters(request).values()
-        
-        # Increment rate limiting counter
-        self.cache_incr(self.current_key(request))
-        
-        # Have they failed?
-        if sum(counts) >= self.requests:
+        if self.hit(request) == 'limited':
             return self.disallowed(request)
         
         return fn(request, *args, **kwargs)
     
-    def cache_get_many(self, keys):
-        return cache.get_many(keys)
+    @classmethod
+    def redis(cls):
+        return redis.Redis(connection_pool=settings.REDIS_POOL)
+    
+    @classmethod
+    def script(cls):
+        if not ratelimit._script:
+            ratelimit._script = cls.redis().register_script(SLIDING_WINDOW)
+        return ratelimit._script
+    
+    def policy(self, request):
+        policies = getattr(settings, 'RATELIMITS', {})
+        policy = dict(minutes=self.minutes, requests=self.requests, shadow=self.shadow)
+        policy.update(policies.get(self.name, {}))
+        user_id = getattr(getattr(request, 'user', None), 'pk', None)
+        if user_id:
+            policy.update(policies.get('%s:%s' % (self.name, user_id), {}))
+        return policy
     
-    def cache_incr(self, key):
-        # memcache is only backend that can increment atomically
+    def hit(self, request):
+        """ Records a request. Returns 'allowed', 'shadowed' or 'limited'. """
+        policy = self.policy(request)
+        now = time.time()
         try:
-            # add first, to ensure the key exists
-            cache.add(key, 0, self.expire_after())
-            cache.incr(key)
-        except (AttributeError, ValueError):
-            cache.set(key, cache.get(key, 0) + 1, self.expire_after())
+            outcome, _ = self.script()(keys=[self.current_key(request),
+                                             self.stats_key(now)],
+                                       args=['%.6f' % now, policy['minutes'] * 60, policy['requests'],
+                                             int(bool(policy['shadow'])), self.name,
+                                             '%.6f:%s' % (now, random.random())],
+                                       client=self.redis())
+        except redis.RedisError:
+            # Fail open: being unable to count requests shouldn't take the site down.
+            return 'allowed'
+        return outcome
     
     def should_ratelimit(self, request):
         return True
     
-    def get_counters(self, request):
-        return self.cache_get_many(self.keys_to_check(request))
+    def current_key(self, request):
+        return '%s%s:%s' % (self.prefix, self.name, self.key_extra(request))
     
-    def keys_to_check(self, request):
-        extra = self.key_extra(request)
-        now = datetime.now()
-        return [
-            '%s%s-%s' % (
-                self.prefix,
-                extra,
-                (now - timedelta(minutes = minute)).strftime('%Y%m%d%H%M')
-            ) for minute in range(self.minutes + 1)
-        ]
+    @classmethod
+    def stats_key(cls, now=None):
+        minute = int(now or time.time()) / 60 * 60
+        return '%sstats:%s' % (cls.prefix, minute)
     
-    def current_key(self, request):
-        return '%s%s-%s' % (
-            self.prefix,
-            self.key_extra(request),
-            datetime.now().strftime('%Y%m%d%H%M')
-        )
+    @classmethod
+    def counters(cls, minutes=60):
+        """
+        Sums the last `minutes` of outcomes as {'name:allowed': n, 'name:limited': n,
+        'name:shadowed': n, ...} for monitoring.
+        """
+        now = time.time()
+        p = cls.redis().pipeline()
+        for minute in range(minutes):
+            p.hgetall(cls.stats_key(now - minute * 60))
+        counters = {}
+        for stats in p.execute():
+            for field, count in stats.items():
+                counters[field] = counters.get(field, 0) + int(count)
+        return counters
     
     def key_extra(self, request):
+        user = getattr(request, 'user', None)
+        if user and user.is_authenticated():
+            return 'u%s' % user.pk
         key = getattr(request.session, 'session_key', '')
         if not key:
             key = request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')[0]
         if not key:
             key = request.COOKIES.get('newsblur_sessionid', '')
         if not key:
-            key = request.META.get('HTTP_USER_AGENT', '')
+            key = hashlib.sha1(request.META.get('HTTP_USER_AGENT', '')).hexdigest()
         return key
     
     def disallowed(self, request):
         "Over-ride this method if you want to log incidents"
         return HttpResponse('Rate limit exceeded', status=429)
-    
-    def expire_after(self):
-        "Used for setting the memcached cache expiry"
-        return (self.minutes + 1) * 60
 
 class ratelimit_post(ratelimit):
     "Rate limit POSTs - can be used to protect a login form"